@@ -0,0 +1,39 @@
+"""Скорость кодирования и разбора сообщений доступными кодеками.
+
+Запуск из каталога python_messenger_v2: python -m benchmarks.bench_codecs
+"""
+
+import timeit
+from common.variables import ACTION, MESSAGE, TIME, SENDER, DESTINATION, MESSAGE_TEXT
+from common.message_codecs import CODECS
+
+NUMBER = 50000
+
+
+def make_message(text_length):
+    return {
+        ACTION: MESSAGE,
+        TIME: 1647000000.123,
+        SENDER: 'test1',
+        DESTINATION: 'test2',
+        MESSAGE_TEXT: 'Привет, мир! ' * (text_length // 13 + 1),
+    }
+
+
+def ops_per_second(func):
+    return NUMBER / min(timeit.repeat(func, number=NUMBER, repeat=3))
+
+
+def main():
+    print(f'{"кодек":<10}{"текст":>8}{"размер":>8}{"кодирование/с":>16}{"разбор/с":>12}')
+    for text_length in (20, 1000):
+        message = make_message(text_length)
+        for name, codec in CODECS.items():
+            payload = codec.encode(message)
+            encode_rate = ops_per_second(lambda: codec.encode(message))
+            decode_rate = ops_per_second(lambda: codec.decode(payload))
+            print(f'{name:<10}{text_length:>8}{len(payload):>8}{encode_rate:>16.0f}{decode_rate:>12.0f}')
+
+
+if __name__ == '__main__':
+    main()
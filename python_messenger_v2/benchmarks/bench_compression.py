@@ -0,0 +1,80 @@
+"""Сжатие кадров: степень сжатия, затраты процессора и точка окупаемости.
+
+Для каждого доступного алгоритма и размера сообщения выводится размер после
+сжатия, скорость сжатия и распаковки и пропускная способность канала, ниже
+которой сжатие окупается: время передачи сэкономленных байт больше времени
+сжатия у отправителя и распаковки у получателя. Помогает выбрать порог
+COMPRESSION_THRESHOLD.
+
+Запуск из каталога python_messenger_v2: python -m benchmarks.bench_compression
+"""
+
+import base64
+import json
+import random
+import timeit
+from common.variables import ACTION, MESSAGE, TIME, SENDER, DESTINATION, MESSAGE_TEXT
+from common.message_codecs import JSON_CODEC
+from common.compression import COMPRESSIONS
+
+SIZES = (64, 128, 256, 512, 1024, 4096, 16384, 65536)
+WORDS = ('привет как дела сервер сообщение отправка пользователь комната история '
+         'сегодня завтра отчет задача готово ошибка проверка запуск версия файл '
+         'the and of to message server release build deploy check status').split()
+
+
+def make_text(size, rng):
+    """Текст из случайных слов: сжимается примерно как вставленная в чат переписка."""
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return ' '.join(words)[:size]
+
+
+def make_machine(size, rng):
+    """JSON с числами и идентификаторами, как в сообщениях ботов."""
+    items = []
+    while len(json.dumps(items)) < size:
+        items.append({'id': rng.randrange(10 ** 9), 'status': rng.choice(('ok', 'fail', 'retry')),
+                      'value': round(rng.random() * 1000, 3)})
+    return json.dumps(items)[:size]
+
+
+def make_random(size, rng):
+    """Закодированные двоичные данные, почти не сжимаются."""
+    return base64.b64encode(rng.randbytes(size))[:size].decode('ascii')
+
+
+KINDS = (('текст', make_text), ('машинные', make_machine), ('base64', make_random))
+
+
+def seconds_per_call(func, payload_size):
+    number = max(10, 2000000 // max(payload_size, 1))
+    return min(timeit.repeat(func, number=number, repeat=3)) / number
+
+
+def main():
+    rng = random.Random(1)
+    print(f'{"данные":<10}{"алгоритм":<8}{"размер":>8}{"сжатый":>8}{"сжатие, мкс":>13}'
+          f'{"распаковка, мкс":>17}{"окупается ниже, Мбит/с":>25}')
+    for kind, make in KINDS:
+        for size in SIZES:
+            payload = JSON_CODEC.encode({ACTION: MESSAGE, TIME: 1647000000.123, SENDER: 'test1',
+                                         DESTINATION: 'test2', MESSAGE_TEXT: make(size, rng)})
+            for name, compression in COMPRESSIONS.items():
+                compressed = compression.compress(payload)
+                compress_time = seconds_per_call(lambda: compression.compress(payload), len(payload))
+                decompress_time = seconds_per_call(
+                    lambda: compression.decompress(compressed, len(payload)), len(payload))
+                saved = len(payload) - len(compressed)
+                # Канал, по которому сэкономленные байты передаются столько же, сколько длится сжатие и распаковка
+                break_even = saved * 8 / (compress_time + decompress_time) / 1e6 if saved > 0 else 0
+                print(f'{kind:<10}{name:<8}{len(payload):>8}{len(compressed):>8}{compress_time * 1e6:>13.1f}'
+                      f'{decompress_time * 1e6:>17.1f}{break_even:>25.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""Стоимость выбора обработчика и проверки сообщения, готовые ответы против кодирования.
+
+Сравнивается прежняя цепочка проверок if/elif с таблицей действий и
+собранными по схемам функциями проверки, а также кодирование ответа 400
+при каждом запросе с готовым кадром CannedResponse.
+
+Запуск из каталога python_messenger_v2: python -m benchmarks.bench_dispatch
+"""
+
+import timeit
+from types import SimpleNamespace
+from common.variables import ACTION, PRESENCE, TIME, USER, ACCOUNT_NAME, MESSAGE, MESSAGE_TEXT, SENDER, \
+    DESTINATION, PING, PONG, JOIN, LEAVE, ROOM, HISTORY, EXIT, STATUS_CODE, STATUS, ERROR, PROTOCOL_VERSION
+from common.utils import encode_message
+from common.message_codecs import CODECS
+from server_core.dispatch import ActionRegistry, CannedResponse, UNKNOWN_ACTION
+
+NUMBER = 200000
+
+MESSAGES = {
+    'message': {ACTION: MESSAGE, TIME: 1.1, SENDER: 'test1', DESTINATION: 'test2', MESSAGE_TEXT: 'Привет'},
+    'exit': {ACTION: EXIT, TIME: 1.1, ACCOUNT_NAME: 'test1'},
+    'bad': {ACTION: 'unknown', TIME: 1.1},
+}
+
+
+def chain(message, client):
+    """Прежний разбор: действия и поля проверяются подряд, пока не найдется подходящая ветвь."""
+    if ACTION in message and message[ACTION] == PRESENCE and TIME in message and USER in message:
+        return 'presence'
+    elif ACTION in message and message[ACTION] == MESSAGE \
+            and TIME in message and MESSAGE_TEXT in message \
+            and DESTINATION in message and SENDER in message:
+        return 'message'
+    elif ACTION in message and message[ACTION] == PING:
+        return 'ping'
+    elif ACTION in message and message[ACTION] == PONG:
+        return 'pong'
+    elif ACTION in message and message[ACTION] in (JOIN, LEAVE) and ROOM in message \
+            and client.name is not None:
+        return 'room'
+    elif ACTION in message and message[ACTION] == HISTORY and DESTINATION in message \
+            and client.name is not None:
+        return 'history'
+    elif ACTION in message and message[ACTION] == EXIT and ACCOUNT_NAME in message:
+        return 'exit'
+    return None
+
+
+class Handlers:
+    actions = ActionRegistry()
+
+    @actions.action(PRESENCE, {TIME: None, USER: dict})
+    def presence(self, message, client):
+        return 'presence'
+
+    @actions.action(MESSAGE, {TIME: None, MESSAGE_TEXT: None, DESTINATION: str, SENDER: str})
+    def message(self, message, client):
+        return 'message'
+
+    @actions.action(PING)
+    def ping(self, message, client):
+        return 'ping'
+
+    @actions.action(PONG)
+    def pong(self, message, client):
+        return 'pong'
+
+    @actions.action(JOIN, {ROOM: None}, named=True)
+    def join(self, message, client):
+        return 'room'
+
+    @actions.action(LEAVE, {ROOM: None}, named=True)
+    def leave(self, message, client):
+        return 'room'
+
+    @actions.action(HISTORY, {DESTINATION: str}, named=True)
+    def history(self, message, client):
+        return 'history'
+
+    @actions.action(EXIT, {ACCOUNT_NAME: None})
+    def exit(self, message, client):
+        return 'exit'
+
+
+def make_table(handlers):
+    table = handlers.actions.bind(handlers)
+
+    def dispatch(message, client):
+        try:
+            validate, handler = table.get(message.get(ACTION), UNKNOWN_ACTION)
+        except TypeError:
+            validate, handler = UNKNOWN_ACTION
+        if validate(message, client):
+            return handler(message, client)
+        return None
+
+    return dispatch
+
+
+def ops_per_second(func):
+    return NUMBER / min(timeit.repeat(func, number=NUMBER, repeat=3))
+
+
+def main():
+    client = SimpleNamespace(name='test1', protocol_version=PROTOCOL_VERSION, codec=CODECS['json'])
+    table = make_table(Handlers())
+    print(f'{"сообщение":<12}{"if/elif, оп/с":>16}{"таблица, оп/с":>16}')
+    for kind, message in MESSAGES.items():
+        assert chain(message, client) == table(message, client)
+        chain_rate = ops_per_second(lambda: chain(message, client))
+        table_rate = ops_per_second(lambda: table(message, client))
+        print(f'{kind:<12}{chain_rate:>16.0f}{table_rate:>16.0f}')
+
+    response = {STATUS_CODE: 400, STATUS: 'Bad Request', ERROR: 'Некоректный запрос'}
+    canned = CannedResponse(response)
+    print(f'\n{"кодек":<12}{"кодирование, оп/с":>20}{"готовый кадр, оп/с":>20}')
+    for name, codec in CODECS.items():
+        client.codec = codec
+        encode_rate = ops_per_second(lambda: encode_message(response, client.protocol_version, codec))
+        canned_rate = ops_per_second(lambda: canned.frame_for(client))
+        print(f'{name:<12}{encode_rate:>20.0f}{canned_rate:>20.0f}')
+
+
+if __name__ == '__main__':
+    main()
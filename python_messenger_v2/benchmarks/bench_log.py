@@ -0,0 +1,46 @@
+"""Стоимость вызова функции, обернутой декоратором log.
+
+Запуск из каталога python_messenger_v2: python -m benchmarks.bench_log
+"""
+
+import logging
+import timeit
+import decors
+
+NUMBER = 200000
+
+
+def target(first, second):
+    return first + second
+
+
+def measure(func):
+    return min(timeit.repeat(lambda: func(1, 2), number=NUMBER, repeat=5)) / NUMBER * 1e9
+
+
+def main():
+    logger = decors.LOGGER
+    handlers, level = logger.handlers[:], logger.level
+    # Записи уходят в NullHandler, чтобы измерять сам декоратор, а не запись на диск
+    logger.handlers = [logging.NullHandler()]
+    try:
+        results = {'без декоратора': measure(target)}
+
+        logger.setLevel(logging.INFO)
+        results['log, DEBUG выключен'] = measure(decors.log(target))
+
+        logger.setLevel(logging.DEBUG)
+        results['log, DEBUG включен'] = measure(decors.log(target))
+
+        decors.LOG_CALLS = False
+        results['log, MESSENGER_LOG_CALLS=0'] = measure(decors.log(target))
+        decors.LOG_CALLS = True
+    finally:
+        logger.handlers, logger.level = handlers, level
+
+    for name, nanoseconds in results.items():
+        print(f'{name:<30} {nanoseconds:8.0f} нс/вызов')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""Прием кадров: recv с новой порцией bytes на каждое чтение против recv_into в буфер соединения.
+
+Отправитель в отдельном потоке пишет в пару сокетов поток коротких кадров,
+читатель разбирает их кодеком (decode_frame). Выводится скорость приема.
+
+Запуск из каталога python_messenger_v2: python -m benchmarks.bench_recv
+"""
+
+import socket
+import threading
+import time
+from common.variables import ACTION, MESSAGE, TIME, SENDER, DESTINATION, MESSAGE_TEXT, RECV_BUFFER_SIZE
+from common.utils import MessageDecoder, encode_message
+from common.message_codecs import CODECS
+
+FRAMES = 200000
+
+
+def read_recv(sock, decoder):
+    data = sock.recv(RECV_BUFFER_SIZE)
+    decoder.append(data)
+    return len(data)
+
+
+def read_recv_into(sock, decoder):
+    return decoder.recv_into(sock)
+
+
+def run(read, frame, codec):
+    reader, writer = socket.socketpair()
+    blob = frame * 1000
+    sender = threading.Thread(target=lambda: [writer.sendall(blob) for _ in range(FRAMES // 1000)])
+    decoder = MessageDecoder(codec=codec)
+    started = time.perf_counter()
+    sender.start()
+    count = 0
+    while count < FRAMES:
+        if not read(reader, decoder):
+            break
+        for frame_view, _ in decoder.frames():
+            decoder.decode_frame(frame_view)
+            count += 1
+    elapsed = time.perf_counter() - started
+    sender.join()
+    reader.close()
+    writer.close()
+    return count / elapsed
+
+
+def main():
+    message = {ACTION: MESSAGE, TIME: 1647000000.123, SENDER: 'test1', DESTINATION: 'test2', MESSAGE_TEXT: 'Привет'}
+    print(f'{"кодек":<10}{"способ":<12}{"кадров/с":>12}')
+    for name, codec in CODECS.items():
+        frame = encode_message(message, codec=codec)
+        for label, read in (('recv', read_recv), ('recv_into', read_recv_into)):
+            rate = max(run(read, frame, codec) for _ in range(3))
+            print(f'{name:<10}{label:<12}{rate:>12.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,534 @@
+"""Нагрузочное тестирование сервера.
+
+Запускает локальный сервер в отдельном процессе и нагружает его тысячами
+клиентов на asyncio. Сценарии: presence - шквал подключений, pingpong -
+обмен сообщениями в парах, fanout - рассылка в комнату, slow - часть
+получателей читает медленно, large - обмен большими сообщениями, stream -
+поток мелких сообщений в парах без ожидания ответа.
+
+Для каждого сценария выводятся сообщения в секунду, задержка доставки
+p50/p99/p999, скорость установки соединений, память (RSS) и загрузка
+процессора сервера, а также число вызовов записи в сокеты на одно
+доставленное сообщение (по метрикам сервера). Результаты сохраняются
+в JSON и сравниваются с ранее сохраненным прогоном.
+
+Запуск из каталога python_messenger_v2:
+    python -m benchmarks.loadgen --clients 1000 --output run.json --baseline old.json
+
+Запись по одному кадру на вызов против записи пачками:
+    python -m benchmarks.loadgen --scenarios stream --server-args "--write-batch-frames 1" --output one.json
+    python -m benchmarks.loadgen --scenarios stream --baseline one.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+from common.variables import ACTION, PRESENCE, TIME, USER, ACCOUNT_NAME, VERSION, CODEC, CODECS, \
+    MESSAGE, SENDER, DESTINATION, MESSAGE_TEXT, STATUS_CODE, JOIN, ROOM, PROTOCOL_VERSION, \
+    LEGACY_PROTOCOL_VERSION, PING, PONG
+from common.utils import MessageDecoder, encode_message
+from common.message_codecs import JSON_CODEC, get_codec
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ('presence', 'pingpong', 'fanout', 'slow', 'large', 'stream')
+WRITE_CALLS_METRIC = 'messenger_write_calls_total'
+# Метрики для сравнения с прошлым прогоном и направление, в котором они лучше
+COMPARED_METRICS = (
+    ('msgs_per_sec', 1),
+    ('connect_per_sec', 1),
+    ('latency_p50_ms', -1),
+    ('latency_p99_ms', -1),
+    ('latency_p999_ms', -1),
+    ('server_rss_max_mb', -1),
+    ('server_cpu_percent', -1),
+    ('writes_per_message', -1),
+)
+
+
+def percentile(sorted_samples, fraction):
+    if not sorted_samples:
+        return None
+    return sorted_samples[min(int(fraction * len(sorted_samples)), len(sorted_samples) - 1)]
+
+
+class ServerProcess:
+    """Сервер, запущенный в дочернем процессе, и замеры его памяти и процессорного времени."""
+
+    def __init__(self, port, args=(), log_level='WARNING', admin_port=None):
+        self.port = port
+        self.admin_port = admin_port
+        if admin_port is not None:
+            args = ['--admin-port', str(admin_port), *args]
+        env = dict(os.environ, MESSENGER_LOG_LEVEL=log_level)
+        self.process = subprocess.Popen(
+            [sys.executable, 'server.py', '-a', '127.0.0.1', '-p', str(port), *args],
+            cwd=SERVER_DIR, env=env)
+        self.wait_ready()
+
+    def wait_ready(self, timeout=10):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f'Сервер завершился с кодом {self.process.returncode}')
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=1).close()
+                return
+            except OSError:
+                time.sleep(0.05)
+        raise RuntimeError('Сервер не начал принимать подключения')
+
+    def pids(self):
+        """Процесс сервера и его рабочие процессы (режим --workers)."""
+        pids = [self.process.pid]
+        for pid in pids:
+            try:
+                with open(f'/proc/{pid}/task/{pid}/children') as file:
+                    pids.extend(int(child) for child in file.read().split())
+            except OSError:
+                pass
+        return pids
+
+    def usage(self):
+        """Суммарные RSS в байтах и процессорное время в секундах, None вне Linux."""
+        rss = cpu = 0
+        page_size = os.sysconf('SC_PAGE_SIZE')
+        ticks = os.sysconf('SC_CLK_TCK')
+        try:
+            for pid in self.pids():
+                with open(f'/proc/{pid}/stat') as file:
+                    fields = file.read().rsplit(')', 1)[1].split()
+                # После имени процесса: utime и stime - 12 и 13 поле, rss - 22 поле
+                cpu += (int(fields[11]) + int(fields[12])) / ticks
+                rss += int(fields[21]) * page_size
+        except (OSError, IndexError, ValueError):
+            return None
+        return rss, cpu
+
+    def write_calls(self):
+        """Суммарное число вызовов записи в сокеты клиентов, None без метрик."""
+        if self.admin_port is None:
+            return None
+        total = None
+        # Рабочие процессы (режим --workers) отдают метрики на соседних портах
+        for port in range(self.admin_port, self.admin_port + len(self.pids())):
+            try:
+                with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics', timeout=5) as response:
+                    text = response.read().decode('utf-8')
+            except OSError:
+                continue
+            total = total or 0
+            for line in text.splitlines():
+                if line.startswith(WRITE_CALLS_METRIC + ' '):
+                    total += float(line.split()[1])
+        return total
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+class ResourceSampler:
+    """Периодически снимает память и процессорное время сервера во время сценария."""
+
+    def __init__(self, server, interval=0.1):
+        self.server = server
+        self.interval = interval
+        self.rss_max = 0
+        self.cpu_start = self.cpu_end = None
+        self.task = None
+
+    async def run(self):
+        while True:
+            self.sample()
+            await asyncio.sleep(self.interval)
+
+    def sample(self):
+        usage = self.server.usage() if self.server is not None else None
+        if usage is None:
+            return
+        rss, cpu = usage
+        self.rss_max = max(self.rss_max, rss)
+        if self.cpu_start is None:
+            self.cpu_start = cpu
+        self.cpu_end = cpu
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        self.sample()
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+
+class SimClient:
+    """Клиент для нагрузки: приветствие, отправка кадров и прием сообщений в очередь."""
+
+    def __init__(self, name, codec_name='json'):
+        self.name = name
+        self.codec_name = codec_name
+        self.codec = JSON_CODEC
+        self.protocol_version = LEGACY_PROTOCOL_VERSION
+        self.decoder = MessageDecoder()
+        self.messages = asyncio.Queue()
+        self.latencies = []
+        self.received = 0
+        # Пауза после каждого принятого сообщения, имитирует медленного получателя
+        self.read_delay = 0
+        self.reader = self.writer = self.read_task = None
+
+    async def connect(self, port):
+        self.reader, self.writer = await asyncio.open_connection('127.0.0.1', port)
+        presence = {ACTION: PRESENCE, TIME: time.time(), USER: {ACCOUNT_NAME: self.name},
+                    VERSION: PROTOCOL_VERSION, CODECS: [self.codec_name]}
+        self.writer.write(encode_message(presence, LEGACY_PROTOCOL_VERSION))
+        response = await self.next_message()
+        if response.get(STATUS_CODE) != 200:
+            raise ConnectionError(f'Сервер отклонил подключение {self.name}: {response}')
+        self.protocol_version = response.get(VERSION, LEGACY_PROTOCOL_VERSION)
+        self.codec = self.decoder.codec = get_codec(response.get(CODEC))
+        self.read_task = asyncio.get_running_loop().create_task(self.read_loop())
+        return response
+
+    async def next_message(self):
+        while True:
+            message = self.decoder.next_message()
+            if message is not None:
+                return message
+            data = await self.reader.read(65536)
+            if not data:
+                raise ConnectionResetError('Сервер закрыл соединение')
+            self.decoder.append(data)
+
+    async def read_loop(self):
+        try:
+            while True:
+                message = await self.next_message()
+                if message.get(ACTION) == PING:
+                    self.writer.write(encode_message({ACTION: PONG, TIME: message.get(TIME)},
+                                                     self.protocol_version, self.codec))
+                    continue
+                if message.get(ACTION) == MESSAGE:
+                    self.received += 1
+                    # В поле времени отправитель передает time.monotonic(), часы общие для процессов машины
+                    self.latencies.append(time.monotonic() - message[TIME])
+                    if self.read_delay:
+                        await asyncio.sleep(self.read_delay)
+                self.messages.put_nowait(message)
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+
+    def send(self, destination, text):
+        self.writer.write(encode_message({
+            ACTION: MESSAGE,
+            TIME: time.monotonic(),
+            SENDER: self.name,
+            DESTINATION: destination,
+            MESSAGE_TEXT: text,
+        }, self.protocol_version, self.codec))
+
+    async def request(self, message):
+        self.writer.write(encode_message(message, self.protocol_version, self.codec))
+        return await self.messages.get()
+
+    async def close(self):
+        if self.read_task is not None:
+            self.read_task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except ConnectionError:
+                pass
+
+
+async def connect_clients(port, names, codec_name, concurrency):
+    """Подключает клиентов не больше concurrency одновременно; возвращает клиентов и время рукопожатий."""
+    semaphore = asyncio.Semaphore(concurrency)
+    handshakes = []
+
+    async def connect(name):
+        client = SimClient(name, codec_name)
+        async with semaphore:
+            started = time.monotonic()
+            await client.connect(port)
+            handshakes.append(time.monotonic() - started)
+        return client
+
+    clients = await asyncio.gather(*(connect(name) for name in names))
+    return clients, handshakes
+
+
+async def wait_received(clients, expected, timeout):
+    deadline = time.monotonic() + timeout
+    while sum(client.received for client in clients) < expected and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+
+
+async def scenario_presence(port, options):
+    names = [f'presence{i}' for i in range(options.clients)]
+    started = time.monotonic()
+    clients, handshakes = await connect_clients(port, names, options.codec, options.concurrency)
+    elapsed = time.monotonic() - started
+    await asyncio.gather(*(client.close() for client in clients))
+    return {'connections': len(clients), 'duration': elapsed, 'connect_per_sec': len(clients) / elapsed,
+            'latencies': handshakes}
+
+
+async def ping_pong(port, options, prefix, text, rounds):
+    pairs = max(options.clients // 2, 1)
+    started = time.monotonic()
+    clients, _ = await connect_clients(port, [f'{prefix}{i}' for i in range(pairs * 2)],
+                                       options.codec, options.concurrency)
+    connect_elapsed = time.monotonic() - started
+
+    async def exchange(first, second):
+        for _ in range(rounds):
+            first.send(second.name, text)
+            await second.messages.get()
+            second.send(first.name, text)
+            await first.messages.get()
+
+    started = time.monotonic()
+    await asyncio.wait_for(asyncio.gather(*(exchange(clients[i], clients[i + 1])
+                                            for i in range(0, len(clients), 2))), options.timeout)
+    elapsed = time.monotonic() - started
+    received = sum(client.received for client in clients)
+    await asyncio.gather(*(client.close() for client in clients))
+    return {'messages': received, 'duration': elapsed, 'msgs_per_sec': received / elapsed,
+            'connect_per_sec': len(clients) / connect_elapsed,
+            'latencies': [latency for client in clients for latency in client.latencies]}
+
+
+async def scenario_pingpong(port, options):
+    return await ping_pong(port, options, 'ping', 'x' * options.payload, options.messages)
+
+
+async def scenario_large(port, options):
+    rounds = max(options.messages // 10, 1)
+    return await ping_pong(port, options, 'large', 'x' * options.large_payload, rounds)
+
+
+async def scenario_fanout(port, options):
+    clients, _ = await connect_clients(port, [f'fanout{i}' for i in range(options.clients)],
+                                       options.codec, options.concurrency)
+    responses = await asyncio.gather(*(client.request({ACTION: JOIN, TIME: time.time(), ROOM: '#bench'})
+                                       for client in clients))
+    for response in responses:
+        if response.get(STATUS_CODE) != 200:
+            raise ConnectionError(f'Сервер не принял вход в комнату: {response}')
+    sender, members = clients[0], clients[1:]
+    text = 'x' * options.payload
+    expected = len(members) * options.messages
+    started = time.monotonic()
+    for _ in range(options.messages):
+        sender.send('#bench', text)
+        await sender.writer.drain()
+    await wait_received(members, expected, options.timeout)
+    elapsed = time.monotonic() - started
+    received = sum(client.received for client in members)
+    await asyncio.gather(*(client.close() for client in clients))
+    return {'messages': received, 'lost': expected - received, 'duration': elapsed,
+            'msgs_per_sec': received / elapsed,
+            'latencies': [latency for client in members for latency in client.latencies]}
+
+
+async def scenario_slow(port, options):
+    pairs = max(options.clients // 2, 1)
+    clients, _ = await connect_clients(port, [f'slow{i}' for i in range(pairs * 2)],
+                                       options.codec, options.concurrency)
+    senders, receivers = clients[0::2], clients[1::2]
+    # Каждый десятый получатель читает медленно
+    slow = receivers[::10]
+    for receiver in slow:
+        receiver.read_delay = options.slow_delay
+    fast = [receiver for receiver in receivers if not receiver.read_delay]
+    text = 'x' * options.payload
+
+    async def stream(sender, receiver):
+        for _ in range(options.messages):
+            sender.send(receiver.name, text)
+            await sender.writer.drain()
+
+    started = time.monotonic()
+    streams = asyncio.gather(*(stream(sender, receiver) for sender, receiver in zip(senders, receivers)))
+    await wait_received(fast, len(fast) * options.messages, options.timeout)
+    elapsed = time.monotonic() - started
+    received = sum(client.received for client in fast)
+    streams.cancel()
+    try:
+        await streams
+    except asyncio.CancelledError:
+        pass
+    await asyncio.gather(*(client.close() for client in clients))
+    return {'messages': received, 'lost': len(fast) * options.messages - received, 'duration': elapsed,
+            'msgs_per_sec': received / elapsed,
+            'slow_received': sum(client.received for client in slow),
+            'latencies': [latency for client in fast for latency in client.latencies]}
+
+
+async def scenario_stream(port, options):
+    pairs = max(options.clients // 2, 1)
+    clients, _ = await connect_clients(port, [f'stream{i}' for i in range(pairs * 2)],
+                                       options.codec, options.concurrency)
+    senders, receivers = clients[0::2], clients[1::2]
+    text = 'x' * options.payload
+    expected = pairs * options.messages
+
+    async def stream(sender, receiver):
+        # Сообщения пишутся подряд: сервер получает их пачками и отвечает многими кадрами за итерацию
+        for _ in range(options.messages):
+            sender.send(receiver.name, text)
+        await sender.writer.drain()
+
+    started = time.monotonic()
+    await asyncio.gather(*(stream(sender, receiver) for sender, receiver in zip(senders, receivers)))
+    await wait_received(receivers, expected, options.timeout)
+    elapsed = time.monotonic() - started
+    received = sum(client.received for client in receivers)
+    await asyncio.gather(*(client.close() for client in clients))
+    return {'messages': received, 'lost': expected - received, 'duration': elapsed,
+            'msgs_per_sec': received / elapsed,
+            'latencies': [latency for client in receivers for latency in client.latencies]}
+
+
+async def run_scenario(name, port, server, options):
+    sampler = ResourceSampler(server)
+    write_calls = server.write_calls() if server is not None else None
+    sampler.start()
+    try:
+        result = await globals()[f'scenario_{name}'](port, options)
+    finally:
+        await sampler.stop()
+    if write_calls is not None:
+        # Ответы на приветствия тоже вызовы записи, поэтому для presence это число вызовов на подключение
+        result['server_write_calls'] = server.write_calls() - write_calls
+        delivered = result.get('messages') or result.get('connections')
+        if delivered:
+            result['writes_per_message'] = result['server_write_calls'] / delivered
+    latencies = sorted(result.pop('latencies'))
+    for label, fraction in (('p50', 0.5), ('p99', 0.99), ('p999', 0.999)):
+        value = percentile(latencies, fraction)
+        result[f'latency_{label}_ms'] = value * 1000 if value is not None else None
+    if sampler.cpu_start is not None:
+        result['server_rss_max_mb'] = sampler.rss_max / 1024 / 1024
+        result['server_cpu_percent'] = (sampler.cpu_end - sampler.cpu_start) / result['duration'] * 100
+    return result
+
+
+def compare(results, baseline):
+    """Печатает изменение метрик относительно прошлого прогона."""
+    print(f'\n{"сценарий":<10}{"метрика":<20}{"было":>12}{"стало":>12}{"изменение":>12}')
+    for name, result in results['scenarios'].items():
+        old = baseline.get('scenarios', {}).get(name)
+        if old is None:
+            continue
+        for metric, direction in COMPARED_METRICS:
+            before, after = old.get(metric), result.get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before * 100
+            mark = '+' if change * direction > 0 else '-' if change else ' '
+            print(f'{name:<10}{metric:<20}{before:>12.2f}{after:>12.2f}{change:>+11.1f}%{mark}')
+
+
+def print_result(name, result):
+    def value(key, spec):
+        return format(result[key], spec) if result.get(key) is not None else '-'
+
+    print(f'{name:<10}{value("msgs_per_sec", ".0f"):>12}{value("connect_per_sec", ".0f"):>12}'
+          f'{value("latency_p50_ms", ".2f"):>10}{value("latency_p99_ms", ".2f"):>10}'
+          f'{value("latency_p999_ms", ".2f"):>10}{value("server_rss_max_mb", ".1f"):>10}'
+          f'{value("server_cpu_percent", ".0f"):>8}{value("writes_per_message", ".3f"):>12}')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def run(options):
+    results = {
+        'meta': {
+            'time': time.time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'clients': options.clients,
+            'messages': options.messages,
+            'codec': options.codec,
+            'server_args': options.server_args,
+        },
+        'scenarios': dict(),
+    }
+    print(f'{"сценарий":<10}{"сообщ./с":>12}{"подкл./с":>12}{"p50 мс":>10}{"p99 мс":>10}'
+          f'{"p999 мс":>10}{"RSS Мб":>10}{"CPU %":>8}{"выз./сообщ.":>12}')
+    for name in options.scenarios:
+        # Каждый сценарий получает свежий сервер, чтобы замеры памяти не смешивались
+        server = None
+        port = options.port
+        if port is None:
+            port = free_port()
+            server = ServerProcess(port, options.server_args.split(), options.server_log_level, free_port())
+        try:
+            result = await run_scenario(name, port, server, options)
+        finally:
+            if server is not None:
+                server.stop()
+        results['scenarios'][name] = result
+        print_result(name, result)
+    return results
+
+
+def arg_parser(argv=None):
+    parser = argparse.ArgumentParser(description='Нагрузочное тестирование сервера сообщений')
+    parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS), choices=SCENARIOS)
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--messages', type=int, default=100, help='сообщений на клиента или пару')
+    parser.add_argument('--payload', type=int, default=64, help='длина текста сообщения')
+    parser.add_argument('--large-payload', type=int, default=256 * 1024)
+    parser.add_argument('--slow-delay', type=float, default=0.005, help='пауза медленного получателя, с')
+    parser.add_argument('--codec', default='json')
+    parser.add_argument('--concurrency', type=int, default=256, help='одновременных подключений')
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--port', type=int, default=None, help='нагружать уже запущенный сервер')
+    parser.add_argument('--server-args', default='', help='дополнительные аргументы server.py')
+    parser.add_argument('--server-log-level', default='WARNING')
+    parser.add_argument('--output', default=None, help='файл для результатов в JSON')
+    parser.add_argument('--baseline', default=None, help='JSON прошлого прогона для сравнения')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = arg_parser(argv)
+    try:
+        import uvloop
+    except ImportError:
+        results = asyncio.run(run(options))
+    else:
+        with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
+            results = runner.run(run(options))
+    if options.output:
+        with open(options.output, 'w', encoding='utf-8') as file:
+            json.dump(results, file, ensure_ascii=False, indent=2)
+    if options.baseline:
+        with open(options.baseline, encoding='utf-8') as file:
+            compare(results, json.load(file))
+
+
+if __name__ == '__main__':
+    main()
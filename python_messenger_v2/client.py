@@ -2,14 +2,16 @@ import argparse
 import socket
 import sys
 import time
-import json
 import logging
 import threading
 import logs.configs.client_log_config
 from common.variables import DEFAULT_IP_ADDRESS, DEFAULT_PORT, ACTION, TIME, \
     USER, ACCOUNT_NAME, PRESENCE, STATUS_CODE, STATUS, MESSAGE, MESSAGE_TEXT, \
-    SENDER, EXIT, DESTINATION, ERROR
+    SENDER, EXIT, DESTINATION, ERROR, VERSION, PROTOCOL_VERSION, LEGACY_PROTOCOL_VERSION, CODEC, CODECS, \
+    JOIN, LEAVE, ROOM, ROOM_PREFIX, PING, PONG, COMPRESSION, COMPRESSIONS
 from common.utils import send_message, get_message
+from common.message_codecs import CODECS as SUPPORTED_CODECS, JSON_CODEC, get_codec
+from common.compression import COMPRESSIONS as SUPPORTED_COMPRESSIONS, get_compression
 from decors import log
 
 # Инициализация клиентского логера
@@ -44,6 +46,9 @@ class Client:
         self.server_ip = server_ip
         self.server_port = server_port
         self.client_name = client_name
+        self.protocol_version = LEGACY_PROTOCOL_VERSION
+        self.codec = JSON_CODEC
+        self.compression = None
 
     @log
     def init_socket(self):
@@ -56,9 +61,13 @@ class Client:
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.sock.connect((self.server_ip, self.server_port))
             message_to_server = self.create_presence()
-            send_message(self.sock, message_to_server)
+            # Приветствие отправляется без разметки, чтобы его понял и сервер первой версии
+            send_message(self.sock, message_to_server, LEGACY_PROTOCOL_VERSION)
             response_from_server = get_message(self.sock)
             checked_response = self.check_presence_response(response_from_server)
+            self.protocol_version = response_from_server.get(VERSION, LEGACY_PROTOCOL_VERSION)
+            self.codec = get_codec(response_from_server.get(CODEC))
+            self.compression = get_compression(response_from_server.get(COMPRESSION))
             CLIENT_LOGGER.info(f'Установленно соединение с сервером. Ответ сервера: {checked_response}')
             print(f'Установленно соединение с сервером.')
 
@@ -71,11 +80,14 @@ class Client:
 
         self.init_socket()
 
-        module_sender = ClientSender(self.client_name, self.sock)
+        # Получатель отвечает на ping сам, поэтому запись в сокет из двух потоков разделяется блокировкой
+        send_lock = threading.Lock()
+        module_sender = ClientSender(self.client_name, self.sock, self.protocol_version, self.codec, send_lock,
+                                     self.compression)
         module_sender.daemon = True
         module_sender.start()
 
-        module_receiver = ClientReceiver(self.client_name, self.sock)
+        module_receiver = ClientReceiver(self.client_name, self.sock, self.codec, self.protocol_version, send_lock)
         module_receiver.daemon = True
         module_receiver.start()
         CLIENT_LOGGER.debug('Запущены процессы получения и отправки сообщений.')
@@ -93,7 +105,10 @@ class Client:
             TIME: time.time(),
             USER: {
                 ACCOUNT_NAME: self.client_name
-            }
+            },
+            VERSION: PROTOCOL_VERSION,
+            CODECS: list(SUPPORTED_CODECS),
+            COMPRESSIONS: list(SUPPORTED_COMPRESSIONS)
         }
         CLIENT_LOGGER.info(f'Сформировано {PRESENCE} сообщение: {out}')
         return out
@@ -110,11 +125,20 @@ class Client:
 
 
 class ClientSender(threading.Thread):
-    def __init__(self, client_name, sock):
+    def __init__(self, client_name, sock, protocol_version=PROTOCOL_VERSION, codec=JSON_CODEC, send_lock=None,
+                 compression=None):
         self.client_name = client_name
         self.sock = sock
+        self.protocol_version = protocol_version
+        self.codec = codec
+        self.compression = compression
+        self.send_lock = send_lock or threading.Lock()
         super().__init__()
 
+    def send(self, message):
+        with self.send_lock:
+            send_message(self.sock, message, self.protocol_version, self.codec, self.compression)
+
     @log
     def create_message(self):
         to_user = input('Введите получателя сообщения: ')
@@ -127,7 +151,20 @@ class ClientSender(threading.Thread):
             MESSAGE_TEXT: message
         }
         CLIENT_LOGGER.debug(f'Сформировано сообщение для отправки: {message_dict}')
-        send_message(self.sock, message_dict)
+        self.send(message_dict)
+        return message_dict
+
+    @log
+    def create_room_message(self, action):
+        room = input('Введите имя комнаты: ')
+        if not room.startswith(ROOM_PREFIX):
+            room = ROOM_PREFIX + room
+        message_dict = {
+            ACTION: action,
+            TIME: time.time(),
+            ROOM: room
+        }
+        self.send(message_dict)
         return message_dict
 
     @log
@@ -142,6 +179,9 @@ class ClientSender(threading.Thread):
     def print_help(self):
         print('Поддерживаемые команды:')
         print('message() - отправить сообщение. Кому отправить сообщение и текст сообщения будет запрошены отдельно.')
+        print(f'           Сообщение в комнату адресуется ее имени, например {ROOM_PREFIX}general.')
+        print('join() - войти в комнату')
+        print('leave() - выйти из комнаты')
         print('help() - вывести подсказки по командам')
         print('exit() - выход из программы')
 
@@ -153,10 +193,14 @@ class ClientSender(threading.Thread):
             command = input('Введите команду: ')
             if command == 'message()':
                 self.create_message()
+            elif command == 'join()':
+                self.create_room_message(JOIN)
+            elif command == 'leave()':
+                self.create_room_message(LEAVE)
             elif command == 'help()':
                 self.print_help()
             elif command == 'exit()':
-                send_message(self.sock, self.create_exit_message())
+                self.send(self.create_exit_message())
                 print('Завершение сеанса.')
                 CLIENT_LOGGER.info('Завершение работы по команде пользователя.')
                 time.sleep(0.5)
@@ -166,27 +210,46 @@ class ClientSender(threading.Thread):
 
 
 class ClientReceiver(threading.Thread):
-    def __init__(self, client_name, sock):
+    def __init__(self, client_name, sock, codec=JSON_CODEC, protocol_version=PROTOCOL_VERSION, send_lock=None):
         self.client_name = client_name
         self.sock = sock
+        self.codec = codec
+        self.protocol_version = protocol_version
+        self.send_lock = send_lock or threading.Lock()
         super().__init__()
 
+    @log
+    def answer_ping(self, message):
+        with self.send_lock:
+            send_message(self.sock, {ACTION: PONG, TIME: message.get(TIME)}, self.protocol_version, self.codec)
+
     @log
     def run(self):
         while True:
             try:
-                message = get_message(self.sock)
-                if ACTION in message and message[ACTION] == MESSAGE and \
+                message = get_message(self.sock, self.codec)
+                if message.get(ACTION) == PING:
+                    self.answer_ping(message)
+                elif ACTION in message and message[ACTION] == MESSAGE and \
                         SENDER in message and DESTINATION in message and \
                         MESSAGE_TEXT in message and message[DESTINATION] == self.client_name:
                     print(f'\nПолучено сообщение от пользователя {message[SENDER]}:'
                           f'\n{message[MESSAGE_TEXT]}')
                     CLIENT_LOGGER.info(f'Получено сообщение от пользователя '
                                        f'{message[SENDER]}: {message[MESSAGE_TEXT]}')
+                elif ACTION in message and message[ACTION] == MESSAGE and \
+                        SENDER in message and DESTINATION in message and \
+                        MESSAGE_TEXT in message and message[DESTINATION].startswith(ROOM_PREFIX):
+                    print(f'\n{message[DESTINATION]} {message[SENDER]}:\n{message[MESSAGE_TEXT]}')
+                    CLIENT_LOGGER.info(f'Получено сообщение в комнате {message[DESTINATION]} '
+                                       f'от пользователя {message[SENDER]}: {message[MESSAGE_TEXT]}')
+                elif STATUS_CODE in message:
+                    print(f'\nОтвет сервера: {message[STATUS_CODE]} {message.get(ERROR, message.get(STATUS))}')
+                    CLIENT_LOGGER.info(f'Получен ответ сервера: {message}')
                 else:
                     CLIENT_LOGGER.error(f'Получено некорректное сообщение с сервера: {message}')
 
-            except (OSError, ConnectionError, ConnectionAbortedError, ConnectionResetError, json.JSONDecodeError):
+            except (OSError, ConnectionError, ConnectionAbortedError, ConnectionResetError, ValueError):
                 CLIENT_LOGGER.critical(f'Потеряно соединение с сервером.')
                 break
 
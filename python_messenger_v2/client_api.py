@@ -0,0 +1,546 @@
+"""Программный клиент мессенджера для ботов и интеграций.
+
+AsyncClient работает в цикле asyncio: send ставит сообщение в очередь и сразу
+возвращает управление, накопившиеся сообщения уходят на сервер одной записью,
+входящие сообщения читаются асинхронным итератором, при обрыве соединение
+восстанавливается с нарастающей паузой. SyncClient - обертка для обычного
+кода, запускающая AsyncClient в отдельном потоке.
+
+    async with AsyncClient('bot') as client:
+        client.send('test1', 'Привет')
+        async for message in client:
+            print(message[SENDER], message[MESSAGE_TEXT])
+
+Сообщения нумеруются в пределах сеанса клиента. Получатель накопительно
+подтверждает полученное, send возвращает номер сообщения, а delivered
+проверяет, подтверждено ли оно. Неподтвержденные сообщения отправляются
+заново после переподключения, и повторы уже принятых сервер отбрасывает.
+Повторы отбрасываются, только если клиент вернулся на тот же процесс
+сервера: при запуске с --workers или в кластере узлов (--node-id)
+переподключение к другому процессу может доставить повтор дважды.
+
+После вызова contacts клиент держит список пользователей в сети в online и
+обновляет его по рассылкам сервера, в том числе после переподключения.
+
+Запросы (join, leave, history, contacts) получают номер REQUEST_ID, и ответ
+сопоставляется запросу по номеру, который сервер возвращает в ответе. Ответы
+без номера - на повторный вход в комнаты после переподключения или ошибки
+обработки отправленных сообщений - к запросам не относятся: ошибки пишутся
+в журнал. Запросы, ответ на которые не пришел до обрыва, после
+переподключения отправляются заново.
+"""
+
+import asyncio
+import logging
+import random
+import secrets
+import threading
+import time
+from collections import deque
+from common.variables import DEFAULT_IP_ADDRESS, DEFAULT_PORT, ACTION, TIME, USER, ACCOUNT_NAME, PRESENCE, \
+    STATUS_CODE, ERROR, MESSAGE, MESSAGE_TEXT, SENDER, DESTINATION, EXIT, VERSION, CODEC, CODECS, PING, PONG, \
+    COMPRESSION, COMPRESSIONS, JOIN, LEAVE, ROOM, HISTORY, LIMIT, BEFORE, HISTORY_PAGE_SIZE, PROTOCOL_VERSION, \
+    LEGACY_PROTOCOL_VERSION, RECV_BUFFER_SIZE, CONTACTS, SUBSCRIBE, REVISION, USERS, JOINED, LEFT, MESSAGE_ID, \
+    ACK, SESSION, ACK_BATCH, ACK_INTERVAL, MAX_UNACKED, ROOM_PREFIX, REQUEST_ID
+from common.utils import MessageDecoder, encode_message
+from common.message_codecs import CODECS as SUPPORTED_CODECS, JSON_CODEC, get_codec
+from common.compression import COMPRESSIONS as SUPPORTED_COMPRESSIONS, get_compression
+
+CLIENT_LOGGER = logging.getLogger('client')
+
+# Предел сообщений, ожидающих отправки, и границы паузы между попытками переподключения, с
+MAX_PENDING = 100000
+RECONNECT_DELAY = 0.1
+RECONNECT_MAX_DELAY = 10
+
+
+class AsyncClient:
+    """Клиент на asyncio с конвейерной отправкой и автоматическим переподключением."""
+
+    def __init__(self, name, host=DEFAULT_IP_ADDRESS, port=DEFAULT_PORT, codecs=None, compressions=None,
+                 reconnect=True, max_pending=MAX_PENDING, reconnect_delay=RECONNECT_DELAY,
+                 reconnect_max_delay=RECONNECT_MAX_DELAY, max_unacked=MAX_UNACKED, ack_batch=ACK_BATCH,
+                 ack_interval=ACK_INTERVAL):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.codecs = list(SUPPORTED_CODECS) if codecs is None else codecs
+        self.compressions = list(SUPPORTED_COMPRESSIONS) if compressions is None else compressions
+        self.reconnect = reconnect
+        self.max_pending = max_pending
+        self.reconnect_delay = reconnect_delay
+        self.reconnect_max_delay = reconnect_max_delay
+        self.max_unacked = max_unacked
+        self.ack_batch = ack_batch
+        self.ack_interval = ack_interval
+
+        self.protocol_version = LEGACY_PROTOCOL_VERSION
+        self.codec = JSON_CODEC
+        self.compression = None
+        self.reader = self.writer = None
+        # Сообщения, ожидающие отправки; кодируются в момент записи, потому что
+        # после переподключения сервер может выбрать другой кодек
+        self.outgoing = deque()
+        self.incoming = asyncio.Queue()
+        # Запросы, ожидающие ответа: {номер запроса: (запрос, future)}
+        self.requests = dict()
+        self.next_request = 1
+        self.rooms = set()
+        # Пользователи в сети на версию contacts_revision (None - снимок еще не получен)
+        self.online = set()
+        self.contacts_revision = None
+        self.contacts_subscribed = False
+        # Сеанс и номер следующего сообщения: по ним сервер узнает повторы после переподключения
+        self.session = secrets.token_hex(8)
+        self.next_id = 1
+        # Отправленные сообщения, которые получатель еще не подтвердил: {получатель: deque},
+        # и номер последнего подтвержденного сообщения каждому получателю
+        self.unacked = dict()
+        self.acked = dict()
+        # Номера последних полученных, но еще не подтвержденных сообщений {отправитель: номер},
+        # число таких сообщений и таймер отправки подтверждений
+        self.pending_acks = dict()
+        self.pending_ack_count = 0
+        self.ack_timer = None
+        self.connected = asyncio.Event()
+        self.wakeup = asyncio.Event()
+        self.flushed = asyncio.Event()
+        self.flushed.set()
+        self.closed = False
+        # Выставляется до отправки EXIT, чтобы закрытие соединения сервером не вызвало переподключение
+        self.closing = False
+        self.tasks = []
+        # Число записей в сокет: при конвейерной отправке оно много меньше числа сообщений
+        self.writes = 0
+        self.reconnects = 0
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self.receive()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+    async def connect(self):
+        """Подключается, проходит приветствие и запускает фоновые задачи чтения и записи."""
+        await self._open()
+        loop = asyncio.get_running_loop()
+        self.tasks = [loop.create_task(self._read_loop()), loop.create_task(self._write_loop())]
+
+    async def _open(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            presence = {ACTION: PRESENCE, TIME: time.time(), USER: {ACCOUNT_NAME: self.name},
+                        VERSION: PROTOCOL_VERSION, CODECS: self.codecs, COMPRESSIONS: self.compressions,
+                        SESSION: self.session}
+            # Приветствие отправляется без разметки, чтобы его понял и сервер первой версии
+            self.writer.write(encode_message(presence, LEGACY_PROTOCOL_VERSION))
+            self.decoder = MessageDecoder()
+            response = await self._next_message()
+            if response.get(STATUS_CODE) != 200:
+                raise ConnectionRefusedError(f'Сервер отклонил приветствие: {response.get(ERROR, response)}')
+            self.protocol_version = response.get(VERSION, LEGACY_PROTOCOL_VERSION)
+            self.codec = self.decoder.codec = get_codec(response.get(CODEC))
+            self.compression = get_compression(response.get(COMPRESSION))
+            # Комнаты сервер не помнит между подключениями; ответы без номера запроса клиент пропускает
+            for room in self.rooms:
+                self.writer.write(self._encode({ACTION: JOIN, TIME: time.time(), ROOM: room}))
+            if self.contacts_subscribed:
+                self.contacts_revision = None
+                self.writer.write(self._encode({ACTION: CONTACTS, TIME: time.time()}))
+            self._resend_requests()
+            self._resend_unacked()
+        except BaseException:
+            self.writer.close()
+            raise
+        CLIENT_LOGGER.info(f'Клиент {self.name} подключен к {self.host}:{self.port}')
+        self.connected.set()
+        self.wakeup.set()
+
+    def _resend_requests(self):
+        """Повторяет запросы, ушедшие в оборвавшееся соединение: ответы на них уже не придут."""
+        queued = {message.get(REQUEST_ID) for message in self.outgoing}
+        for request_id, (message, future) in self.requests.items():
+            if request_id not in queued and not future.done():
+                self.writer.write(self._encode(message))
+
+    def _resend_unacked(self):
+        """Ставит в начало очереди сообщения, ушедшие в оборвавшееся соединение и не подтвержденные."""
+        # Сообщения из очереди отправки еще не записывались; записанные раньше них имеют меньшие номера
+        queued = min((message[MESSAGE_ID] for message in self.outgoing
+                      if message.get(ACTION) == MESSAGE and MESSAGE_ID in message), default=self.next_id)
+        resend = sorted((message for messages in self.unacked.values() for message in messages
+                         if message[MESSAGE_ID] < queued), key=lambda message: message[MESSAGE_ID])
+        self.outgoing.extendleft(reversed(resend))
+
+    def _encode(self, message):
+        return encode_message(message, self.protocol_version, self.codec, self.compression)
+
+    async def _next_message(self):
+        while True:
+            message = self.decoder.next_message()
+            if message is not None:
+                return message
+            data = await self.reader.read(RECV_BUFFER_SIZE)
+            if not data:
+                raise ConnectionResetError('Сервер закрыл соединение')
+            self.decoder.append(data)
+
+    async def _read_loop(self):
+        while not self.closed:
+            try:
+                message = await self._next_message()
+            except (OSError, ValueError) as err:
+                if self.closing:
+                    return
+                await self._reconnect(err)
+                continue
+            action = message.get(ACTION)
+            if action == PING:
+                self.outgoing.appendleft({ACTION: PONG, TIME: message.get(TIME)})
+                self.wakeup.set()
+            elif action == MESSAGE:
+                self.incoming.put_nowait(message)
+                if MESSAGE_ID in message and message.get(DESTINATION) == self.name:
+                    self._received(message[SENDER], message[MESSAGE_ID])
+            elif action == ACK:
+                self._acknowledged(message[SENDER], message[MESSAGE_ID])
+            elif action == CONTACTS:
+                self._update_contacts(message)
+            elif action != PONG:
+                if REVISION in message and USERS in message:
+                    self.online = set(message[USERS])
+                    self.contacts_revision = message[REVISION]
+                self._respond(message)
+
+    def _respond(self, message):
+        request = self.requests.get(message.get(REQUEST_ID))
+        if request is not None:
+            if not request[1].done():
+                request[1].set_result(message)
+        elif message.get(STATUS_CODE, 200) >= 400:
+            CLIENT_LOGGER.warning(f'Ошибка сервера: {message.get(ERROR, message)}')
+
+    def _received(self, sender, message_id):
+        # Подтверждение накопительное: номер последнего сообщения подтверждает и все предыдущие
+        self.pending_acks[sender] = message_id
+        self.pending_ack_count += 1
+        if self.pending_ack_count >= self.ack_batch:
+            self._send_acks()
+        elif self.ack_timer is None:
+            self.ack_timer = asyncio.get_running_loop().call_later(self.ack_interval, self._send_acks)
+
+    def _send_acks(self):
+        if self.ack_timer is not None:
+            self.ack_timer.cancel()
+            self.ack_timer = None
+        for sender, message_id in self.pending_acks.items():
+            self.outgoing.append({ACTION: ACK, SENDER: self.name, DESTINATION: sender, MESSAGE_ID: message_id})
+        if self.pending_acks:
+            self.pending_acks.clear()
+            self.pending_ack_count = 0
+            self.wakeup.set()
+
+    def _acknowledged(self, receiver, message_id):
+        if message_id > self.acked.get(receiver, 0):
+            self.acked[receiver] = message_id
+        messages = self.unacked.get(receiver)
+        if messages is None:
+            return
+        while messages and messages[0][MESSAGE_ID] <= message_id:
+            messages.popleft()
+        if not messages:
+            del self.unacked[receiver]
+
+    def _update_contacts(self, update):
+        revision = update[REVISION]
+        if self.contacts_revision is None or revision <= self.contacts_revision:
+            # Снимок еще не пришел или уже учитывает это изменение
+            return
+        if revision != self.contacts_revision + 1:
+            # Пропущенное изменение не восстановить: список запрашивается заново
+            CLIENT_LOGGER.warning(f'Пропущены изменения списка пользователей в сети до версии {revision}')
+            self.contacts_revision = None
+            self.outgoing.append({ACTION: CONTACTS, TIME: time.time()})
+            self.wakeup.set()
+            return
+        self.online.difference_update(update[LEFT])
+        self.online.update(update[JOINED])
+        self.contacts_revision = revision
+
+    async def _reconnect(self, err):
+        self.connected.clear()
+        self.writer.close()
+        if not self.reconnect:
+            CLIENT_LOGGER.error(f'Потеряно соединение с сервером: {err}')
+            self.closed = True
+            self.incoming.put_nowait(None)
+            return
+        delay = self.reconnect_delay
+        while not self.closing:
+            CLIENT_LOGGER.warning(f'Потеряно соединение с сервером ({err}), повтор через {delay:.1f} с')
+            # Случайная добавка к паузе, чтобы клиенты не переподключались одновременно
+            await asyncio.sleep(delay * random.uniform(1, 1.5))
+            try:
+                await self._open()
+            except (OSError, ValueError) as open_err:
+                err = open_err
+                delay = min(delay * 2, self.reconnect_max_delay)
+                continue
+            self.reconnects += 1
+            return
+
+    async def _write_loop(self):
+        while not self.closed:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            await self.connected.wait()
+            outgoing = self.outgoing
+            if not outgoing:
+                self.flushed.set()
+                continue
+            # Все накопленные сообщения уходят одной записью
+            frames = []
+            while outgoing:
+                frames.append(self._encode(outgoing.popleft()))
+            writer = self.writer
+            writer.write(b''.join(frames))
+            self.writes += 1
+            try:
+                await writer.drain()
+            except OSError:
+                # Сообщения, уже переданные оборвавшемуся соединению, теряются; чтение переподключится
+                pass
+            self.wakeup.set()
+
+    def send(self, to, text):
+        """Ставит сообщение пользователю или комнате в очередь отправки, не дожидаясь записи.
+
+        Возвращает номер сообщения; пока получатель его не подтвердил, сообщение
+        хранится и отправляется заново после переподключения. Сообщения в
+        комнату не подтверждаются.
+        """
+        message = {
+            ACTION: MESSAGE,
+            TIME: time.time(),
+            SENDER: self.name,
+            DESTINATION: to,
+            MESSAGE_TEXT: text,
+            MESSAGE_ID: self.next_id,
+        }
+        self.send_message(message)
+        self.next_id += 1
+        if not to.startswith(ROOM_PREFIX):
+            messages = self.unacked.get(to)
+            if messages is None:
+                # Самые старые неподтвержденные сообщения вытесняются и заново не отправляются
+                messages = self.unacked[to] = deque(maxlen=self.max_unacked)
+            messages.append(message)
+        return message[MESSAGE_ID]
+
+    def delivered(self, to, message_id):
+        """Подтвердил ли пользователь to получение сообщения с номером message_id."""
+        return self.acked.get(to, 0) >= message_id
+
+    def send_message(self, message):
+        if self.closed:
+            raise ConnectionError('Клиент закрыт')
+        if len(self.outgoing) >= self.max_pending:
+            raise BufferError('Очередь отправки переполнена')
+        self.outgoing.append(message)
+        self.flushed.clear()
+        self.wakeup.set()
+
+    async def flush(self):
+        """Ждет, пока все поставленные в очередь сообщения будут переданы в сокет."""
+        while self.outgoing or not self.flushed.is_set():
+            self.wakeup.set()
+            await self.flushed.wait()
+
+    async def receive(self):
+        """Следующее входящее сообщение или None, если клиент закрыт."""
+        if self.closed and self.incoming.empty():
+            return None
+        return await self.incoming.get()
+
+    async def request(self, message):
+        """Отправляет запрос и ждет ответа на него."""
+        request_id = message[REQUEST_ID] = self.next_request
+        self.next_request += 1
+        future = asyncio.get_running_loop().create_future()
+        self.requests[request_id] = message, future
+        try:
+            self.send_message(message)
+            return await future
+        finally:
+            del self.requests[request_id]
+
+    async def join(self, room):
+        response = await self.request({ACTION: JOIN, TIME: time.time(), ROOM: room})
+        if response.get(STATUS_CODE) == 200:
+            self.rooms.add(room)
+        return response
+
+    async def leave(self, room):
+        self.rooms.discard(room)
+        return await self.request({ACTION: LEAVE, TIME: time.time(), ROOM: room})
+
+    async def history(self, peer, limit=HISTORY_PAGE_SIZE, before=None):
+        """Страница переписки с пользователем или комнатой peer от новых сообщений к старым.
+
+        В ответе сервера MESSAGES - сообщения, BEFORE - курсор следующей страницы
+        (передается в before) или None, если страница последняя.
+        """
+        request = {ACTION: HISTORY, TIME: time.time(), DESTINATION: peer, LIMIT: limit}
+        if before is not None:
+            request[BEFORE] = before
+        return await self.request(request)
+
+    async def contacts(self, subscribe=True):
+        """Запрашивает список пользователей в сети и подписывается на его изменения (или отписывается).
+
+        Ответ сервера содержит USERS и версию REVISION; дальше список в online
+        обновляется рассылками сервера, пока включена подписка.
+        """
+        self.contacts_subscribed = subscribe
+        return await self.request({ACTION: CONTACTS, TIME: time.time(), SUBSCRIBE: subscribe})
+
+    async def close(self):
+        if self.closing:
+            return
+        self.closing = True
+        if self.connected.is_set():
+            self._send_acks()
+            self.send_message({ACTION: EXIT, TIME: time.time(), ACCOUNT_NAME: self.name})
+            try:
+                await asyncio.wait_for(self.flush(), 5)
+            except asyncio.TimeoutError:
+                pass
+        self.closed = True
+        if self.ack_timer is not None:
+            self.ack_timer.cancel()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        if self.writer is not None:
+            self.writer.close()
+        self.incoming.put_nowait(None)
+
+
+class SyncClient:
+    """Потокобезопасная обертка над AsyncClient для кода без asyncio.
+
+    Клиент работает в собственном цикле событий в фоновом потоке. send
+    складывает сообщения в общую очередь и будит цикл только тогда, когда
+    очередь была пуста, поэтому частые вызовы из разных потоков дешевы.
+    Если AsyncClient не принял сообщения (переполнена очередь отправки или
+    клиент закрыт), непереданный остаток возвращается в очередь, а ошибку
+    получает следующий вызов flush.
+    """
+
+    def __init__(self, name, **options):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name=f'client-{name}', daemon=True)
+        self.thread.start()
+        self.client = self._call(self._create(name, options))
+        self.outbox = deque()
+        self.outbox_lock = threading.Lock()
+        self.scheduled = False
+        # Ошибка последней передачи сообщений из outbox в AsyncClient
+        self.send_error = None
+
+    @staticmethod
+    async def _create(name, options):
+        # Очереди и события asyncio создаются внутри цикла клиента
+        return AsyncClient(name, **options)
+
+    def _call(self, coro, timeout=None):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self):
+        while True:
+            message = self.receive()
+            if message is None:
+                return
+            yield message
+
+    def connect(self, timeout=None):
+        self._call(self.client.connect(), timeout)
+
+    def send(self, to, text):
+        with self.outbox_lock:
+            self.outbox.append((to, text))
+            if self.scheduled:
+                return
+            self.scheduled = True
+        self.loop.call_soon_threadsafe(self._drain_outbox)
+
+    def _drain_outbox(self):
+        with self.outbox_lock:
+            batch, self.outbox = self.outbox, deque()
+            self.scheduled = False
+        try:
+            while batch:
+                to, text = batch[0]
+                self.client.send(to, text)
+                batch.popleft()
+        except (BufferError, ConnectionError) as err:
+            with self.outbox_lock:
+                batch.extend(self.outbox)
+                self.outbox = batch
+            self.send_error = err
+        else:
+            self.send_error = None
+
+    def flush(self, timeout=None):
+        """Ждет записи всех сообщений в сокет; передает ошибку, если часть сообщений не принята."""
+        self._call(self._flush(), timeout)
+
+    async def _flush(self):
+        self._drain_outbox()
+        if self.send_error is not None:
+            raise self.send_error
+        await self.client.flush()
+
+    def receive(self, timeout=None):
+        return self._call(self.client.receive(), timeout)
+
+    def join(self, room, timeout=None):
+        return self._call(self.client.join(room), timeout)
+
+    def leave(self, room, timeout=None):
+        return self._call(self.client.leave(room), timeout)
+
+    def history(self, peer, limit=HISTORY_PAGE_SIZE, before=None, timeout=None):
+        return self._call(self.client.history(peer, limit, before), timeout)
+
+    def contacts(self, subscribe=True, timeout=None):
+        return self._call(self.client.contacts(subscribe), timeout)
+
+    def close(self, timeout=None):
+        try:
+            self._call(self._close(), timeout)
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+
+    async def _close(self):
+        self._drain_outbox()
+        await self.client.close()
@@ -0,0 +1,164 @@
+import json
+import struct
+from common.variables import ENCODING, ACTION, TIME, SENDER, DESTINATION, MESSAGE_TEXT, MESSAGE, MESSAGE_ID
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class JsonCodec:
+    name = 'json'
+
+    def encode(self, message):
+        return json.dumps(message).encode(ENCODING)
+
+    def decode(self, payload):
+        return json.loads(str(payload, ENCODING))
+
+    def peek_route(self, payload):
+        # Адресат в JSON не извлечь без полного разбора
+        return None
+
+
+class StructCodec:
+    """Двоичный формат с фиксированной раскладкой полей сообщения пользователю.
+
+    Сообщение с полями ACTION, TIME, SENDER, DESTINATION и MESSAGE_TEXT
+    упаковывается как заголовок (вид, длины отправителя, получателя и текста,
+    время) и следующие за ним строки UTF-8; сообщение с номером MESSAGE_ID -
+    заголовком другого вида, в конце которого номер. Остальные словари
+    передаются как JSON с однобайтовым признаком вида.
+    """
+    name = 'struct'
+
+    KIND_JSON = 0
+    KIND_MESSAGE = 1
+    KIND_MESSAGE_ID = 2
+    HEADER = struct.Struct('!BHHId')
+    HEADER_ID = struct.Struct('!BHHIdQ')
+    FIELDS = frozenset((ACTION, TIME, SENDER, DESTINATION, MESSAGE_TEXT))
+    FIELDS_ID = FIELDS | {MESSAGE_ID}
+    MAX_ID = 0xFFFFFFFFFFFFFFFF
+
+    def encode(self, message):
+        keys = message.keys()
+        if (keys == self.FIELDS or keys == self.FIELDS_ID) and message[ACTION] == MESSAGE:
+            time, sender, destination, text = \
+                message[TIME], message[SENDER], message[DESTINATION], message[MESSAGE_TEXT]
+            message_id = message.get(MESSAGE_ID)
+            if isinstance(time, (int, float)) and not isinstance(time, bool) and \
+                    isinstance(sender, str) and isinstance(destination, str) and isinstance(text, str) and \
+                    (message_id is None or type(message_id) is int and 0 <= message_id <= self.MAX_ID):
+                sender = sender.encode(ENCODING)
+                destination = destination.encode(ENCODING)
+                text = text.encode(ENCODING)
+                if len(sender) <= 0xFFFF and len(destination) <= 0xFFFF:
+                    if message_id is None:
+                        header = self.HEADER.pack(self.KIND_MESSAGE, len(sender), len(destination), len(text), time)
+                    else:
+                        header = self.HEADER_ID.pack(self.KIND_MESSAGE_ID, len(sender), len(destination),
+                                                     len(text), time, message_id)
+                    return b''.join((header, sender, destination, text))
+        return bytes((self.KIND_JSON,)) + json.dumps(message).encode(ENCODING)
+
+    def _unpack(self, payload):
+        """Заголовок, поля заголовка и границы строк отправителя и получателя; ValueError, если раскладка неверна."""
+        kind = payload[0]
+        header = self.HEADER if kind == self.KIND_MESSAGE else self.HEADER_ID
+        try:
+            fields = header.unpack_from(payload)
+        except struct.error as err:
+            raise ValueError(f'Некорректный заголовок двоичного сообщения: {err}')
+        sender_end = header.size + fields[1]
+        destination_end = sender_end + fields[2]
+        if destination_end + fields[3] != len(payload):
+            raise ValueError('Длина двоичного сообщения не совпадает с заголовком')
+        return header, fields, sender_end, destination_end
+
+    def peek_route(self, payload):
+        """Отправитель, получатель и номер (или None) сообщения пользователю без разбора текста, иначе None."""
+        if not payload or payload[0] not in (self.KIND_MESSAGE, self.KIND_MESSAGE_ID):
+            return None
+        try:
+            header, fields, sender_end, destination_end = self._unpack(payload)
+            return (str(payload[header.size:sender_end], ENCODING),
+                    str(payload[sender_end:destination_end], ENCODING),
+                    fields[5] if header is self.HEADER_ID else None)
+        except (ValueError, UnicodeDecodeError):
+            return None
+
+    def decode(self, payload):
+        kind = payload[0]
+        if kind == self.KIND_JSON:
+            return json.loads(str(payload[1:], ENCODING))
+        if kind not in (self.KIND_MESSAGE, self.KIND_MESSAGE_ID):
+            raise ValueError(f'Неизвестный вид двоичного сообщения: {kind}')
+        header, fields, sender_end, destination_end = self._unpack(payload)
+        message = {
+            ACTION: MESSAGE,
+            TIME: fields[4],
+            SENDER: str(payload[header.size:sender_end], ENCODING),
+            DESTINATION: str(payload[sender_end:destination_end], ENCODING),
+            MESSAGE_TEXT: str(payload[destination_end:], ENCODING),
+        }
+        if header is self.HEADER_ID:
+            message[MESSAGE_ID] = fields[5]
+        return message
+
+
+class MsgpackCodec:
+    name = 'msgpack'
+
+    def encode(self, message):
+        return msgpack.packb(message)
+
+    def decode(self, payload):
+        return msgpack.unpackb(payload, raw=False)
+
+    def peek_route(self, payload):
+        """Читает ключи словаря, пропуская значения, кроме действия, отправителя, получателя и номера."""
+        unpacker = msgpack.Unpacker(raw=False)
+        unpacker.feed(payload)
+        fields = dict()
+        keys = set()
+        try:
+            for _ in range(unpacker.read_map_header()):
+                key = unpacker.unpack()
+                keys.add(key)
+                if key in (ACTION, SENDER, DESTINATION, MESSAGE_ID):
+                    fields[key] = unpacker.unpack()
+                else:
+                    unpacker.skip()
+        except (ValueError, msgpack.OutOfData):
+            return None
+        message_id = fields.get(MESSAGE_ID)
+        if keys != StructCodec.FIELDS and keys != StructCodec.FIELDS_ID or fields[ACTION] != MESSAGE or \
+                not isinstance(fields[SENDER], str) or not isinstance(fields[DESTINATION], str) or \
+                message_id is not None and type(message_id) is not int:
+            return None
+        return fields[SENDER], fields[DESTINATION], message_id
+
+
+JSON_CODEC = JsonCodec()
+
+# Доступные кодеки в порядке предпочтения сервера
+CODECS = dict()
+if msgpack is not None:
+    CODECS[MsgpackCodec.name] = MsgpackCodec()
+CODECS[StructCodec.name] = StructCodec()
+CODECS[JsonCodec.name] = JSON_CODEC
+
+
+def get_codec(name):
+    return CODECS.get(name, JSON_CODEC)
+
+
+def negotiate_codec(offered):
+    """Выбирает первый по предпочтению сервера кодек из предложенных клиентом."""
+    if isinstance(offered, list):
+        for name, codec in CODECS.items():
+            if name in offered:
+                return codec
+    return JSON_CODEC
@@ -1,22 +1,296 @@
 import json
-from common.variables import ENCODING, MAX_MESSAGE_LENGTH
+import struct
+import weakref
+from common.variables import ENCODING, MAX_MESSAGE_LENGTH, RECV_BUFFER_SIZE, RECV_BUFFER_MIN, \
+    LEGACY_PROTOCOL_VERSION, PROTOCOL_VERSION
+from common.message_codecs import JSON_CODEC
+from common.compression import COMPRESSION_IDS, compression_by_id, compress_payload
 from decors import log
 
+# Заголовок кадра: 4 байта в сетевом порядке, старший байт - номер алгоритма
+# сжатия (0 - без сжатия), остальные три - длина полезной нагрузки. Номера
+# алгоритмов малы, поэтому первый байт кадра не совпадает с '{' или пробельным
+# символом, с которых всегда начинается сообщение старого клиента.
+FRAME_HEADER = struct.Struct('!I')
+MAX_FRAME_LENGTH = 0xFFFFFF
+FRAME_KINDS = frozenset((0, *COMPRESSION_IDS))
 
-@log
-def get_message(client):
-    encoded_response = client.recv(MAX_MESSAGE_LENGTH)
-    if isinstance(encoded_response, bytes):
-        json_response = encoded_response.decode(ENCODING)
-        response = json.loads(json_response)
-        if isinstance(response, dict):
-            return response
-        raise ValueError
+_WHITESPACE = b' \t\r\n'
+
+# Разборщики для сокетов, читаемых через get_message
+_DECODERS = weakref.WeakKeyDictionary()
+
+
+class MessageDecoder:
+    """Потоковый разборщик входящих данных одного соединения.
+
+    Накапливает частично принятые данные и отдает сообщения, которые удалось
+    собрать целиком. Понимает как кадры с заголовком длины, так и JSON без
+    разметки от клиентов первой версии протокола. Кадры разбираются по одному
+    в момент выдачи, поэтому кодек можно сменить между двумя сообщениями,
+    например сразу после ответа на приветствие.
+
+    Данные хранятся в собственном буфере соединения: recv_into читает сокет
+    прямо в его свободную часть, а кадры отдаются как memoryview без
+    копирования. Кадр действителен до следующего чтения в разборщик; тот, кто
+    хранит кадр дольше (очередь другого соединения, рассылка), копирует его.
+    Буфер растет под длинный кадр не больше чем до max_length и возвращается
+    к обычному размеру, когда кадр разобран, а shrink освобождает его у
+    молчащего соединения. Порция, переданная в append, разбирается на месте,
+    в буфер копируется только незавершенный остаток.
+    """
+
+    def __init__(self, max_length=MAX_MESSAGE_LENGTH, codec=JSON_CODEC):
+        if max_length > MAX_FRAME_LENGTH:
+            raise ValueError(f'Максимальная длина кадра: {MAX_FRAME_LENGTH} байт')
+        self.max_length = max_length
+        self.codec = codec
+        # Приемный буфер: [_start:_end) - принятые, но не разобранные данные, дальше - свободное место
+        self._buffer = bytearray()
+        self._start = 0
+        self._end = 0
+        # Размер буфера, к которому он возвращается после длинного кадра; растет, пока чтения заполняют буфер
+        self._capacity = RECV_BUFFER_MIN
+        # Последняя порция из append и позиция первого неразобранного байта в ней
+        self._chunk = None
+        self._position = 0
+        self._json_decoder = json.JSONDecoder()
+
+    @property
+    def buffer(self):
+        """Копия принятых, но еще не разобранных данных."""
+        self._spill()
+        return self._buffer[self._start:self._end]
+
+    def recv_into(self, sock):
+        """Читает из сокета в свободную часть буфера; возвращает число принятых байт."""
+        self._spill()
+        self._reserve(self._wanted())
+        free = len(self._buffer) - self._end
+        received = sock.recv_into(memoryview(self._buffer)[self._end:])
+        self._end += received
+        if received == free and self._capacity < RECV_BUFFER_SIZE:
+            self._capacity = min(self._capacity * 2, RECV_BUFFER_SIZE)
+        return received
+
+    def append(self, data):
+        if self._chunk is None and self._start == self._end:
+            self._chunk = memoryview(data)
+            self._position = 0
+        else:
+            self._spill()
+            self._write(data)
+
+    def shrink(self):
+        """Освобождает буфер молчащего соединения, оставляя только неразобранный остаток."""
+        self._spill()
+        self._buffer = self._buffer[self._start:self._end]
+        self._start, self._end = 0, len(self._buffer)
+        self._capacity = RECV_BUFFER_MIN
+
+    def feed(self, data):
+        """Добавляет принятые данные и возвращает итератор по готовым сообщениям."""
+        self.append(data)
+        return self.messages()
+
+    def messages(self):
+        while True:
+            message = self.next_message()
+            if message is None:
+                return
+            yield message
+
+    def frames(self):
+        """Итератор по парам (кадр, сообщение).
+
+        Для кадров протокола 2 сообщение равно None и разбирается вызовом
+        decode_frame только при необходимости; JSON клиентов первой версии
+        отдается уже разобранным, без кадра.
+        """
+        while True:
+            frame = self.next_frame()
+            if frame is not None:
+                yield frame, None
+                continue
+            if self._start == self._end or self._buffer[self._start] in FRAME_KINDS:
+                return
+            message = self._next_legacy_message()
+            if message is None:
+                return
+            yield None, message
+
+    def decode_frame(self, frame):
+        return _check_message(self.codec.decode(frame_payload(frame, self.max_length)))
+
+    def next_message(self):
+        frame = self.next_frame()
+        if frame is not None:
+            return self.decode_frame(frame)
+        if self._start < self._end and self._buffer[self._start] not in FRAME_KINDS:
+            return self._next_legacy_message()
+        return None
+
+    def next_frame(self):
+        chunk = self._chunk
+        if chunk is not None:
+            position = self._position
+            end = self._frame_end(chunk, position, len(chunk))
+            if end is not None:
+                if end == len(chunk):
+                    self._chunk = None
+                else:
+                    self._position = end
+                return chunk[position:end]
+            self._spill()
+        start = self._start
+        end = self._frame_end(self._buffer, start, self._end)
+        if end is None:
+            return None
+        self._start = end
+        return memoryview(self._buffer)[start:end]
+
+    def _frame_end(self, data, position, limit):
+        """Конец кадра, начинающегося с position, если он принят целиком до limit."""
+        if limit - position < FRAME_HEADER.size or data[position] not in FRAME_KINDS:
+            return None
+        length = FRAME_HEADER.unpack_from(data, position)[0] & MAX_FRAME_LENGTH
+        if length > self.max_length:
+            raise ValueError(f'Длина кадра {length} превышает допустимую')
+        end = position + FRAME_HEADER.size + length
+        return end if end <= limit else None
+
+    def _wanted(self):
+        # Недостающая часть кадра, заголовок которого уже принят, читается одним вызовом
+        pending = self._end - self._start
+        if pending >= FRAME_HEADER.size and self._buffer[self._start] in FRAME_KINDS:
+            length = FRAME_HEADER.unpack_from(self._buffer, self._start)[0] & MAX_FRAME_LENGTH
+            return max(min(length, self.max_length) + FRAME_HEADER.size - pending, RECV_BUFFER_MIN)
+        return RECV_BUFFER_MIN
+
+    def _reserve(self, size):
+        """Готовит не меньше size байт свободного места за концом данных.
+
+        Буфер не изменяет размер на месте: выданные раньше memoryview не дают
+        этого сделать, поэтому больший или меньший буфер создается заново.
+        """
+        buffer = self._buffer
+        pending = self._end - self._start
+        if not pending:
+            self._start = self._end = 0
+            if len(buffer) > self._capacity:
+                # Длинный кадр разобран, буфер возвращается к обычному размеру
+                buffer = self._buffer = bytearray(self._capacity)
+        if len(buffer) - self._end >= size:
+            return
+        if pending + size <= len(buffer):
+            buffer[:pending] = buffer[self._start:self._end]
+        else:
+            limit = self.max_length + FRAME_HEADER.size + RECV_BUFFER_SIZE
+            capacity = max(pending + size, self._capacity, min(2 * len(buffer), limit))
+            self._buffer = bytearray(capacity)
+            self._buffer[:pending] = buffer[self._start:self._end]
+        self._start, self._end = 0, pending
+
+    def _write(self, data):
+        self._reserve(len(data))
+        end = self._end + len(data)
+        self._buffer[self._end:end] = data
+        self._end = end
+
+    def _spill(self):
+        # Неразобранный остаток порции переносится в буфер
+        if self._chunk is not None:
+            chunk = self._chunk[self._position:]
+            self._chunk = None
+            self._write(chunk)
+
+    def _next_legacy_message(self):
+        buffer = self._buffer
+        start, end = self._start, self._end
+        while start < end and buffer[start] in _WHITESPACE:
+            start += 1
+        self._start = start
+        if start == end:
+            return None
+        if buffer[start] != ord('{'):
+            raise ValueError('Некорректное начало сообщения')
+        data = memoryview(buffer)[start:end]
+        try:
+            text = str(data, ENCODING)
+        except UnicodeDecodeError as err:
+            if err.reason != 'unexpected end of data':
+                raise
+            text = str(data[:err.start], ENCODING)
+        try:
+            message, position = self._json_decoder.raw_decode(text)
+        except json.JSONDecodeError as err:
+            if not _is_truncated(err, text) or end - start > self.max_length:
+                raise
+            return None
+        self._start = start + len(text[:position].encode(ENCODING))
+        return _check_message(message)
+
+
+def _is_truncated(err, text):
+    # Ошибка в конце текста означает, что объект еще не принят целиком
+    if err.msg.startswith('Unterminated string'):
+        return True
+    if err.msg.startswith('Invalid \\uXXXX escape'):
+        return err.pos + 6 > len(text)
+    return err.pos >= len(text)
+
+
+def _check_message(message):
+    if isinstance(message, dict):
+        return message
     raise ValueError
 
 
+def negotiate_protocol_version(offered):
+    if not isinstance(offered, int) or offered < LEGACY_PROTOCOL_VERSION:
+        return LEGACY_PROTOCOL_VERSION
+    return min(offered, PROTOCOL_VERSION)
+
+
+def frame_payload(frame, max_length=MAX_MESSAGE_LENGTH):
+    """Полезная нагрузка кадра, распакованная, если кадр сжат."""
+    payload = frame[FRAME_HEADER.size:]
+    if frame[0]:
+        payload = compression_by_id(frame[0]).decompress(payload, max_length)
+    return payload
+
+
+def make_frame(payload, compression_id=0):
+    if len(payload) > MAX_FRAME_LENGTH:
+        raise ValueError(f'Длина сообщения {len(payload)} превышает допустимую')
+    return FRAME_HEADER.pack(compression_id << 24 | len(payload)) + payload
+
+
+def encode_message(message, version=PROTOCOL_VERSION, codec=JSON_CODEC, compression=None):
+    if version == LEGACY_PROTOCOL_VERSION:
+        return JSON_CODEC.encode(message)
+    compression_id, payload = compress_payload(codec.encode(message), compression)
+    return make_frame(payload, compression_id)
+
+
+@log
+def get_message(client, codec=JSON_CODEC):
+    decoder = _DECODERS.get(client)
+    if decoder is None:
+        decoder = _DECODERS[client] = MessageDecoder()
+    decoder.codec = codec
+    message = decoder.next_message()
+    while message is None:
+        data = client.recv(RECV_BUFFER_SIZE)
+        if not isinstance(data, bytes):
+            raise ValueError
+        if not data:
+            raise ConnectionResetError('Соединение закрыто удаленной стороной')
+        decoder.append(data)
+        message = decoder.next_message()
+    return message
+
+
 @log
-def send_message(sock, message):
-    json_message = json.dumps(message)
-    encoded_message = json_message.encode(ENCODING)
-    sock.send(encoded_message)
+def send_message(sock, message, version=PROTOCOL_VERSION, codec=JSON_CODEC, compression=None):
+    sock.sendall(encode_message(message, version, codec, compression))
@@ -1,18 +1,159 @@
 DEFAULT_IP_ADDRESS = '127.0.0.1'
 DEFAULT_PORT = 7777
-MAX_MESSAGE_LENGTH = 1024
+MAX_MESSAGE_LENGTH = 4 * 1024 * 1024
+RECV_BUFFER_SIZE = 64 * 1024
+# Начальный и минимальный размер приемного буфера соединения
+RECV_BUFFER_MIN = 4 * 1024
 MAX_CONNECTIONS = 5
+LISTEN_BACKLOG = 1024
 ENCODING = 'utf-8'
 
+# Границы исходящей очереди соединения в байтах
+OUTBOUND_QUEUE_LIMIT = 1024 * 1024
+OUTBOUND_HIGH_WATERMARK = 256 * 1024
+OUTBOUND_LOW_WATERMARK = 64 * 1024
+
+# Наибольшее число кадров (не больше IOV_MAX, в Linux 1024) и байт в одном вызове sendmsg
+WRITE_BATCH_FRAMES = 512
+WRITE_BATCH_SIZE = 256 * 1024
+
+# Поведение при переполнении исходящей очереди
+OVERFLOW_DROP_OLDEST = 'drop-oldest'
+OVERFLOW_REJECT = 'reject'
+OVERFLOW_DISCONNECT = 'disconnect'
+OVERFLOW_POLICIES = (OVERFLOW_DROP_OLDEST, OVERFLOW_REJECT, OVERFLOW_DISCONNECT)
+
+# Хранение сообщений для пользователей не в сети: размер сегмента журнала,
+# срок хранения в секундах, задержка групповой записи, пауза перед повтором
+# неудавшейся записи, доля живых записей, ниже которой сегмент сжимается,
+# и период обслуживания журнала в секундах
+OFFLINE_SEGMENT_SIZE = 16 * 1024 * 1024
+OFFLINE_RETENTION = 7 * 24 * 60 * 60
+OFFLINE_COMMIT_INTERVAL = 0.002
+OFFLINE_RETRY_INTERVAL = 1.0
+OFFLINE_COMPACT_RATIO = 0.5
+OFFLINE_MAINTENANCE_INTERVAL = 60
+
+# История сообщений: задержка пакетной записи в базу, размер страницы по умолчанию и наибольший
+HISTORY_COMMIT_INTERVAL = 0.01
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 500
+
+# Число доставок рассылки в комнату за одну итерацию цикла событий
+FANOUT_CHUNK = 256
+
+# Число принятых сообщений одного соединения, обрабатываемых за одну итерацию
+# цикла событий; остаток ждет, пока свою долю получат остальные соединения
+FAIR_QUANTUM = 64
+
+# Поведение при превышении частоты сообщений: приостановить чтение, ответить
+# ошибкой 429 или отключить клиента; период удаления полных корзин маркеров, с
+RATE_LIMIT_DELAY = 'delay'
+RATE_LIMIT_REJECT = 'reject'
+RATE_LIMIT_DISCONNECT = 'disconnect'
+RATE_LIMIT_POLICIES = (RATE_LIMIT_DELAY, RATE_LIMIT_REJECT, RATE_LIMIT_DISCONNECT)
+RATE_LIMIT_PRUNE_INTERVAL = 60
+
+# Проверка живости соединений: ping после PING_INTERVAL секунд тишины, отключение
+# после IDLE_TIMEOUT секунд тишины, отключение не приславших приветствие за
+# HANDSHAKE_TIMEOUT секунд; TIMER_RESOLUTION - шаг колеса таймеров в секундах
+PING_INTERVAL = 30
+IDLE_TIMEOUT = 90
+HANDSHAKE_TIMEOUT = 10
+TIMER_RESOLUTION = 0.25
+
+# Профилирование по запросу: длительность по умолчанию и период выборок стека, секунды
+PROFILE_SECONDS = 30
+PROFILE_SAMPLE_INTERVAL = 0.005
+
+# Кадры короче порога в байтах не сжимаются: по benchmarks/bench_compression сжатие
+# коротких кадров окупается только на каналах медленнее нескольких десятков Мбит/с
+COMPRESSION_THRESHOLD = 512
+
+# Версии протокола: 1 - JSON без разметки (старые клиенты), 2 - кадры с заголовком длины
+LEGACY_PROTOCOL_VERSION = 1
+PROTOCOL_VERSION = 2
+
 ACTION = 'action'
 TIME = 'time'
 USER = 'user'
 ACCOUNT_NAME = 'account_name'
+VERSION = 'version'
+CODEC = 'codec'
+CODECS = 'codecs'
+COMPRESSION = 'compression'
+COMPRESSIONS = 'compressions'
 
 PRESENCE = 'presence'
 MESSAGE = 'message'
 EXIT = 'exit'
 ERROR = 'error'
+PING = 'ping'
+PONG = 'pong'
+
+# Комнаты: вход, выход и имя комнаты; сообщение в комнату адресуется имени с префиксом ROOM_PREFIX
+JOIN = 'join'
+LEAVE = 'leave'
+ROOM = 'room'
+ROOM_PREFIX = '#'
+
+# Запрос истории переписки с пользователем или комнатой DESTINATION: не больше LIMIT
+# сообщений старше курсора BEFORE; в ответе сообщения MESSAGES и курсор следующей страницы
+HISTORY = 'history'
+LIMIT = 'limit'
+BEFORE = 'before'
+MESSAGES = 'messages'
+
+# Список пользователей в сети: запрос снимка USERS версии REVISION с подпиской SUBSCRIBE
+# (по умолчанию включена) и рассылка подписчикам вошедших JOINED и вышедших LEFT;
+# изменения копятся CONTACTS_SYNC_INTERVAL секунд и уходят одной рассылкой
+CONTACTS = 'contacts'
+SUBSCRIBE = 'subscribe'
+REVISION = 'revision'
+JOINED = 'joined'
+LEFT = 'left'
+CONTACTS_SYNC_INTERVAL = 0.5
+
+# Номера сообщений и подтверждения доставки: клиент нумерует свои сообщения MESSAGE_ID
+# по возрастанию в пределах сеанса SESSION (передается в приветствии), получатель
+# отвечает отправителю накопительным ACK с номером последнего полученного сообщения:
+# не чаще чем раз в ACK_BATCH сообщений или ACK_INTERVAL секунд. Сервер помнит
+# последний номер DEDUP_SENDERS отключившихся отправителей и отбрасывает повторы
+# после переподключения; клиент хранит до MAX_UNACKED неподтвержденных сообщений
+# каждому получателю и отправляет их заново после переподключения. Номера отправителей
+# известны только процессу, к которому клиент был подключен, поэтому с --workers и в
+# кластере узлов повтор после переподключения к другому процессу доставляется дважды
+MESSAGE_ID = 'id'
+ACK = 'ack'
+SESSION = 'session'
+ACK_BATCH = 64
+ACK_INTERVAL = 0.05
+DEDUP_SENDERS = 100000
+MAX_UNACKED = 10000
+
+# Номер запроса клиента (JOIN, LEAVE, HISTORY, CONTACTS): сервер возвращает его в ответе,
+# и клиент сопоставляет ответы запросам, не путая их с ответами на сообщения
+REQUEST_ID = 'request'
+
+# Служебные сообщения между рабочими процессами сервера
+PEER_JOIN = 'peer_join'
+PEER_LEAVE = 'peer_leave'
+WORKER = 'worker'
+# Сколько имен, не найденных в общем реестре, рабочий процесс помнит до PEER_JOIN
+UNKNOWN_NAMES_LIMIT = 10000
+
+# Связь между узлами кластера: приветствие узла NODE и ответ с выбранным кодеком, список
+# пользователей USERS ({имя: узел}) от каталога, запрос имени у каталога и ответ с RESULT
+NODE = 'node'
+NODE_HELLO = 'node_hello'
+NODE_WELCOME = 'node_welcome'
+NODE_SYNC = 'node_sync'
+NAME_CLAIM = 'name_claim'
+NAME_CLAIMED = 'name_claimed'
+USERS = 'users'
+RESULT = 'result'
+# Пауза перед повторным подключением к узлу, секунды
+NODE_RECONNECT_INTERVAL = 1
 
 MESSAGE_TEXT = 'message_text'
 SENDER = 'from'
@@ -20,4 +161,3 @@ DESTINATION = 'to'
 RESPONSE = 'response'
 STATUS_CODE = 'status_code'
 STATUS = 'status'
-
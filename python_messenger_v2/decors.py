@@ -1,6 +1,7 @@
+import functools
 import logging
+import os
 import sys
-import inspect
 import logs.configs.server_log_config
 import logs.configs.client_log_config
 
@@ -9,13 +10,25 @@ if sys.argv[0].find('client') == -1:
 else:
     LOGGER = logging.getLogger('client')
 
+# MESSENGER_LOG_CALLS=0 отключает журналирование вызовов еще при импорте:
+# декоратор возвращает функцию без обертки
+LOG_CALLS = os.environ.get('MESSENGER_LOG_CALLS', '1') != '0'
+
 
 def log(func_to_log):
+    if not LOG_CALLS:
+        return func_to_log
+
+    @functools.wraps(func_to_log)
     def log_saver(*args, **kwargs):
         rtrn = func_to_log(*args, **kwargs)
-        LOGGER.debug(f'Вызвана функция: {func_to_log.__name__} с параметрами: {args}, {kwargs}. '
-                     f'Результат работы функции: {rtrn}. '
-                     f'Вызов из функции: {inspect.stack()[1][3]} ', stacklevel=2)
+        # Аргументы форматируются только если запись действительно попадет в журнал
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug('Вызвана функция: %s с параметрами: %s, %s. '
+                         'Результат работы функции: %s. '
+                         'Вызов из функции: %s ',
+                         func_to_log.__name__, args, kwargs, rtrn, sys._getframe(1).f_code.co_name,
+                         stacklevel=2)
         return rtrn
 
     return log_saver
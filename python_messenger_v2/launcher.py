@@ -1,25 +1,10 @@
-"""Лаунчер"""
+"""Лаунчер: запускает локальный сервер и нагружает его клиентами без окон терминала.
 
-import subprocess
+Параметры те же, что у benchmarks.loadgen, например:
+    python launcher.py --clients 1000 --scenarios pingpong fanout --output run.json
+"""
 
-PROCESS = []
+from benchmarks.loadgen import main
 
-while True:
-    ACTION = input('Выберите действие: q - выход, '
-                   's - запустить сервер и клиенты, x - закрыть все окна: ')
-
-    if ACTION == 'q':
-        break
-    elif ACTION == 's':
-        PROCESS.append(subprocess.Popen('python server.py',
-                                        creationflags=subprocess.CREATE_NEW_CONSOLE))
-        PROCESS.append(subprocess.Popen('python client.py -n test1',
-                                        creationflags=subprocess.CREATE_NEW_CONSOLE))
-        PROCESS.append(subprocess.Popen('python client.py -n test2',
-                                        creationflags=subprocess.CREATE_NEW_CONSOLE))
-        PROCESS.append(subprocess.Popen('python client.py -n test3',
-                                        creationflags=subprocess.CREATE_NEW_CONSOLE))
-    elif ACTION == 'x':
-        while PROCESS:
-            VICTIM = PROCESS.pop()
-            VICTIM.kill()
+if __name__ == '__main__':
+    main()
@@ -2,24 +2,26 @@ import logging
 import logging.handlers
 import sys
 import os
+from logs.configs.queue_logging import setup_queue_logging, JsonLinesFormatter, LOG_FORMAT
 
 # formatter
 CLIENT_FORMATTER = logging.Formatter('%(asctime) - 25s %(levelname) - 10s %(filename) - 21s %(message)s')
 
 # log_filename
 PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-PATH = os.path.join(PATH, 'client_logs\client.log')
+PATH = os.path.join(PATH, 'client_logs', 'client.log')
 
 STREAM_HANDLER = logging.StreamHandler(sys.stderr)
 STREAM_HANDLER.setFormatter(CLIENT_FORMATTER)
 STREAM_HANDLER.setLevel(logging.ERROR)
 LOG_FILE = logging.handlers.TimedRotatingFileHandler(PATH, encoding='utf8', interval=1, when='midnight')
-LOG_FILE.setFormatter(CLIENT_FORMATTER)
+LOG_FILE.setFormatter(JsonLinesFormatter() if LOG_FORMAT == 'json' else CLIENT_FORMATTER)
 
+# Обработчики вызываются в отдельном потоке, сетевой цикл только ставит записи в очередь
 LOGGER = logging.getLogger('client')
-LOGGER.addHandler(STREAM_HANDLER)
-LOGGER.addHandler(LOG_FILE)
-LOGGER.setLevel(logging.DEBUG)
+QUEUE_HANDLER = setup_queue_logging(LOGGER, (STREAM_HANDLER, LOG_FILE))
+# Уровень журнала задается переменной окружения MESSENGER_LOG_LEVEL (по умолчанию DEBUG)
+LOGGER.setLevel(os.environ.get('MESSENGER_LOG_LEVEL', 'DEBUG').upper())
 
 if __name__ == '__main__':
     LOGGER.critical('Критическая ошибка')
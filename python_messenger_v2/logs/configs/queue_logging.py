@@ -0,0 +1,121 @@
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+
+# Размер очереди записей и поведение при ее переполнении
+LOG_QUEUE_SIZE = int(os.environ.get('MESSENGER_LOG_QUEUE_SIZE', 10000))
+LOG_DROP_POLICY = os.environ.get('MESSENGER_LOG_DROP_POLICY', 'drop-newest')
+# Формат файлового журнала: text или json (одна JSON-запись на строку)
+LOG_FORMAT = os.environ.get('MESSENGER_LOG_FORMAT', 'text')
+
+DROP_NEWEST = 'drop-newest'
+DROP_OLDEST = 'drop-oldest'
+
+# Обработчики, для которых запущены потоки записи
+_QUEUE_HANDLERS = []
+_EXC_FORMATTER = logging.Formatter()
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """Кладет записи в ограниченную очередь, не блокируя вызывающий поток.
+
+    Если очередь заполнена, отбрасывается новая (drop-newest) или самая
+    старая (drop-oldest) запись; число потерянных записей хранится в dropped.
+    """
+
+    def __init__(self, log_queue, drop_policy=DROP_NEWEST):
+        super().__init__(log_queue)
+        self.drop_policy = drop_policy
+        self.dropped = 0
+        self.listener = None
+
+    def start_listener(self, handlers):
+        self.listener = logging.handlers.QueueListener(self.queue, *handlers, respect_handler_level=True)
+        self.listener.start()
+
+    def stop_listener(self):
+        """Дописывает накопленные записи и останавливает поток записи."""
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def prepare(self, record):
+        # Аргументы подставляются сразу, пока сетевой цикл не изменил переданные объекты;
+        # оформление строки (время, уровень, файл) остается потоку QueueListener
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = _EXC_FORMATTER.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+            return
+        except queue.Full:
+            pass
+        if self.drop_policy == DROP_OLDEST:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            try:
+                self.queue.put_nowait(record)
+            except queue.Full:
+                pass
+        self.dropped += 1
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """Компактная запись в одну строку JSON, удобная для загрузки в системы сбора журналов."""
+
+    def format(self, record):
+        entry = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'file': record.filename,
+            'line': record.lineno,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def setup_queue_logging(logger, handlers, maxsize=LOG_QUEUE_SIZE, drop_policy=LOG_DROP_POLICY):
+    """Подключает handlers к logger через очередь и фоновый поток записи."""
+    queue_handler = BoundedQueueHandler(queue.Queue(maxsize), drop_policy)
+    queue_handler.start_listener(handlers)
+    logger.addHandler(queue_handler)
+
+    def restart_in_child():
+        # Поток записи не переживает fork, поэтому рабочий процесс получает свои очередь и поток
+        queue_handler.queue = queue.Queue(maxsize)
+        queue_handler.dropped = 0
+        queue_handler.start_listener(handlers)
+
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=restart_in_child)
+    _QUEUE_HANDLERS.append(queue_handler)
+    return queue_handler
+
+
+def dropped_records():
+    """Число записей, потерянных при переполнении очередей журналов этого процесса."""
+    return sum(queue_handler.dropped for queue_handler in _QUEUE_HANDLERS)
+
+
+@atexit.register
+def stop_queue_logging():
+    for queue_handler in _QUEUE_HANDLERS:
+        queue_handler.stop_listener()
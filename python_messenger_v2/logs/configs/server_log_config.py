@@ -2,24 +2,26 @@ import logging
 import logging.handlers
 import sys
 import os
+from logs.configs.queue_logging import setup_queue_logging, JsonLinesFormatter, LOG_FORMAT
 
 # formatter
 SERVER_FORMATTER = logging.Formatter('%(asctime) - 25s %(levelname) - 10s %(filename) - 21s %(message)s')
 
 # log_filename
 PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-PATH = os.path.join(PATH, 'server_logs\server.log')
+PATH = os.path.join(PATH, 'server_logs', 'server.log')
 
 STREAM_HANDLER = logging.StreamHandler(sys.stderr)
 STREAM_HANDLER.setFormatter(SERVER_FORMATTER)
 STREAM_HANDLER.setLevel(logging.ERROR)
 LOG_FILE = logging.handlers.TimedRotatingFileHandler(PATH, encoding='utf8', interval=1, when='midnight')
-LOG_FILE.setFormatter(SERVER_FORMATTER)
+LOG_FILE.setFormatter(JsonLinesFormatter() if LOG_FORMAT == 'json' else SERVER_FORMATTER)
 
+# Обработчики вызываются в отдельном потоке, сетевой цикл только ставит записи в очередь
 LOGGER = logging.getLogger('server')
-LOGGER.addHandler(STREAM_HANDLER)
-LOGGER.addHandler(LOG_FILE)
-LOGGER.setLevel(logging.DEBUG)
+QUEUE_HANDLER = setup_queue_logging(LOGGER, (STREAM_HANDLER, LOG_FILE))
+# Уровень журнала задается переменной окружения MESSENGER_LOG_LEVEL (по умолчанию DEBUG)
+LOGGER.setLevel(os.environ.get('MESSENGER_LOG_LEVEL', 'DEBUG').upper())
 
 if __name__ == '__main__':
     LOGGER.critical('Критическая ошибка')
@@ -1,18 +1,66 @@
+import asyncio
 import socket
 import sys
+import time
 import logging
-import select
+import selectors
 import argparse
+from collections import Counter, deque
 import logs.configs.server_log_config
-from common.variables import DEFAULT_IP_ADDRESS, DEFAULT_PORT, MAX_CONNECTIONS, \
+from logs.configs.queue_logging import dropped_records
+from common.variables import DEFAULT_IP_ADDRESS, DEFAULT_PORT, LISTEN_BACKLOG, \
     ACTION, PRESENCE, TIME, USER, ACCOUNT_NAME, STATUS_CODE, STATUS, MESSAGE, \
-    MESSAGE_TEXT, SENDER, DESTINATION, ERROR, EXIT
-from common.utils import get_message, send_message
+    MESSAGE_TEXT, SENDER, DESTINATION, ERROR, EXIT, VERSION, CODEC, CODECS, OUTBOUND_QUEUE_LIMIT, \
+    OUTBOUND_HIGH_WATERMARK, OUTBOUND_LOW_WATERMARK, OVERFLOW_POLICIES, OVERFLOW_DROP_OLDEST, \
+    OVERFLOW_REJECT, OFFLINE_SEGMENT_SIZE, OFFLINE_RETENTION, JOIN, LEAVE, ROOM, ROOM_PREFIX, FANOUT_CHUNK, \
+    PING, PONG, PING_INTERVAL, IDLE_TIMEOUT, HANDSHAKE_TIMEOUT, TIMER_RESOLUTION, LEGACY_PROTOCOL_VERSION, \
+    HISTORY, LIMIT, BEFORE, MESSAGES, HISTORY_PAGE_SIZE, HISTORY_MAX_PAGE_SIZE, COMPRESSION, COMPRESSIONS, \
+    FAIR_QUANTUM, RATE_LIMIT_POLICIES, RATE_LIMIT_DELAY, RATE_LIMIT_REJECT, RATE_LIMIT_PRUNE_INTERVAL, \
+    PROFILE_SECONDS, CONTACTS, SUBSCRIBE, MESSAGE_ID, ACK, SESSION, WRITE_BATCH_FRAMES, REQUEST_ID
+from common.utils import negotiate_protocol_version, frame_payload, make_frame
+from common.message_codecs import negotiate_codec, JSON_CODEC
+from common.compression import negotiate_compression, accepted_compressions
+from server_core.connection import ClientConnection, AsyncClientConnection
+from server_core.workers import run_workers, WorkerCluster
+from server_core.federation import FederationCluster, parse_address
+from server_core.offline import OfflineStore
+from server_core.history import MessageHistory
+from server_core.rooms import RoomRegistry, FanOut
+from server_core.contacts import ContactDirectory
+from server_core.dedup import SenderWindows
+from server_core.metrics import Metrics, start_admin_server
+from server_core.profiling import LoopProfiler, install_profile_signals
+from server_core.timers import TimerWheel
+from server_core.ratelimit import RateLimiter
+from server_core.dispatch import ActionRegistry, CannedResponse, UNKNOWN_ACTION
 from decors import log
 
 # Инициализация логирования сервера
 SERVER_LOGGER = logging.getLogger('server')
 
+# Постоянные ответы кодируются один раз для каждой версии протокола и кодека
+BAD_REQUEST = CannedResponse({STATUS_CODE: 400, STATUS: 'Bad Request', ERROR: 'Некоректный запрос'})
+NAME_TAKEN = CannedResponse({STATUS_CODE: 400, STATUS: 'Bad Request', ERROR: 'Имя пользователя уже занято.'})
+BAD_ROOM_NAME = CannedResponse({STATUS_CODE: 400, STATUS: 'Bad Request',
+                                ERROR: f'Имя комнаты должно начинаться с {ROOM_PREFIX}'})
+DIRECTORY_UNAVAILABLE = CannedResponse({STATUS_CODE: 503, STATUS: 'Service Unavailable',
+                                        ERROR: 'Каталог пользователей кластера недоступен, повторите позже.'})
+FORGED_SENDER = CannedResponse({STATUS_CODE: 403, STATUS: 'Forbidden',
+                                ERROR: 'Отправитель сообщения не совпадает с именем пользователя.'})
+ROOMS_UNAVAILABLE = CannedResponse({STATUS_CODE: 501, STATUS: 'Not Implemented',
+                                    ERROR: 'Комнаты не поддерживаются в режиме нескольких процессов и кластера'})
+HISTORY_DISABLED = CannedResponse({STATUS_CODE: 501, STATUS: 'Not Implemented',
+                                   ERROR: 'История сообщений на сервере не хранится'})
+BAD_HISTORY_REQUEST = CannedResponse({
+    STATUS_CODE: 400,
+    STATUS: 'Bad Request',
+    ERROR: f'Некорректный запрос истории, не больше {HISTORY_MAX_PAGE_SIZE} сообщений на страницу'
+})
+
+
+def is_room_name(room):
+    return isinstance(room, str) and room.startswith(ROOM_PREFIX) and len(room) > 1
+
 
 # Парсер аргументов коммандной строки
 @log
@@ -20,8 +68,45 @@ def arg_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('-a', default=DEFAULT_IP_ADDRESS, nargs='?')
     parser.add_argument('-p', default=DEFAULT_PORT, type=int, nargs='?')
+    parser.add_argument('--engine', default='selectors', choices=('selectors', 'asyncio'))
+    parser.add_argument('--queue-limit', default=OUTBOUND_QUEUE_LIMIT, type=int)
+    parser.add_argument('--high-watermark', default=OUTBOUND_HIGH_WATERMARK, type=int)
+    parser.add_argument('--low-watermark', default=OUTBOUND_LOW_WATERMARK, type=int)
+    parser.add_argument('--overflow-policy', default=None, choices=OVERFLOW_POLICIES,
+                        help='по умолчанию drop-oldest, для --engine asyncio - reject')
+    parser.add_argument('--workers', default=1, type=int)
+    parser.add_argument('--offline-dir', default=None)
+    parser.add_argument('--offline-segment-size', default=OFFLINE_SEGMENT_SIZE, type=int)
+    parser.add_argument('--offline-retention', default=OFFLINE_RETENTION, type=float)
+    parser.add_argument('--history-db', default=None, help='файл базы SQLite для истории сообщений')
+    parser.add_argument('--admin-port', default=None, type=int,
+                        help='порт на 127.0.0.1 для метрик в формате Prometheus')
+    parser.add_argument('--admin-socket', default=None, help='unix-сокет для метрик')
+    parser.add_argument('--profile-dir', default='.',
+                        help='каталог для профилей, снятых по SIGUSR1, SIGUSR2 или POST /profile')
+    parser.add_argument('--profile-seconds', default=PROFILE_SECONDS, type=float,
+                        help='длительность профилирования по сигналу')
+    parser.add_argument('--ping-interval', default=PING_INTERVAL, type=float,
+                        help='ping после стольких секунд тишины, 0 - не проверять')
+    parser.add_argument('--idle-timeout', default=IDLE_TIMEOUT, type=float)
+    parser.add_argument('--handshake-timeout', default=HANDSHAKE_TIMEOUT, type=float,
+                        help='0 - не ограничивать время приветствия')
+    parser.add_argument('--rate-limit', default=0, type=float,
+                        help='сообщений в секунду от одного пользователя, 0 - без ограничения')
+    parser.add_argument('--rate-burst', default=None, type=float, help='запас сообщений сверх --rate-limit')
+    parser.add_argument('--ip-rate-limit', default=0, type=float,
+                        help='сообщений в секунду со всех соединений одного IP-адреса, 0 - без ограничения')
+    parser.add_argument('--ip-rate-burst', default=None, type=float)
+    parser.add_argument('--rate-limit-policy', default=RATE_LIMIT_DELAY, choices=RATE_LIMIT_POLICIES)
+    parser.add_argument('--fair-quantum', default=FAIR_QUANTUM, type=int,
+                        help='сообщений одного соединения за итерацию цикла')
+    parser.add_argument('--write-batch-frames', default=WRITE_BATCH_FRAMES, type=int,
+                        help='кадров в одном вызове sendmsg; 1 - отдельный вызов на каждый кадр')
+    parser.add_argument('--node-id', default=None, type=int, help='номер узла в кластере из нескольких серверов')
+    parser.add_argument('--node-listen', default=None, help='адрес host:port для каналов от других узлов')
+    parser.add_argument('--node-peer', default=[], action='append',
+                        help='другой узел кластера в виде номер=host:port, можно указать несколько раз')
     namespace = parser.parse_args(sys.argv[1:])
-    server_ip = namespace.a
     server_port = namespace.p
 
     try:
@@ -32,133 +117,1184 @@ def arg_parser():
                                f'Порт сервера должен быть в диапазоне от "1024" до "65535"')
         sys.exit(1)
 
-    return server_ip, server_port
+    if not 0 <= namespace.low_watermark <= namespace.high_watermark <= namespace.queue_limit:
+        SERVER_LOGGER.critical('Границы очереди должны удовлетворять условию: '
+                               'low-watermark <= high-watermark <= queue-limit')
+        sys.exit(1)
+
+    if namespace.overflow_policy is None:
+        namespace.overflow_policy = OVERFLOW_REJECT if namespace.engine == 'asyncio' else OVERFLOW_DROP_OLDEST
+    if namespace.overflow_policy == OVERFLOW_DROP_OLDEST and namespace.engine == 'asyncio':
+        SERVER_LOGGER.critical('Политика drop-oldest не поддерживается с --engine asyncio: '
+                               'данные, переданные транспорту, нельзя удалить выборочно')
+        sys.exit(1)
+
+    if namespace.workers < 1 or namespace.workers > 1 and namespace.engine != 'selectors':
+        SERVER_LOGGER.critical('Число рабочих процессов должно быть положительным, '
+                               'несколько процессов поддерживаются только с --engine selectors')
+        sys.exit(1)
+
+    if namespace.rate_limit < 0 or namespace.ip_rate_limit < 0 or namespace.fair_quantum < 1 or \
+            any(burst is not None and burst < 1 for burst in (namespace.rate_burst, namespace.ip_rate_burst)):
+        SERVER_LOGGER.critical('Ограничения частоты не могут быть отрицательными, запас - меньше одного '
+                               'сообщения, fair-quantum - меньше одного сообщения')
+        sys.exit(1)
+
+    if not 1 <= namespace.write_batch_frames <= 1024:
+        SERVER_LOGGER.critical('write-batch-frames должен быть в диапазоне от 1 до 1024')
+        sys.exit(1)
+
+    if namespace.profile_seconds <= 0:
+        SERVER_LOGGER.critical('profile-seconds должен быть положительным')
+        sys.exit(1)
+
+    if namespace.ping_interval and namespace.idle_timeout <= namespace.ping_interval:
+        SERVER_LOGGER.critical('idle-timeout должен быть больше ping-interval')
+        sys.exit(1)
+
+    if namespace.offline_dir is not None and namespace.workers > 1:
+        SERVER_LOGGER.critical('Хранение сообщений для пользователей не в сети '
+                               'не поддерживается в режиме нескольких процессов')
+        sys.exit(1)
+
+    if namespace.history_db is not None and namespace.workers > 1:
+        SERVER_LOGGER.critical('История сообщений не поддерживается в режиме нескольких процессов')
+        sys.exit(1)
+
+    if namespace.node_id is not None:
+        try:
+            namespace.node_listen = parse_address(namespace.node_listen)
+            namespace.node_peer = {int(node_id): parse_address(address) for node_id, _, address in
+                                   (peer.partition('=') for peer in namespace.node_peer)}
+            if namespace.node_id in namespace.node_peer or namespace.workers > 1 or \
+                    namespace.engine != 'selectors':
+                raise ValueError
+        except (AttributeError, ValueError):
+            SERVER_LOGGER.critical('Узлу кластера нужны --node-listen host:port и --node-peer номер=host:port '
+                                   'для остальных узлов; кластер работает только с --engine selectors '
+                                   'в одном процессе')
+            sys.exit(1)
+
+    return namespace
 
 
 # Основной класс сервера
 class Server:
-    def __init__(self, server_ip, server_port):
+    # Действия протокола и их обработчики; подкласс добавляет свои действия в копию таблицы:
+    # actions = Server.actions.copy() и декоратор @actions.action над новым методом
+    actions = ActionRegistry()
+
+    def __init__(self, server_ip, server_port, queue_limit=OUTBOUND_QUEUE_LIMIT,
+                 high_watermark=OUTBOUND_HIGH_WATERMARK, low_watermark=OUTBOUND_LOW_WATERMARK,
+                 overflow_policy=OVERFLOW_DROP_OLDEST, offline=None, history=None, admin_address=None,
+                 ping_interval=PING_INTERVAL, idle_timeout=IDLE_TIMEOUT, handshake_timeout=HANDSHAKE_TIMEOUT,
+                 rate_limiter=None, rate_limit_policy=RATE_LIMIT_DELAY, fair_quantum=FAIR_QUANTUM,
+                 profile_dir='.', write_batch_frames=WRITE_BATCH_FRAMES):
         # Параметры подключения
         self.server_ip = server_ip
         self.server_port = server_port
 
-        # Список подключенных клиентов
-        self.clients = []
+        # Ограничения исходящей очереди соединения: при превышении high_watermark
+        # приостанавливается чтение от отправителей, пока очередь не опустится
+        # ниже low_watermark; при превышении queue_limit применяется overflow_policy
+        self.queue_limit = queue_limit
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.overflow_policy = overflow_policy
+
+        # Мультиплексор событий ввода-вывода (epoll в Linux)
+        self.selector = selectors.DefaultSelector()
+
+        # Множество подключенных клиентов
+        self.clients = set()
 
         # Список сообщений на отправку
         self.messages = []
 
-        # Словарь имен и соответствующие им сокеты
+        # Словарь имен и соответствующие им соединения
         self.names = dict()
 
+        # Соединения, в буферах которых есть данные на отправку
+        self.pending_writes = set()
+
+        # Счетчики событий сервера
+        self.stats = Counter()
+
+        # Общий порт и маршрутизация между рабочими процессами (режим --workers)
+        # или узлами кластера (FederationCluster)
+        self.reuse_port = False
+        self.cluster = None
+        # Приветствия, ждущие ответа каталога кластера: {имя: (сообщение, клиент)}
+        self.claiming = dict()
+
+        # Почтовые ящики пользователей не в сети (OfflineStore), если хранение включено
+        self.offline = offline
+
+        # История сообщений (MessageHistory), если хранение включено
+        self.history = history
+
+        # Комнаты и незавершенные рассылки в них; за итерацию цикла выполняется
+        # не больше fanout_chunk доставок, чтобы большая комната не задерживала остальных
+        self.rooms = RoomRegistry()
+        self.fanouts = deque()
+        self.fanout_chunk = FANOUT_CHUNK
+
+        # Проверка живости: таймеры соединений лежат в колесе, поэтому итерация цикла
+        # обрабатывает только сработавшие таймеры, а не все соединения
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        self.handshake_timeout = handshake_timeout
+        self.now = time.monotonic()
+        self.timers = TimerWheel(TIMER_RESOLUTION, self.now)
+
+        # Список пользователей в сети и подписчики на его изменения
+        self.contacts = ContactDirectory(self)
+
+        # Последние номера сообщений отключившихся отправителей для отбрасывания повторов
+        self.dedup = SenderWindows()
+
+        # Справедливость: за итерацию соединение обрабатывает не больше fair_quantum сообщений,
+        # соединения с необработанным остатком обходятся по кругу из backlog
+        self.fair_quantum = fair_quantum
+        self.backlog = deque()
+
+        # Сколько кадров из очереди соединения уходит одним вызовом sendmsg
+        self.write_batch_frames = write_batch_frames
+        self.handlers = self.actions.bind(self)
+
+        # Ограничение частоты сообщений по учетным записям и IP-адресам (RateLimiter)
+        self.rate_limiter = rate_limiter
+        self.rate_limit_policy = rate_limit_policy
+        if rate_limiter is not None:
+            self.timers.schedule(self.now, RATE_LIMIT_PRUNE_INTERVAL, self.prune_rate_limits)
+
+        # Метрики: счетчики из stats, датчики и гистограммы времени; отдаются по admin_address
+        self.admin_address = admin_address
+        self.admin_server = None
+        self.metrics = Metrics(self.stats)
+        self.metrics.gauge('clients', 'Подключенные клиенты', lambda: len(self.clients))
+        self.metrics.gauge('users', 'Пользователи, прошедшие приветствие', lambda: len(self.names))
+        self.metrics.gauge('queued_bytes', 'Байт в исходящих очередях',
+                           lambda: sum(client.out_bytes for client in list(self.clients)))
+        self.metrics.gauge('rooms', 'Комнаты', lambda: len(self.rooms.rooms))
+        self.metrics.gauge('backlog', 'Соединения, ждущие своей доли обработки', lambda: len(self.backlog))
+        self.metrics.gauge('contact_subscribers', 'Подписчики на изменения списка пользователей в сети',
+                           lambda: len(self.contacts.subscribers.members))
+        self.metrics.gauge('log_records_dropped', 'Записи журнала, потерянные при переполнении очереди',
+                           dropped_records)
+        self.relay_time = self.metrics.histogram(
+            'relay_seconds', 'Время от чтения сообщения из сокета до постановки в очередь получателя '
+                             '(для комнаты - последнего участника)')
+        self.loop_time = self.metrics.histogram(
+            'loop_iteration_seconds', 'Время обработки одной итерации цикла событий без ожидания')
+        # Время этапов обработки: прием подключения, чтение сокета, разбор кадра, обработка
+        # действия, маршрутизация сообщения и запись в сокет; всегда включено и стоит
+        # двух вызовов perf_counter и одного observe на этап
+        self.accept_time, self.read_time, self.decode_time, self.dispatch_time, self.route_time, \
+            self.send_time = (self.metrics.histogram('stage_seconds', 'Время этапов обработки в цикле событий',
+                                                     labels={'stage': stage})
+                              for stage in ('accept', 'read', 'decode', 'dispatch', 'route', 'send'))
+
+        # Профилирование по запросу: SIGUSR1/SIGUSR2 или POST /profile на адресе метрик
+        self.profiler = LoopProfiler(profile_dir)
+
     @log
     def init_socket(self):
         SERVER_LOGGER.info(f'Запущен сервер, адрес сервера: {self.server_ip} '
                            f'порт для подключений: {self.server_port} ')
         server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self.reuse_port:
+            server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         server_sock.bind((self.server_ip, self.server_port))
-        server_sock.settimeout(0.5)
+        server_sock.setblocking(False)
         self.sock = server_sock
-        self.sock.listen()
+        self.sock.listen(LISTEN_BACKLOG)
+        self.selector.register(self.sock, selectors.EVENT_READ)
+        if self.cluster is not None:
+            self.cluster.attach(self)
+        self.start_admin()
+
+    def start_admin(self):
+        if self.admin_address is None:
+            return
+        address = self.admin_address
+        if isinstance(self.cluster, WorkerCluster):
+            # Каждый рабочий процесс отдает свои метрики на соседнем порту или своем сокете
+            worker_id = self.cluster.worker_id
+            address = address + worker_id if isinstance(address, int) else f'{address}.{worker_id}'
+        self.admin_server = start_admin_server(self.metrics, address, self.profiler)
+
+    def stop_admin(self):
+        if self.admin_server is not None:
+            self.admin_server.shutdown()
+            self.admin_server.server_close()
+            self.admin_server = None
 
     @log
     def main_loop(self):
         self.init_socket()
 
         while True:
+            # Простаивающий цикл просыпается раз в TIMER_RESOLUTION, чтобы запрос профиля не ждал первого события
+            self.run_once(TIMER_RESOLUTION)
+
+    def run_once(self, timeout=None):
+        if self.fanouts or self.backlog:
+            timeout = 0
+        elif self.timers or self.profiler.active:
+            timeout = TIMER_RESOLUTION if timeout is None else min(timeout, TIMER_RESOLUTION)
+        events = self.selector.select(timeout)
+        self.now = time.monotonic()
+        self.profiler.tick()
+        started = time.perf_counter()
+        self.serve_backlog()
+        for key, mask in events:
+            client = key.data
+            if client is None:
+                self.accept_clients()
+                continue
+            if client is self.cluster:
+                self.cluster.accept_nodes()
+                continue
+            if mask & selectors.EVENT_READ and not client.closing and not client.paused:
+                self.read_client(client)
+            if mask & selectors.EVENT_WRITE and not client.closed:
+                self.pending_writes.add(client)
+
+        self.process_messages()
+        self.run_fanouts()
+        self.timers.run(self.now)
+        self.flush_clients()
+
+        self.loop_time.observe(time.perf_counter() - started)
+
+    def accept_clients(self):
+        while True:
+            started = time.perf_counter()
             try:
                 client_sock, client_addr = self.sock.accept()
-            except OSError:
-                pass
-            else:
-                SERVER_LOGGER.info(f'Подключен клиент с адресом {client_addr}')
-                self.clients.append(client_sock)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as err:
+                SERVER_LOGGER.error(f'Ошибка при подключении клиента: {err}')
+                return
+            SERVER_LOGGER.info(f'Подключен клиент с адресом {client_addr}')
+            client_sock.setblocking(False)
+            client_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.set_keepalive(client_sock)
+            client = ClientConnection(client_sock, client_addr, self.stats, self.write_batch_frames)
+            self.stats['connections'] += 1
+            self.clients.add(client)
+            self.selector.register(client_sock, client.events, client)
+            self.start_timers(client)
+            self.accept_time.observe(time.perf_counter() - started)
+
+    def set_keepalive(self, sock):
+        # Клиенты первой версии не отвечают на ping, их обрыв обнаруживает TCP keepalive
+        if not self.idle_timeout:
+            return
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, max(int(self.idle_timeout), 1))
+
+    def start_timers(self, client):
+        client.last_seen = self.now
+        if self.handshake_timeout:
+            client.timer = self.timers.schedule(self.now, self.handshake_timeout, self.check_handshake, client)
+
+    def check_handshake(self, client):
+        if client.closed or client.name is not None:
+            return
+        self.stats['handshake_timeouts'] += 1
+        SERVER_LOGGER.info(f'Клиент {client.addr} не прислал приветствие вовремя и отключен.')
+        self.remove_client(client)
+
+    def check_idle(self, client):
+        """Отправляет ping молчащему клиенту и отключает того, кто молчит дольше idle_timeout."""
+        if client.closed:
+            return
+        idle = self.now - client.last_seen
+        if idle >= self.idle_timeout:
+            self.stats['idle_disconnects'] += 1
+            SERVER_LOGGER.warning(f'Клиент {client} не отвечает {idle:.0f} с и отключен.')
+            self.remove_client(client)
+            return
+        if idle >= self.ping_interval:
+            # Молчащему соединению приемный буфер не нужен
+            client.decoder.shrink()
+            self.send_to(client, {ACTION: PING, TIME: time.time()})
+            self.stats['pings'] += 1
+            delay = min(self.ping_interval, self.idle_timeout - idle)
+        else:
+            delay = self.ping_interval - idle
+        client.timer = self.timers.schedule(self.now, delay, self.check_idle, client)
+
+    def read_client(self, client):
+        client.last_seen = self.now
+        started = time.perf_counter()
+        try:
+            frames = client.read()
+            self.read_time.observe(time.perf_counter() - started)
+        except (BlockingIOError, InterruptedError):
+            return
+        except Exception:
+            SERVER_LOGGER.info(f'Клиент {client.addr} отключился от сервера.')
+            self.remove_client(client)
+            return
+        self.serve_client(client, frames)
 
-            recv_data_list = []
-            send_data_list = []
-            err_data_list = []
+    def serve_client(self, client, frames):
+        try:
+            unfinished = self.process_frames(client, frames)
+        except Exception:
+            SERVER_LOGGER.info(f'Клиент {client.addr} отключился от сервера.')
+            self.remove_client(client)
+            return
+        if unfinished and not client.closed and not client.closing and not client.throttled:
+            # Остаток принятых данных разбирается в следующих итерациях, читать сокет до тех пор незачем
+            client.backlogged = True
+            self.backlog.append(client)
+            self.update_events(client)
+
+    def serve_backlog(self):
+        """Дает по одной доле обработки соединениям, оставшимся в очереди с прошлой итерации."""
+        backlog = self.backlog
+        for _ in range(len(backlog)):
+            client = backlog.popleft()
+            client.backlogged = False
+            if client.closed:
+                continue
+            self.serve_client(client, client.decoder.frames())
+            if not client.closed:
+                self.update_events(client)
+
+    def process_frames(self, client, frames):
+        """Обрабатывает принятые кадры клиента, не больше fair_quantum за вызов.
+
+        Возвращает True, если доля исчерпана и в разборщике могли остаться данные.
+        """
+        process = self.cluster.process_peer_message if client.is_peer else self.process_client_message
+        # Канал соседнего процесса несет сообщения многих пользователей и не ограничивается
+        quantum = None if client.is_peer else self.fair_quantum
+        limiter = None if client.is_peer else self.rate_limiter
+        perf_counter = time.perf_counter
+        processed = 0
+        while quantum is None or processed < quantum:
+            item = client.held_frame
+            if item is None:
+                item = next(frames, None)
+                if item is None:
+                    return False
+            client.held_frame = None
+            processed += 1
+            if limiter is not None:
+                delay = limiter.acquire(client, self.now)
+                if delay:
+                    if self.over_limit(client, item, delay):
+                        continue
+                    return False
+            frame, message = item
+            if message is None:
+                if not client.is_peer:
+                    started = perf_counter()
+                    relayed = self.relay_frame(client, frame)
+                    self.route_time.observe(perf_counter() - started)
+                    if relayed:
+                        continue
+                started = perf_counter()
+                message = client.decoder.decode_frame(frame)
+                self.decode_time.observe(perf_counter() - started)
+            started = perf_counter()
+            process(message, client)
+            self.dispatch_time.observe(perf_counter() - started)
+            if client.closed or client.closing:
+                return False
+        return True
+
+    def over_limit(self, client, item, delay):
+        """Применяет rate_limit_policy к кадру сверх лимита; возвращает True, если обработку можно продолжить."""
+        if self.rate_limit_policy == RATE_LIMIT_DELAY:
+            client.held_frame = item
+            self.throttle(client, delay)
+            return False
+        if self.rate_limit_policy == RATE_LIMIT_REJECT:
+            self.stats['rate_limited_messages'] += 1
+            frame, message = item
+            if message is None:
+                try:
+                    message = client.decoder.decode_frame(frame)
+                except ValueError:
+                    message = {}
+            self.respond(client, message, {
+                STATUS_CODE: 429,
+                STATUS: 'Too Many Requests',
+                ERROR: f'Превышена частота сообщений, повторите через {delay:.2f} с'
+            })
+            return True
+        self.stats['rate_limit_disconnects'] += 1
+        SERVER_LOGGER.warning(f'Клиент {client} отключен: превышена частота сообщений.')
+        self.remove_client(client)
+        return False
+
+    def throttle(self, client, delay):
+        client.throttled = True
+        self.stats['throttled_clients'] += 1
+        self.update_events(client)
+        self.timers.schedule(self.now, delay, self.unthrottle, client)
+
+    def unthrottle(self, client):
+        if client.closed:
+            return
+        client.throttled = False
+        # Отложенный кадр и остаток данных обрабатываются в общей очереди
+        client.backlogged = True
+        self.backlog.append(client)
 
+    def prune_rate_limits(self):
+        self.rate_limiter.prune(self.now)
+        self.timers.schedule(self.now, RATE_LIMIT_PRUNE_INTERVAL, self.prune_rate_limits)
+
+    def relay_frame(self, client, frame):
+        """Быстрый путь: пересылает кадр сообщения получателю без разбора текста.
+
+        Из кадра читаются только отправитель и получатель; если получатель
+        использует ту же версию протокола и тот же кодек, ему уходят исходные
+        байты кадра. Сжатый кадр распаковывается только для чтения адреса и уходит
+        сжатым, если получатель умеет его распаковать, иначе - распакованным, но
+        без повторного кодирования. В остальных случаях возвращается False и кадр
+        разбирается целиком.
+        """
+        payload = frame_payload(frame, client.decoder.max_length)
+        route = client.codec.peek_route(payload)
+        if route is None:
+            return False
+        sender, destination, message_id = route
+        if destination.startswith(ROOM_PREFIX):
+            room = self.rooms.get(destination)
+            if sender != client.name or room is None or client not in room.members:
+                return False
+            if message_id is not None and self.is_duplicate(client, message_id):
+                return True
+            if self.messages:
+                self.process_messages()
+            # Кадр лежит в приемном буфере отправителя, а рассылка может растянуться на несколько итераций
+            self.publish(room, client, frame=bytes(frame))
+            if self.history is not None:
+                self.history.record(sender, destination, payload=payload, codec=client.codec)
+            return True
+        receiver = self.names.get(destination)
+        if sender != client.name or receiver is None or receiver.mailbox or \
+                receiver.codec is not client.codec or receiver.protocol_version != client.protocol_version:
+            return False
+        if message_id is not None and self.is_duplicate(client, message_id):
+            return True
+        # Сообщения, принятые раньше по полному пути, должны уйти первыми
+        if self.messages:
+            self.process_messages()
+        if frame[0] and frame[0] not in receiver.compressions:
+            frame = make_frame(payload)
+            self.stats['decompressed_frames'] += 1
+        else:
+            # Очередь получателя переживает следующее чтение в приемный буфер отправителя
+            frame = bytes(frame)
+        self.deliver(receiver, frame, client)
+        self.relay_time.observe(time.perf_counter() - client.received_at)
+        self.stats['relayed_frames'] += 1
+        if self.history is not None:
+            self.history.record(sender, destination, payload=payload, codec=client.codec)
+        SERVER_LOGGER.debug('Кадр пользователя %s переслан пользователю %s', sender, destination)
+        return True
+
+    def publish(self, room, sender, message=None, frame=None):
+        """Ставит в очередь рассылку сообщения всем участникам комнаты, кроме отправителя."""
+        self.fanouts.append(FanOut(room, sender, message, frame))
+        self.stats['room_messages'] += 1
+        self.schedule_fanouts()
+
+    def schedule_fanouts(self):
+        # Цикл на selectors выполняет рассылки на каждой итерации сам
+        pass
+
+    def run_fanouts(self):
+        """Выполняет не больше fanout_chunk доставок из очереди рассылок."""
+        budget = self.fanout_chunk
+        fanouts = self.fanouts
+        while fanouts and budget > 0:
+            fanout = fanouts[0]
+            members = fanout.members
+            end = min(fanout.position + budget, len(members))
+            for index in range(fanout.position, end):
+                member = members[index]
+                if member is not fanout.sender and not member.closed:
+                    self.deliver(member, fanout.frame_for(member))
+            budget -= end - fanout.position
+            fanout.position = end
+            if end == len(members):
+                fanouts.popleft()
+                self.stats['fanout_frames'] += len(fanout.frames)
+                if fanout.received_at is not None:
+                    self.relay_time.observe(time.perf_counter() - fanout.received_at)
+
+    def process_messages(self):
+        perf_counter = time.perf_counter
+        observe = self.route_time.observe
+        for message, sender in self.messages:
+            started = perf_counter()
+            self.process_message(message, sender)
+            observe(perf_counter() - started)
+        self.messages.clear()
+
+    def flush_clients(self):
+        pending_writes = self.pending_writes
+        while pending_writes:
+            client = pending_writes.pop()
+            if client.closed:
+                continue
+            started = time.perf_counter()
             try:
-                if self.clients:
-                    recv_data_list, send_data_list, err_list = select.select(self.clients, self.clients, [], 0)
+                flushed = client.flush()
+                self.send_time.observe(time.perf_counter() - started)
             except OSError:
-                pass
-
-            if recv_data_list:
-                for client_with_message in recv_data_list:
-                    try:
-                        self.process_client_message(get_message(client_with_message), client_with_message)
-                    except Exception:
-                        SERVER_LOGGER.info(f'Клиент {client_with_message.getpeername()} '
-                                           f'отключился от сервера.')
-                        self.clients.remove(client_with_message)
-
-            for message in self.messages:
-                try:
-                    self.process_message(message, send_data_list)
-                except Exception:
-                    SERVER_LOGGER.info(f'Связь с клиентом с именем {message[DESTINATION]} была потеряна.')
-                    self.clients.remove(self.names[message[DESTINATION]])
-                    del self.names[message[DESTINATION]]
-            self.messages.clear()
+                SERVER_LOGGER.info(f'Связь с клиентом {client} была потеряна.')
+                self.remove_client(client)
+                continue
+            if flushed and client.closing:
+                self.remove_client(client)
+                continue
+            if client.blocked_senders and client.out_bytes <= self.low_watermark:
+                self.resume_senders(client)
+            if client.offline_marks:
+                self.confirm_offline(client)
+            if client.mailbox and client.out_bytes <= self.low_watermark:
+                self.deliver_offline(client)
+            self.update_events(client)
+
+    def update_events(self, client):
+        events = 0
+        if not client.paused and not client.closing and not client.backlogged and not client.throttled:
+            events |= selectors.EVENT_READ
+        if client.out_queue:
+            events |= selectors.EVENT_WRITE
+        if events == client.events:
+            return
+        if not events:
+            self.selector.unregister(client.sock)
+        elif not client.events:
+            self.selector.register(client.sock, events, client)
+        else:
+            self.selector.modify(client.sock, events, client)
+        client.events = events
+
+    def send_to(self, client, message, sender=None):
+        return self.deliver(client, client.encode(message), sender)
+
+    def deliver(self, client, frame, sender=None):
+        """Ставит кадр в очередь клиента с учетом ее границ; возвращает False, если кадр не принят."""
+        overflow = client.out_bytes + len(frame) - self.queue_limit
+        # Канал к соседнему процессу не ограничивается, его перегрузка лишь приостанавливает отправителей
+        if overflow > 0 and not client.is_peer and not self.handle_overflow(client, frame, sender, overflow):
+            return False
+        client.queue_frame(frame)
+        self.pending_writes.add(client)
+        if sender is not None and sender is not client and client.out_bytes > self.high_watermark:
+            self.pause_sender(sender, client)
+        return True
+
+    def handle_overflow(self, client, frame, sender, overflow):
+        if self.overflow_policy == OVERFLOW_DROP_OLDEST:
+            self.stats['dropped_messages'] += client.drop_oldest(overflow)
+            if client.out_bytes + len(frame) <= self.queue_limit:
+                return True
+            self.stats['dropped_messages'] += 1
+            return False
+        if self.overflow_policy == OVERFLOW_REJECT:
+            self.stats['rejected_messages'] += 1
+            if sender is not None and sender is not client and not sender.closed:
+                self.send_to(sender, {
+                    STATUS_CODE: 503,
+                    STATUS: 'Service Unavailable',
+                    ERROR: f'Очередь пользователя {client.name} переполнена, сообщение не доставлено.'
+                })
+            return False
+        self.stats['overflow_disconnects'] += 1
+        SERVER_LOGGER.warning(f'Клиент {client} отключен: переполнена очередь исходящих сообщений.')
+        self.remove_client(client)
+        return False
+
+    def pause_sender(self, sender, client):
+        client.blocked_senders.add(sender)
+        sender.blocked_by.add(client)
+        if not sender.paused:
+            sender.paused = True
+            self.stats['paused_senders'] += 1
+            self.update_events(sender)
+
+    def resume_senders(self, client):
+        for sender in client.blocked_senders:
+            sender.blocked_by.discard(client)
+            if sender.paused and not sender.blocked_by and not sender.closed:
+                sender.paused = False
+                self.update_events(sender)
+        client.blocked_senders.clear()
+
+    def close_after_flush(self, client):
+        client.closing = True
+        self.pending_writes.add(client)
+
+    def remove_client(self, client):
+        if client.closed:
+            return
+        self.clients.discard(client)
+        self.pending_writes.discard(client)
+        self.release_name(client)
+        self.rooms.leave_all(client)
+        self.timers.cancel(client.timer)
+        self.resume_senders(client)
+        for blocker in client.blocked_by:
+            blocker.blocked_senders.discard(client)
+        if client.events:
+            self.selector.unregister(client.sock)
+        client.close()
+        if client.is_peer:
+            self.cluster.peer_lost(client)
+
+    def deliver_offline(self, client):
+        """Отправляет клиенту очередную пачку сообщений из его почтового ящика.
+
+        Пачка не больше high_watermark; следующая уходит, когда очередь
+        клиента опустится до low_watermark. Доставленными сообщения
+        отмечаются в confirm_offline, когда их кадры записаны в сокет.
+        """
+        batch = self.offline.read(client.name, self.high_watermark, client.offline_cursor)
+        sent = 0
+        for record_id, message in batch:
+            if not self.send_to(client, message):
+                break
+            client.offline_cursor = record_id
+            sent += 1
+        if sent:
+            client.offline_marks.append((client.queued_total, client.offline_cursor))
+            self.stats['offline_delivered'] += sent
+            SERVER_LOGGER.info('Пользователю %s отправлено сообщений из почтового ящика: %s',
+                               client.name, sent)
+        client.mailbox = not client.closed and self.offline.has_mail(client.name, client.offline_cursor)
+
+    def confirm_offline(self, client):
+        """Отмечает доставленными сообщения ящика, кадры которых уже записаны в сокет клиента."""
+        marks = client.offline_marks
+        record_id = None
+        while marks and marks[0][0] <= client.written_total:
+            record_id = marks.popleft()[1]
+        if record_id is not None:
+            self.offline.delivered(client.name, record_id)
+
+    def claim_name(self, name):
+        """Занимает имя: True или False, либо None, если ответ придет позже в claim_done."""
+        if name in self.names or name in self.claiming:
+            return False
+        return self.cluster is None or self.cluster.claim(name)
+
+    def release_name(self, client):
+        self.contacts.unsubscribe(client)
+        if client.name is not None and self.names.get(client.name) is client:
+            del self.names[client.name]
+            self.dedup.save(client.name, client.session, client.last_message_id)
+            self.contacts.touch(client.name)
+            if self.cluster is not None:
+                self.cluster.release(client.name)
 
     @log
     def process_client_message(self, message, client):
-        SERVER_LOGGER.debug(f'Разбор сообщения от клиента: {message}')
-        if ACTION in message and message[ACTION] == PRESENCE and \
-                TIME in message and USER in message:
-            if message[USER][ACCOUNT_NAME] not in self.names.keys():
-                self.names[message[USER][ACCOUNT_NAME]] = client
-                send_message(client, {
-                    STATUS_CODE: 200,
-                    STATUS: 'OK'
-                })
-            else:
-                send_message(client, {
-                    STATUS_CODE: 400,
-                    STATUS: 'Bad Request',
-                    ERROR: 'Имя пользователя уже занято.'
-                })
-                self.clients.remove(client)
-                client.close()
+        SERVER_LOGGER.debug('Разбор сообщения от клиента: %s', message)
+        try:
+            validate, handler = self.handlers.get(message.get(ACTION), UNKNOWN_ACTION)
+        except TypeError:
+            # Действие нехешируемого типа
+            validate, handler = UNKNOWN_ACTION
+        if validate(message, client):
+            handler(message, client)
+            return
+        self.respond(client, message, BAD_REQUEST)
+
+    def respond(self, client, request, response):
+        """Отвечает на запрос словарем или заготовкой CannedResponse.
+
+        Номер запроса REQUEST_ID, если клиент его передал, возвращается в ответе;
+        готовый кадр заготовки используется только для ответа без номера.
+        """
+        request_id = request.get(REQUEST_ID)
+        if isinstance(response, CannedResponse):
+            if request_id is None:
+                self.deliver(client, response.frame_for(client))
+                return
+            response = response.message
+        if request_id is not None:
+            response = {**response, REQUEST_ID: request_id}
+        self.send_to(client, response)
+
+    @actions.action(PRESENCE, {TIME: None, USER: dict})
+    def handle_presence(self, message, client):
+        if client.name is not None or any(pending is client for _, pending in self.claiming.values()):
+            # Повторное приветствие сменило бы имя, а прежнее осталось бы занятым навсегда
+            self.respond(client, message, BAD_REQUEST)
+            return
+        # Клиенты первой версии не передают версию протокола
+        client.protocol_version = negotiate_protocol_version(message.get(VERSION))
+        name = message[USER].get(ACCOUNT_NAME)
+        if not isinstance(name, str) or not name:
+            self.respond(client, message, BAD_REQUEST)
+            return
+        try:
+            claimed = self.claim_name(name)
+        except ConnectionError as err:
+            SERVER_LOGGER.error(f'Приветствие клиента {client} отклонено: {err}')
+            claimed = None
+        else:
+            if claimed is None:
+                # Ответ на приветствие будет отправлен, когда каталог кластера ответит на запрос имени
+                self.claiming[name] = message, client
+                return
+        self.finish_presence(message, client, claimed)
+
+    def claim_done(self, name, claimed):
+        """Результат запроса имени у каталога кластера: True, False или None, если каталог недоступен."""
+        message, client = self.claiming.pop(name)
+        if client.closed:
+            if claimed:
+                self.cluster.release(name)
+            return
+        self.finish_presence(message, client, claimed)
+
+    def finish_presence(self, message, client, claimed):
+        if not claimed:
+            self.deliver(client, (NAME_TAKEN if claimed is False else DIRECTORY_UNAVAILABLE).frame_for(client))
+            self.close_after_flush(client)
+            return
+        client.name = message[USER][ACCOUNT_NAME]
+        self.names[client.name] = client
+        session = message.get(SESSION)
+        if isinstance(session, str):
+            client.session = session
+            client.last_message_id = self.dedup.restore(client.name, session)
+        self.contacts.touch(client.name)
+        self.stats['presences'] += 1
+        # Ответ на приветствие еще в JSON без сжатия, выбранные кодек и сжатие
+        # действуют со следующего кадра
+        codec = JSON_CODEC
+        compression = None
+        if client.protocol_version > LEGACY_PROTOCOL_VERSION:
+            codec = negotiate_codec(message.get(CODECS))
+            compression = negotiate_compression(message.get(COMPRESSIONS))
+        self.send_to(client, {
+            STATUS_CODE: 200,
+            STATUS: 'OK',
+            VERSION: client.protocol_version,
+            CODEC: codec.name,
+            COMPRESSION: compression and compression.name
+        })
+        client.set_codec(codec)
+        if compression is not None:
+            client.set_compression(compression, accepted_compressions(message.get(COMPRESSIONS)))
+        self.timers.cancel(client.timer)
+        # Клиенты первой версии не знают о ping, их проверяет только TCP keepalive
+        if self.ping_interval and client.protocol_version > LEGACY_PROTOCOL_VERSION:
+            client.timer = self.timers.schedule(self.now, self.ping_interval, self.check_idle, client)
+        if self.offline is not None and self.offline.has_mail(client.name):
+            client.mailbox = True
+            self.deliver_offline(client)
+
+    @actions.action(MESSAGE, {TIME: None, MESSAGE_TEXT: None, DESTINATION: str, SENDER: str}, named=True)
+    def handle_message(self, message, client):
+        # Сюда же попадают кадры, отклоненные быстрым путем, в том числе с чужим отправителем
+        if message[SENDER] != client.name:
+            self.deliver(client, FORGED_SENDER.frame_for(client))
             return
-        elif ACTION in message and message[ACTION] == MESSAGE \
-                and TIME in message and MESSAGE_TEXT in message \
-                and DESTINATION in message and SENDER in message:
-            self.messages.append(message)
+        if MESSAGE_ID in message and self.is_duplicate(client, message[MESSAGE_ID]):
             return
-        elif ACTION in message and message[ACTION] == EXIT and ACCOUNT_NAME in message:
-            self.clients.remove(self.names[message[ACCOUNT_NAME]])
-            self.names[message[ACCOUNT_NAME]].close()
-            del self.names[message[ACCOUNT_NAME]]
+        self.messages.append((message, client))
+
+    def is_duplicate(self, client, message_id):
+        """Проверяет номер сообщения клиента: True - повтор уже принятого сообщения, его нужно отбросить."""
+        if client.session is None or type(message_id) is not int:
+            return False
+        if message_id <= client.last_message_id:
+            self.stats['duplicate_messages'] += 1
+            return True
+        client.last_message_id = message_id
+        return False
+
+    @actions.action(ACK, {DESTINATION: str, MESSAGE_ID: int}, named=True)
+    def handle_ack(self, message, client):
+        """Передает отправителю подтверждение получения его сообщений с номерами до MESSAGE_ID.
+
+        Подтверждение, не заставшее отправителя в сети, теряется: следующее
+        накопительное подтверждение того же получателя покроет и эти сообщения.
+        """
+        message[SENDER] = client.name
+        receiver = self.names.get(message[DESTINATION])
+        if receiver is not None:
+            self.send_to(receiver, message)
+        elif self.cluster is not None:
+            self.cluster.forward(message)
+        self.stats['acks'] += 1
+
+    @actions.action(PING)
+    def handle_ping(self, message, client):
+        self.send_to(client, {ACTION: PONG, TIME: message.get(TIME)})
+
+    @actions.action(PONG)
+    def handle_pong(self, message, client):
+        # Время ответа уже учтено в last_seen при чтении
+        pass
+
+    @actions.action(JOIN, {ROOM: None}, named=True)
+    def handle_join(self, message, client):
+        room = message[ROOM]
+        if not is_room_name(room):
+            self.respond(client, message, BAD_ROOM_NAME)
+            return
+        if self.cluster is not None:
+            # Участники комнаты хранятся в каждом процессе отдельно, сообщения в комнату между
+            # рабочими процессами и узлами не пересылаются
+            self.respond(client, message, ROOMS_UNAVAILABLE)
             return
+        self.rooms.join(room, client)
+        self.respond(client, message, {STATUS_CODE: 200, STATUS: 'OK', ROOM: room})
+
+    @actions.action(LEAVE, {ROOM: None}, named=True)
+    def handle_leave(self, message, client):
+        room = message[ROOM]
+        if not is_room_name(room):
+            self.respond(client, message, BAD_ROOM_NAME)
+        elif self.rooms.leave(room, client):
+            self.respond(client, message, {STATUS_CODE: 200, STATUS: 'OK', ROOM: room})
         else:
-            send_message(client, {
-                STATUS_CODE: 400,
-                STATUS: 'Bad Request',
-                ERROR: 'Некоректный запрос'
+            self.respond(client, message, {
+                STATUS_CODE: 404,
+                STATUS: 'Not Found',
+                ERROR: f'Вы не состоите в комнате {room}'
             })
+
+    @actions.action(CONTACTS, named=True)
+    def handle_contacts(self, message, client):
+        """Отвечает снимком списка пользователей в сети и подписывает на его изменения."""
+        if message.get(SUBSCRIBE, True):
+            self.contacts.subscribe(client)
+        else:
+            self.contacts.unsubscribe(client)
+        if REQUEST_ID in message:
+            self.respond(client, message, self.contacts.snapshot())
+        else:
+            self.deliver(client, self.contacts.frame_for(client))
+
+    @actions.action(EXIT, {ACCOUNT_NAME: None}, named=True)
+    def handle_exit(self, message, client):
+        # Клиент может отключить только себя
+        if message[ACCOUNT_NAME] != client.name:
+            self.respond(client, message, BAD_REQUEST)
             return
+        self.remove_client(client)
 
     @log
-    def process_message(self, message, socks):
-        if message[DESTINATION] in self.names and self.names[message[DESTINATION]] in socks:
-            send_message(self.names[message[DESTINATION]], message)
-            SERVER_LOGGER.info(f'Отправленно сообщение пользователю {message[DESTINATION]} '
-                               f'от пользователя {message[SENDER]}')
-        elif message[DESTINATION] in self.names and self.names[message[DESTINATION]] not in socks:
-            raise ConnectionError
+    def process_message(self, message, sender=None):
+        if message[DESTINATION].startswith(ROOM_PREFIX):
+            self.process_room_message(message, sender)
+            return
+        receiver = self.names.get(message[DESTINATION])
+        if receiver is not None and receiver.mailbox:
+            # Пока не доставлен почтовый ящик, новые сообщения встают за ним в очередь
+            self.offline.store(message, message[DESTINATION])
+        elif receiver is not None:
+            self.send_to(receiver, message, sender)
+            if sender is not None:
+                self.relay_time.observe(time.perf_counter() - sender.received_at)
+            self.stats['relayed_messages'] += 1
+            SERVER_LOGGER.info('Отправленно сообщение пользователю %s от пользователя %s',
+                               message[DESTINATION], message[SENDER])
+        elif self.cluster is not None and self.cluster.forward(message, sender):
+            SERVER_LOGGER.info('Сообщение пользователю %s передано другому рабочему процессу',
+                               message[DESTINATION])
+        elif self.offline is not None:
+            self.offline.store(message, message[DESTINATION])
+            self.stats['offline_stored'] += 1
+            SERVER_LOGGER.info('Пользователь %s не в сети, сообщение сохранено в почтовый ящик',
+                               message[DESTINATION])
         else:
+            self.stats['undeliverable_messages'] += 1
             SERVER_LOGGER.error(
                 f'Пользователь {message[DESTINATION]} не зарегистрирован на сервере, '
                 f'отправка сообщения невозможна.')
+            return
+        if self.history is not None:
+            self.history.record(message[SENDER], message[DESTINATION], message)
+
+    def process_room_message(self, message, sender=None):
+        room = self.rooms.get(message[DESTINATION])
+        if room is not None and (sender is None or sender in room.members):
+            self.publish(room, sender, message)
+            if self.history is not None:
+                self.history.record(message[SENDER], room.name, message)
+            SERVER_LOGGER.debug('Сообщение пользователя %s разослано в комнату %s (участников: %s)',
+                                message[SENDER], room.name, len(room.members))
+        elif sender is not None and not sender.closed:
+            self.send_to(sender, {
+                STATUS_CODE: 403,
+                STATUS: 'Forbidden',
+                ERROR: f'Вы не состоите в комнате {message[DESTINATION]}'
+            })
+
+    @actions.action(HISTORY, {DESTINATION: str}, named=True)
+    def send_history(self, message, client):
+        """Отвечает на запрос истории страницей сообщений и курсором следующей страницы."""
+        peer, limit, before = message[DESTINATION], message.get(LIMIT, HISTORY_PAGE_SIZE), message.get(BEFORE)
+        if self.history is None:
+            self.respond(client, message, HISTORY_DISABLED)
+        elif not isinstance(limit, int) or not 0 < limit <= HISTORY_MAX_PAGE_SIZE \
+                or before is not None and not (isinstance(before, list) and len(before) == 2 and
+                                               all(isinstance(value, (int, float)) for value in before)):
+            self.respond(client, message, BAD_HISTORY_REQUEST)
+        elif peer.startswith(ROOM_PREFIX) and client not in getattr(self.rooms.get(peer), 'members', ()):
+            self.respond(client, message, {
+                STATUS_CODE: 403,
+                STATUS: 'Forbidden',
+                ERROR: f'Вы не состоите в комнате {peer}'
+            })
+        else:
+            messages, cursor = self.history.query(client.name, peer, limit, before)
+            self.stats['history_queries'] += 1
+            self.respond(client, message, {
+                STATUS_CODE: 200,
+                STATUS: 'OK',
+                DESTINATION: peer,
+                MESSAGES: messages,
+                BEFORE: cursor
+            })
+
+
+# Сервер на asyncio с той же обработкой сообщений, что и основной
+class AsyncServer(Server):
+    def __init__(self, server_ip, server_port, **options):
+        # Данные, переданные транспорту asyncio, нельзя удалить выборочно, поэтому drop-oldest недоступна
+        if options.setdefault('overflow_policy', OVERFLOW_REJECT) == OVERFLOW_DROP_OLDEST:
+            raise ValueError('Политика drop-oldest не поддерживается сервером на asyncio')
+        super().__init__(server_ip, server_port, **options)
+        self.async_server = None
+        self.fanout_task = None
+        self.lag_task = None
+        self.timer_task = None
+        self.loop_lag = self.metrics.histogram(
+            'loop_lag_seconds', 'Задержка запуска задач циклом событий asyncio')
+
+    async def start(self):
+        """Запускает прием подключений в текущем цикле событий, не блокируя его."""
+        SERVER_LOGGER.info(f'Запущен сервер asyncio, адрес сервера: {self.server_ip} '
+                           f'порт для подключений: {self.server_port} ')
+        self.async_server = await asyncio.start_server(
+            self.handle_client, self.server_ip, self.server_port, backlog=LISTEN_BACKLOG)
+        self.sock = self.async_server.sockets[0]
+        self.lag_task = asyncio.get_running_loop().create_task(self.measure_loop_lag())
+        self.timer_task = asyncio.get_running_loop().create_task(self.run_timers())
+        self.start_admin()
+
+    async def run_timers(self):
+        while True:
+            await asyncio.sleep(TIMER_RESOLUTION)
+            self.now = time.monotonic()
+            self.profiler.tick()
+            self.timers.run(self.now)
+
+    async def measure_loop_lag(self, interval=0.1):
+        # Итерации цикла asyncio недоступны, поэтому измеряется, насколько позже срока просыпается задача
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + interval
+            await asyncio.sleep(interval)
+            self.loop_lag.observe(max(loop.time() - expected, 0))
+
+    async def serve_forever(self):
+        await self.start()
+        async with self.async_server:
+            await self.async_server.serve_forever()
+
+    def close(self):
+        if self.offline is not None:
+            self.offline.close()
+        if self.history is not None:
+            self.history.close()
+        for task in (self.lag_task, self.timer_task):
+            if task is not None:
+                task.cancel()
+        self.stop_admin()
+        for client in list(self.clients):
+            self.remove_client(client)
+        if self.async_server is not None:
+            self.async_server.close()
+
+    def confirm_offline_later(self, client):
+        """Ждет записи последних кадров почтового ящика: транспорт asyncio отправляет их без участия сервера."""
+        client.offline_timer = None
+        if client.closed:
+            return
+        self.confirm_offline(client)
+        if client.offline_marks:
+            client.offline_timer = self.timers.schedule(self.now, TIMER_RESOLUTION, self.confirm_offline_later,
+                                                        client)
+
+    async def handle_client(self, reader, writer):
+        started = time.perf_counter()
+        client = AsyncClientConnection(reader, writer, self.stats)
+        self.stats['connections'] += 1
+        client.set_watermarks(self.high_watermark, self.low_watermark)
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            self.set_keepalive(sock)
+        self.now = time.monotonic()
+        self.start_timers(client)
+        SERVER_LOGGER.info(f'Подключен клиент с адресом {client.addr}')
+        self.clients.add(client)
+        self.accept_time.observe(time.perf_counter() - started)
+        try:
+            while not client.closed and not client.closing:
+                frames = await client.read()
+                self.now = client.last_seen = time.monotonic()
+                while True:
+                    unfinished = self.process_frames(client, frames)
+                    self.process_messages()
+                    if client.throttled:
+                        await asyncio.sleep(client.throttle_delay)
+                        client.throttled = False
+                    elif not unfinished or client.closed or client.closing:
+                        break
+                    else:
+                        # Доля соединения исчерпана: цикл событий обслуживает остальных
+                        await asyncio.sleep(0)
+                    self.now = time.monotonic()
+                while client.mailbox and not client.closed:
+                    await client.writer.drain()
+                    self.confirm_offline(client)
+                    self.deliver_offline(client)
+                if client.offline_marks and client.offline_timer is None:
+                    self.confirm_offline_later(client)
+                # Не читаем дальше, пока перегруженные получатели не разгрузят буферы
+                while client.congested:
+                    receiver = client.congested.pop()
+                    if not receiver.closed:
+                        try:
+                            await receiver.writer.drain()
+                        except ConnectionError:
+                            pass
+        except Exception:
+            SERVER_LOGGER.info(f'Клиент {client.addr} отключился от сервера.')
+        finally:
+            self.remove_client(client)
+
+    def deliver(self, client, frame, sender=None):
+        overflow = client.out_bytes + len(frame) - self.queue_limit
+        if overflow > 0 and not self.handle_overflow(client, frame, sender, overflow):
+            return False
+        # Транспорт asyncio пишет в сокет прямо из write, если буфер пуст
+        started = time.perf_counter()
+        client.queue_frame(frame)
+        self.send_time.observe(time.perf_counter() - started)
+        if sender is not None and sender is not client and client.out_bytes > self.high_watermark:
+            self.pause_sender(sender, client)
+        return True
+
+    def schedule_fanouts(self):
+        if self.fanout_task is None:
+            self.fanout_task = asyncio.get_running_loop().create_task(self.fanout_loop())
+
+    async def fanout_loop(self):
+        try:
+            while self.fanouts:
+                self.run_fanouts()
+                # Между частями рассылки цикл событий обслуживает остальные соединения
+                await asyncio.sleep(0)
+        finally:
+            self.fanout_task = None
+
+    def pause_sender(self, sender, client):
+        sender.congested.add(client)
+
+    def resume_senders(self, client):
+        pass
+
+    def close_after_flush(self, client):
+        client.closing = True
+
+    def throttle(self, client, delay):
+        # Пауза выдерживается в задаче соединения, чтение на это время останавливается само
+        client.throttled = True
+        client.throttle_delay = delay
+        self.stats['throttled_clients'] += 1
+
+    def remove_client(self, client):
+        if client.closed:
+            return
+        self.clients.discard(client)
+        self.release_name(client)
+        self.rooms.leave_all(client)
+        self.timers.cancel(client.timer)
+        client.close()
+
+    @log
+    def main_loop(self):
+        run_event_loop(self.serve_forever())
+
+
+def run_event_loop(coro):
+    try:
+        import uvloop
+    except ImportError:
+        SERVER_LOGGER.info('uvloop не установлен, используется стандартный цикл событий asyncio.')
+        return asyncio.run(coro)
+    with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
+        return runner.run(coro)
 
 
 def main():
-    server_ip, server_port = arg_parser()
+    namespace = arg_parser()
+
+    server_class = AsyncServer if namespace.engine == 'asyncio' else Server
+    offline = None
+    history = None
+    admin_address = namespace.admin_port if namespace.admin_port is not None else namespace.admin_socket
+    if namespace.offline_dir is not None:
+        offline = OfflineStore(namespace.offline_dir, segment_size=namespace.offline_segment_size,
+                               retention=namespace.offline_retention)
+    if namespace.history_db is not None:
+        history = MessageHistory(namespace.history_db)
+    rate_limiter = None
+    if namespace.rate_limit or namespace.ip_rate_limit:
+        rate_limiter = RateLimiter(namespace.rate_limit, namespace.rate_burst,
+                                   namespace.ip_rate_limit, namespace.ip_rate_burst)
+
+    def make_server():
+        server = server_class(namespace.a, namespace.p, offline=offline, history=history,
+                              admin_address=admin_address,
+                              ping_interval=namespace.ping_interval,
+                              idle_timeout=namespace.idle_timeout,
+                              handshake_timeout=namespace.handshake_timeout,
+                              rate_limiter=rate_limiter,
+                              rate_limit_policy=namespace.rate_limit_policy,
+                              fair_quantum=namespace.fair_quantum,
+                              queue_limit=namespace.queue_limit,
+                              high_watermark=namespace.high_watermark,
+                              low_watermark=namespace.low_watermark,
+                              overflow_policy=namespace.overflow_policy,
+                              profile_dir=namespace.profile_dir,
+                              write_batch_frames=namespace.write_batch_frames)
+        # Каждый рабочий процесс профилируется отдельно: сигнал посылается его pid
+        install_profile_signals(server.profiler, namespace.profile_seconds)
+        return server
 
-    server = Server(server_ip, server_port)
-    server.main_loop()
+    if namespace.workers > 1:
+        run_workers(namespace.workers, make_server)
+    else:
+        server = make_server()
+        if namespace.node_id is not None:
+            server.cluster = FederationCluster(namespace.node_id, namespace.node_listen, namespace.node_peer)
+        server.main_loop()
 
 
 if __name__ == "__main__":
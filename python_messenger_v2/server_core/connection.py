@@ -0,0 +1,221 @@
+import selectors
+import socket
+import time
+from abc import ABC, abstractmethod
+from collections import deque, Counter
+from common.variables import LEGACY_PROTOCOL_VERSION, RECV_BUFFER_SIZE, WRITE_BATCH_FRAMES, WRITE_BATCH_SIZE
+from common.utils import MessageDecoder, encode_message
+from common.message_codecs import JSON_CODEC
+
+# Без sendmsg (Windows) пачка кадров склеивается в один буфер
+HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
+
+
+class BaseConnection(ABC):
+    """Общее состояние клиентского соединения, не зависящее от способа ввода-вывода."""
+    is_peer = False
+
+    def __init__(self, addr, stats=None):
+        self.addr = addr
+        # Счетчики сервера, в которые соединение добавляет принятые и отправленные байты
+        self.stats = Counter() if stats is None else stats
+        # Имя пользователя, под которым клиент представился
+        self.name = None
+        self.protocol_version = LEGACY_PROTOCOL_VERSION
+        self.codec = JSON_CODEC
+        # Алгоритм сжатия кадров для клиента и номера всех алгоритмов, которые клиент умеет распаковать
+        self.compression = None
+        self.compressions = frozenset()
+        self.decoder = MessageDecoder()
+        self.closed = False
+        # Время последнего чтения (perf_counter): от него отсчитывается время пересылки принятых сообщений.
+        # Пока не разобраны прочитанные кадры, чтение приостановлено, поэтому время относится ко всем им
+        self.received_at = 0.0
+        # В почтовом ящике пользователя остались недоставленные сообщения
+        self.mailbox = False
+        # Комнаты, в которых состоит клиент
+        self.rooms = set()
+        # Время последних принятых данных и таймер проверки живости соединения
+        self.last_seen = 0.0
+        self.timer = None
+        # Принятые данные разобраны не до конца и ждут своей очереди в цикле сервера
+        self.backlogged = False
+        # Клиент превысил частоту сообщений: чтение приостановлено, а отложенный кадр
+        # (пара кадр, сообщение) будет обработан первым после паузы throttle_delay
+        self.throttled = False
+        self.throttle_delay = 0
+        self.held_frame = None
+        # Сеанс клиента из приветствия и номер последнего принятого от него сообщения:
+        # сообщения с номерами не больше него - повторы после переподключения
+        self.session = None
+        self.last_message_id = 0
+        # Байты, поставленные в очередь за все время соединения; номер последнего сообщения
+        # почтового ящика, отправленного клиенту, и отметки (позиция в потоке байт, номер):
+        # сообщения до номера доставлены, когда в сокет записано queued_total байт до позиции
+        self.queued_total = 0
+        self.offline_cursor = 0
+        self.offline_marks = deque()
+
+    def set_codec(self, codec):
+        self.codec = self.decoder.codec = codec
+
+    def set_compression(self, compression, compressions):
+        self.compression = compression
+        self.compressions = compressions
+
+    def encode(self, message):
+        return encode_message(message, self.protocol_version, self.codec, self.compression)
+
+    def send_message(self, message):
+        self.queue_frame(self.encode(message))
+
+    @abstractmethod
+    def queue_frame(self, frame):
+        """Ставит готовый кадр в очередь на отправку клиенту."""
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {self.name or "-"} {self.addr}>'
+
+
+class ClientConnection(BaseConnection):
+    """Неблокирующее соединение для цикла на selectors.
+
+    Исходящие кадры накапливаются в очереди и отправляются, когда сокет
+    готов к записи; интерес к записи регистрируется только пока очередь не пуста.
+    Все кадры, накопленные за итерацию цикла, уходят одним вызовом sendmsg
+    (до write_batch_frames кадров и WRITE_BATCH_SIZE байт) без копирования
+    в общий буфер.
+    """
+
+    def __init__(self, sock, addr, stats=None, write_batch_frames=WRITE_BATCH_FRAMES):
+        super().__init__(addr, stats)
+        self.sock = sock
+        self.write_batch_frames = write_batch_frames
+        self.out_queue = deque()
+        # Объем неотправленных данных и смещение в частично отправленном первом кадре
+        self.out_bytes = 0
+        self.out_offset = 0
+        # Байты, записанные в сокет или отброшенные политикой переполнения
+        self.written_total = 0
+        # Закрыть соединение после отправки очереди
+        self.closing = False
+        self.events = selectors.EVENT_READ
+        # Чтение приостановлено, пока перегружены получатели из blocked_by
+        self.paused = False
+        self.blocked_by = set()
+        # Отправители, приостановленные из-за переполнения этого соединения
+        self.blocked_senders = set()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def queue_frame(self, frame):
+        self.out_queue.append(frame)
+        self.out_bytes += len(frame)
+        self.queued_total += len(frame)
+
+    def drop_oldest(self, nbytes):
+        """Удаляет самые старые неотправленные кадры, пока не освободится nbytes байт."""
+        out_queue = self.out_queue
+        started = out_queue.popleft() if self.out_offset else None
+        dropped = freed = 0
+        while out_queue and freed < nbytes:
+            freed += len(out_queue.popleft())
+            dropped += 1
+        if started is not None:
+            out_queue.appendleft(started)
+        self.out_bytes -= freed
+        self.written_total += freed
+        return dropped
+
+    def read(self):
+        received = self.decoder.recv_into(self.sock)
+        if not received:
+            raise ConnectionResetError('Соединение закрыто удаленной стороной')
+        self.received_at = time.perf_counter()
+        self.stats['bytes_in'] += received
+        return self.decoder.frames()
+
+    def flush(self):
+        """Отправляет сколько возможно; возвращает True, если очередь опустела."""
+        out_queue = self.out_queue
+        limit = self.write_batch_frames
+        while out_queue:
+            buffers = []
+            size = -self.out_offset
+            for frame in out_queue:
+                buffers.append(frame)
+                size += len(frame)
+                if size >= WRITE_BATCH_SIZE or len(buffers) >= limit:
+                    break
+            if self.out_offset:
+                buffers[0] = memoryview(buffers[0])[self.out_offset:]
+            try:
+                sent = self.sock.sendmsg(buffers) if HAS_SENDMSG else self.sock.send(b''.join(buffers))
+            except (BlockingIOError, InterruptedError):
+                return False
+            self.stats['write_calls'] += 1
+            self.out_bytes -= sent
+            self.written_total += sent
+            self.stats['bytes_out'] += sent
+            if sent < size:
+                # Буфер сокета заполнен: отправленные целиком кадры удаляются, в первом оставшемся запоминается смещение
+                offset = self.out_offset + sent
+                while offset >= len(out_queue[0]):
+                    offset -= len(out_queue.popleft())
+                self.out_offset = offset
+                return False
+            for _ in range(len(buffers)):
+                out_queue.popleft()
+            self.out_offset = 0
+        return True
+
+    def close(self):
+        self.closed = True
+        self.sock.close()
+
+
+class AsyncClientConnection(BaseConnection):
+    """Соединение для сервера на asyncio поверх потоков чтения и записи."""
+
+    def __init__(self, reader, writer, stats=None):
+        super().__init__(writer.get_extra_info('peername'), stats)
+        self.reader = reader
+        self.writer = writer
+        self.closing = False
+        # Получатели, буфер записи которых превысил верхнюю границу
+        self.congested = set()
+        # Проверка записи последних кадров почтового ящика, которые транспорт отправляет сам
+        self.offline_timer = None
+
+    @property
+    def out_bytes(self):
+        return self.writer.transport.get_write_buffer_size()
+
+    @property
+    def written_total(self):
+        return self.queued_total - self.out_bytes
+
+    def set_watermarks(self, high_watermark, low_watermark):
+        self.writer.transport.set_write_buffer_limits(high=high_watermark, low=low_watermark)
+
+    def queue_frame(self, frame):
+        if not self.writer.is_closing():
+            # Транспорт отправляет данные сам, поэтому учитываются байты, переданные ему
+            self.stats['bytes_out'] += len(frame)
+            self.queued_total += len(frame)
+            self.writer.write(frame)
+
+    async def read(self):
+        data = await self.reader.read(RECV_BUFFER_SIZE)
+        if not data:
+            raise ConnectionResetError('Соединение закрыто удаленной стороной')
+        self.received_at = time.perf_counter()
+        self.stats['bytes_in'] += len(data)
+        self.decoder.append(data)
+        return self.decoder.frames()
+
+    def close(self):
+        self.closed = True
+        # Транспорт отправит оставшиеся в буфере данные перед закрытием
+        self.writer.close()
@@ -0,0 +1,89 @@
+from common.variables import ACTION, CONTACTS, REVISION, USERS, JOINED, LEFT, STATUS_CODE, STATUS, \
+    CONTACTS_SYNC_INTERVAL
+from server_core.rooms import Room, FanOut
+
+
+class ContactDirectory:
+    """Список пользователей в сети с номером версии и рассылкой изменений подписчикам.
+
+    Вход и выход пользователя только отмечают имя; раз в interval секунд
+    отмеченные имена сверяются с Server.names (и с пользователями других
+    процессов или узлов), и если список изменился, версия увеличивается на
+    единицу, а подписчикам уходит одна рассылка с вошедшими и вышедшими.
+    Поэтому волна из тысяч переподключений дает подписчику несколько
+    сообщений, а не по сообщению на каждого пользователя.
+
+    Снимок отдается на версию последней рассылки, и его кадр кодируется один
+    раз для каждого формата клиента, пока версия не изменится. Изменение
+    с версией revision клиент применяет поверх снимка версии revision - 1;
+    пропуск версии (изменение отброшено при переполнении очереди) означает,
+    что снимок нужно запросить заново.
+    """
+
+    def __init__(self, server, interval=CONTACTS_SYNC_INTERVAL):
+        self.server = server
+        self.interval = interval
+        self.revision = 0
+        # Пользователи в сети на версию revision
+        self.published = set()
+        # Имена, которые могли войти или выйти после последней рассылки
+        self.touched = set()
+        self.timer = None
+        # Подписчики - участники комнаты, не зарегистрированной в RoomRegistry
+        self.subscribers = Room(CONTACTS)
+        self.frames = dict()
+
+    def is_online(self, name):
+        cluster = self.server.cluster
+        return name in self.server.names or cluster is not None and cluster.has_user(name)
+
+    def touch(self, name):
+        self.touched.add(name)
+        if self.timer is None:
+            self.timer = self.server.timers.schedule(self.server.now, self.interval, self.flush)
+
+    def subscribe(self, client):
+        self.subscribers.members.add(client)
+
+    def unsubscribe(self, client):
+        self.subscribers.members.discard(client)
+
+    def snapshot(self):
+        return {
+            STATUS_CODE: 200,
+            STATUS: 'OK',
+            REVISION: self.revision,
+            USERS: sorted(self.published)
+        }
+
+    def frame_for(self, client):
+        """Кадр ответа со снимком списка текущей версии в формате клиента."""
+        key = client.protocol_version, client.codec, client.compression
+        frame = self.frames.get(key)
+        if frame is None:
+            frame = self.frames[key] = client.encode(self.snapshot())
+        return frame
+
+    def flush(self):
+        self.timer = None
+        published = self.published
+        joined = []
+        left = []
+        for name in self.touched:
+            online = self.is_online(name)
+            if online and name not in published:
+                published.add(name)
+                joined.append(name)
+            elif not online and name in published:
+                published.discard(name)
+                left.append(name)
+        self.touched.clear()
+        if not joined and not left:
+            return
+        self.revision += 1
+        self.frames.clear()
+        self.server.stats['contact_updates'] += 1
+        if self.subscribers.members:
+            update = {ACTION: CONTACTS, REVISION: self.revision, JOINED: sorted(joined), LEFT: sorted(left)}
+            self.server.fanouts.append(FanOut(self.subscribers, None, update))
+            self.server.schedule_fanouts()
@@ -0,0 +1,41 @@
+from collections import OrderedDict
+from common.variables import DEDUP_SENDERS
+
+
+class SenderWindows:
+    """Последние номера сообщений отключившихся отправителей для отбрасывания повторов.
+
+    Пока клиент подключен, номер его последнего сообщения хранится в самом
+    соединении (last_message_id), и проверка повтора - одно сравнение. При
+    отключении номер переносится сюда вместе с сеансом клиента и
+    возвращается соединению, если тот же сеанс переподключится: сообщения,
+    повторно отправленные после обрыва, с номерами не больше сохраненного
+    отбрасываются. Хранится не больше limit отправителей, самые давние
+    вытесняются.
+
+    Номера хранятся только в памяти своего процесса и между рабочими
+    процессами (--workers) и узлами кластера (--node-id) не передаются:
+    если клиент переподключился к другому процессу, повторно отправленные
+    сообщения доставляются еще раз. Повторы гарантированно отбрасываются
+    только в режиме одного процесса.
+    """
+
+    def __init__(self, limit=DEDUP_SENDERS):
+        self.limit = limit
+        # {имя: (сеанс, последний номер)} в порядке отключения
+        self.senders = OrderedDict()
+
+    def save(self, name, session, last_id):
+        if session is None or not last_id:
+            return
+        self.senders[name] = session, last_id
+        self.senders.move_to_end(name)
+        if len(self.senders) > self.limit:
+            self.senders.popitem(last=False)
+
+    def restore(self, name, session):
+        """Последний номер сеанса session пользователя name или 0, если сеанс новый."""
+        entry = self.senders.pop(name, None)
+        if entry is None or session is None or entry[0] != session:
+            return 0
+        return entry[1]
@@ -0,0 +1,81 @@
+from common.utils import encode_message
+
+
+def compile_schema(schema, named=False):
+    """Собирает функцию проверки validate(message, client) по схеме действия.
+
+    Схема - словарь {поле: тип, кортеж типов или None}; все поля обязательны,
+    None означает поле любого типа, named - действие только для представившихся
+    клиентов. Проверка генерируется одним выражением с именами полей в виде
+    констант, без цикла по схеме при каждом сообщении.
+    """
+    namespace = dict()
+    checks = []
+    for number, (field, types) in enumerate(schema.items()):
+        if types is None:
+            checks.append(f'{field!r} in message')
+            continue
+        namespace[f'types_{number}'] = types
+        if isinstance(None, types):
+            checks.append(f'{field!r} in message')
+        checks.append(f'isinstance(message.get({field!r}), types_{number})')
+    if named:
+        checks.append('client.name is not None')
+    source = f'def validate(message, client):\n    return {" and ".join(checks) or "True"}\n'
+    exec(source, namespace)
+    return namespace['validate']
+
+
+def _reject(message, client):
+    return False
+
+
+# Запись таблицы для неизвестного действия: проверка не проходит никогда
+UNKNOWN_ACTION = _reject, None
+
+
+class ActionRegistry:
+    """Таблица действий протокола: схема сообщения и метод-обработчик для каждого действия.
+
+    Обработчики объявляются декоратором action в классе сервера, а bind
+    связывает таблицу с экземпляром, учитывая переопределения в подклассах.
+    """
+
+    def __init__(self, actions=None):
+        self.actions = dict(actions or {})
+
+    def copy(self):
+        return ActionRegistry(self.actions)
+
+    def action(self, name, schema=None, named=False):
+        """Регистрирует обработчик действия name; named - только для представившихся клиентов."""
+        validate = compile_schema(schema or {}, named)
+
+        def register(handler):
+            self.actions[name] = handler.__name__, validate
+            return handler
+
+        return register
+
+    def bind(self, owner):
+        """Словарь {действие: (проверка, связанный обработчик)} для экземпляра owner."""
+        return {name: (validate, getattr(owner, method)) for name, (method, validate) in self.actions.items()}
+
+
+class CannedResponse:
+    """Неизменный ответ, закодированный один раз для каждой версии протокола и кодека.
+
+    Такие ответы короче порога сжатия, поэтому один кадр годится клиентам
+    с любым алгоритмом сжатия.
+    """
+
+    def __init__(self, message):
+        self.message = message
+        self.frames = dict()
+
+    def frame_for(self, client):
+        key = client.protocol_version, client.codec
+        frame = self.frames.get(key)
+        if frame is None:
+            frame = self.frames[key] = encode_message(self.message, *key)
+        return frame
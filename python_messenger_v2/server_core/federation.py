@@ -0,0 +1,300 @@
+import errno
+import logging
+import socket
+import selectors
+from common.variables import ACTION, ACCOUNT_NAME, MESSAGE, DESTINATION, PEER_JOIN, PEER_LEAVE, CODEC, CODECS, \
+    NODE, NODE_HELLO, NODE_WELCOME, NODE_SYNC, NAME_CLAIM, NAME_CLAIMED, USERS, RESULT, NODE_RECONNECT_INTERVAL, \
+    LISTEN_BACKLOG, ACK
+from common.message_codecs import CODECS as AVAILABLE_CODECS, JSON_CODEC, negotiate_codec
+from server_core.workers import PeerConnection
+
+SERVER_LOGGER = logging.getLogger('server')
+
+
+class NodeLink(PeerConnection):
+    """Постоянный канал к другому узлу кластера, общий для сообщений всех пользователей.
+
+    До обмена приветствиями кадры кодируются в JSON, после него - кодеком,
+    выбранным принявшим подключение узлом. Номер узла на принимающей стороне
+    известен только после приветствия.
+    """
+
+    def __init__(self, sock, addr, node_id=None):
+        super().__init__(sock, node_id, addr)
+        self.set_codec(JSON_CODEC)
+        self.ready = False
+
+
+def parse_address(address):
+    """Разбирает адрес вида host:port."""
+    host, _, port = address.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+class FederationCluster:
+    """Узел кластера из нескольких серверов.
+
+    Узлы соединены попарно постоянными TCP-каналами: узел с большим номером
+    подключается к узлу с меньшим и переподключается после обрыва. Сообщение
+    пользователю другого узла уходит по каналу к этому узлу; кадры, накопленные
+    за итерацию цикла, отправляются пачкой.
+
+    Каталог пользователей ведет узел с наименьшим номером. Только он решает,
+    свободно ли имя, поэтому имя уникально во всем кластере, а приветствие
+    клиента другого узла завершается после ответа каталога. О каждом входе и
+    выходе каталог сообщает всем узлам, и те хранят у себя копию расположения
+    пользователей для маршрутизации. При обрыве канала к каталогу узел после
+    переподключения заново регистрирует своих пользователей; пока канала нет,
+    новые клиенты этого узла получают отказ.
+    """
+
+    def __init__(self, node_id, listen_address, peers):
+        self.node_id = node_id
+        self.listen_address = listen_address
+        # Адреса остальных узлов: {номер узла: (host, port)}
+        self.peer_addresses = dict(peers)
+        self.directory_id = min(node_id, *self.peer_addresses) if self.peer_addresses else node_id
+        # Каналы к узлам, обменявшимся приветствием
+        self.links = dict()
+        # Узлы, на которых находятся пользователи других узлов
+        self.locations = dict()
+        # Только у каталога: узлы всех пользователей кластера
+        self.directory = dict()
+        # Все каналы, включая еще не поприветствовавшие
+        self.connections = set()
+        # Имена, ждущие ответа каталога
+        self.pending = set()
+        self.server = None
+        self.sock = None
+        self.closed = False
+
+    @property
+    def is_directory(self):
+        return self.node_id == self.directory_id
+
+    def attach(self, server):
+        self.server = server
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(self.listen_address)
+        sock.listen(LISTEN_BACKLOG)
+        sock.setblocking(False)
+        self.sock = sock
+        server.selector.register(sock, selectors.EVENT_READ, self)
+        for node_id in self.peer_addresses:
+            if node_id < self.node_id:
+                self.connect(node_id)
+
+    def connect(self, node_id):
+        if self.closed:
+            return
+        address = self.peer_addresses[node_id]
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        code = sock.connect_ex(address)
+        # Подключение завершается в фоне: приветствие ждет в очереди, пока сокет не станет доступен для записи
+        if code not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            SERVER_LOGGER.error(f'Не удалось подключиться к узлу {node_id} {address}: {errno.errorcode.get(code)}')
+            self.schedule_reconnect(node_id)
+            return
+        link = NodeLink(sock, address, node_id)
+        self.connections.add(link)
+        self.server.selector.register(sock, link.events, link)
+        self.server.send_to(link, {ACTION: NODE_HELLO, NODE: self.node_id, CODECS: list(AVAILABLE_CODECS)})
+
+    def schedule_reconnect(self, node_id):
+        if not self.closed:
+            self.server.timers.schedule(self.server.now, NODE_RECONNECT_INTERVAL, self.connect, node_id)
+
+    def accept_nodes(self):
+        while True:
+            try:
+                sock, addr = self.sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as err:
+                SERVER_LOGGER.error(f'Ошибка при подключении узла: {err}')
+                return
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            link = NodeLink(sock, addr)
+            self.connections.add(link)
+            self.server.selector.register(sock, link.events, link)
+
+    def claim(self, name):
+        """Занимает имя во всем кластере.
+
+        Возвращает True или False, если ответ известен сразу (узел - каталог),
+        и None, если запрос отправлен каталогу и ответ придет в server.claim_done.
+        """
+        if self.is_directory:
+            return self.join(name, self.node_id)
+        link = self.links.get(self.directory_id)
+        if link is None:
+            raise ConnectionError('Каталог пользователей недоступен')
+        self.pending.add(name)
+        self.server.send_to(link, {ACTION: NAME_CLAIM, ACCOUNT_NAME: name, NODE: self.node_id})
+        return None
+
+    def release(self, name):
+        if self.is_directory:
+            self.leave(name, self.node_id)
+            return
+        link = self.links.get(self.directory_id)
+        if link is not None:
+            self.server.send_to(link, {ACTION: PEER_LEAVE, ACCOUNT_NAME: name, NODE: self.node_id})
+
+    def join(self, name, node_id, requester=None):
+        """Каталог: регистрирует пользователя узла node_id, если имя свободно."""
+        owner = self.directory.get(name)
+        if owner is not None and owner != node_id:
+            return False
+        self.directory[name] = node_id
+        if node_id != self.node_id:
+            self.locations[name] = node_id
+            self.server.contacts.touch(name)
+        self.broadcast({ACTION: PEER_JOIN, ACCOUNT_NAME: name, NODE: node_id}, exclude=requester)
+        return True
+
+    def leave(self, name, node_id):
+        """Каталог: снимает регистрацию пользователя узла node_id."""
+        if self.directory.get(name) != node_id:
+            return
+        del self.directory[name]
+        if self.locations.pop(name, None) is not None:
+            self.server.contacts.touch(name)
+        self.broadcast({ACTION: PEER_LEAVE, ACCOUNT_NAME: name, NODE: node_id})
+
+    def broadcast(self, message, exclude=None):
+        for link in self.links.values():
+            if link is not exclude:
+                self.server.send_to(link, message)
+
+    def has_user(self, name):
+        return name in self.locations
+
+    def forward(self, message, sender=None):
+        """Передает сообщение узлу, на котором находится получатель."""
+        link = self.links.get(self.locations.get(message[DESTINATION]))
+        if link is None:
+            return False
+        return self.server.send_to(link, message, sender)
+
+    def process_peer_message(self, message, link):
+        if not link.ready:
+            self.process_handshake(message, link)
+            return
+        action = message.get(ACTION)
+        if action == MESSAGE:
+            receiver = self.server.names.get(message[DESTINATION])
+            if receiver is not None:
+                self.server.send_to(receiver, message)
+            elif self.server.offline is not None:
+                self.server.offline.store(message, message[DESTINATION])
+                self.server.stats['offline_stored'] += 1
+            else:
+                SERVER_LOGGER.error(f'Пользователь {message[DESTINATION]} уже отключился, '
+                                    f'сообщение от узла {link.peer_id} не доставлено.')
+        elif action == ACK:
+            # Подтверждение отключившемуся отправителю не нужно
+            receiver = self.server.names.get(message[DESTINATION])
+            if receiver is not None:
+                self.server.send_to(receiver, message)
+        elif action == PEER_JOIN:
+            if message[NODE] != self.node_id:
+                self.locations[message[ACCOUNT_NAME]] = message[NODE]
+                self.server.contacts.touch(message[ACCOUNT_NAME])
+        elif action == PEER_LEAVE:
+            if self.is_directory:
+                self.leave(message[ACCOUNT_NAME], message[NODE])
+            elif self.locations.get(message[ACCOUNT_NAME]) == message[NODE]:
+                del self.locations[message[ACCOUNT_NAME]]
+                self.server.contacts.touch(message[ACCOUNT_NAME])
+        elif action == NAME_CLAIM and self.is_directory:
+            name = message[ACCOUNT_NAME]
+            self.server.send_to(link, {ACTION: NAME_CLAIMED, ACCOUNT_NAME: name,
+                                       RESULT: self.join(name, message[NODE], link)})
+        elif action == NAME_CLAIMED:
+            self.claimed(message[ACCOUNT_NAME], message[RESULT])
+        elif action == NODE_SYNC:
+            for name, node_id in message[USERS].items():
+                if node_id != self.node_id:
+                    self.locations[name] = node_id
+                    self.server.contacts.touch(name)
+        else:
+            SERVER_LOGGER.error(f'Некорректное сообщение от узла {link.peer_id}: {message}')
+
+    def process_handshake(self, message, link):
+        action = message.get(ACTION)
+        if action == NODE_HELLO and link.peer_id is None and message.get(NODE) in self.peer_addresses:
+            # Принятое подключение: кодек выбирает этот узел
+            codec = negotiate_codec(message.get(CODECS))
+            link.peer_id = message[NODE]
+            self.server.send_to(link, {ACTION: NODE_WELCOME, NODE: self.node_id, CODEC: codec.name})
+            link.set_codec(codec)
+            self.link_ready(link)
+        elif action == NODE_WELCOME and message.get(NODE) == link.peer_id:
+            link.set_codec(AVAILABLE_CODECS.get(message.get(CODEC), JSON_CODEC))
+            self.link_ready(link)
+        else:
+            SERVER_LOGGER.error(f'Узел {link.addr} не прошел приветствие: {message}')
+            self.server.remove_client(link)
+
+    def link_ready(self, link):
+        old = self.links.get(link.peer_id)
+        link.ready = True
+        # Новая связь занимает место до закрытия старой, чтобы peer_lost не счел узел потерянным
+        self.links[link.peer_id] = link
+        if old is not None:
+            self.server.remove_client(old)
+        SERVER_LOGGER.info(f'Установлена связь с узлом {link.peer_id} {link.addr}.')
+        if self.is_directory:
+            self.server.send_to(link, {ACTION: NODE_SYNC, USERS: self.directory})
+        elif link.peer_id == self.directory_id:
+            # Каталог мог забыть пользователей этого узла, пока не было связи
+            for name in self.server.names:
+                self.server.send_to(link, {ACTION: NAME_CLAIM, ACCOUNT_NAME: name, NODE: self.node_id})
+
+    def claimed(self, name, result):
+        if name in self.pending:
+            self.pending.discard(name)
+            self.server.claim_done(name, result)
+        elif not result and name in self.server.names:
+            # Пока не было связи с каталогом, имя занял пользователь другого узла
+            SERVER_LOGGER.warning(f'Имя {name} занято на другом узле, клиент отключен.')
+            client = self.server.names.pop(name)
+            self.server.contacts.touch(name)
+            self.server.remove_client(client)
+
+    def peer_lost(self, link):
+        self.connections.discard(link)
+        node_id = link.peer_id
+        if node_id is None:
+            return
+        if self.links.get(node_id) is link:
+            del self.links[node_id]
+            SERVER_LOGGER.error(f'Потеряна связь с узлом {node_id}.')
+            for name, owner in list(self.locations.items()):
+                if owner == node_id:
+                    del self.locations[name]
+                    self.server.contacts.touch(name)
+            if self.is_directory:
+                for name, owner in list(self.directory.items()):
+                    if owner == node_id:
+                        self.leave(name, node_id)
+            if node_id == self.directory_id:
+                for name in self.pending:
+                    self.server.claim_done(name, None)
+                self.pending.clear()
+        if node_id < self.node_id and node_id not in self.links:
+            self.schedule_reconnect(node_id)
+
+    def close(self):
+        self.closed = True
+        for link in list(self.connections):
+            self.server.remove_client(link)
+        if self.sock is not None:
+            self.server.selector.unregister(self.sock)
+            self.sock.close()
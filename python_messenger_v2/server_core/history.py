@@ -0,0 +1,164 @@
+import logging
+import sqlite3
+import threading
+import time
+from common.variables import HISTORY_COMMIT_INTERVAL, ROOM_PREFIX
+from common.message_codecs import JSON_CODEC, get_codec
+
+SERVER_LOGGER = logging.getLogger('server')
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS messages ('
+    'id INTEGER PRIMARY KEY, sender TEXT NOT NULL, destination TEXT NOT NULL, '
+    'time REAL NOT NULL, codec TEXT NOT NULL, payload BLOB NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS messages_conversation ON messages (sender, destination, time)',
+    # Для комнат отправитель не известен заранее, поэтому история читается по получателю
+    'CREATE INDEX IF NOT EXISTS messages_room ON messages (destination, time)',
+)
+
+INSERT = 'INSERT OR IGNORE INTO messages (id, sender, destination, time, codec, payload) VALUES (?, ?, ?, ?, ?, ?)'
+
+# Страница идет назад от курсора (время, номер): индекс с неявным номером строки в конце
+# отдает строки уже в нужном порядке, поэтому читается только сама страница
+PAGE = ('SELECT id, time, codec, payload FROM messages '
+        'WHERE sender = ? AND destination = ? AND time <= ? AND (time < ? OR id < ?) '
+        'ORDER BY time DESC, id DESC LIMIT ?')
+ROOM_PAGE = ('SELECT id, time, codec, payload FROM messages '
+             'WHERE destination = ? AND time <= ? AND (time < ? OR id < ?) '
+             'ORDER BY time DESC, id DESC LIMIT ?')
+
+
+class MessageHistory:
+    """История сообщений в базе SQLite в режиме WAL.
+
+    Цикл сервера только добавляет запись в очередь в памяти; фоновый поток
+    вставляет накопившиеся записи одной транзакцией. Номера записей выдаются
+    сразу, поэтому запросы истории видят и еще не записанные сообщения.
+    Сообщения хранятся в том кодеке, в котором пришли: кадр быстрого пути
+    сохраняется без разбора, а раскодируется только при чтении истории.
+    """
+
+    def __init__(self, path, commit_interval=HISTORY_COMMIT_INTERVAL):
+        self.path = path
+        self.commit_interval = commit_interval
+
+        self.lock = threading.Lock()
+        self.commit_needed = threading.Condition(self.lock)
+        self.committed = threading.Condition(self.lock)
+        # Записи, еще не отданные потоку записи, и пачка, которую он сейчас записывает
+        self.pending = []
+        self.writing = []
+        self.stopping = False
+
+        # Соединение для чтения принадлежит циклу сервера, для записи - фоновому потоку
+        self.reader = self._connect()
+        for statement in SCHEMA:
+            self.reader.execute(statement)
+        self.next_id = (self.reader.execute('SELECT MAX(id) FROM messages').fetchone()[0] or 0) + 1
+        self.writer = threading.Thread(target=self.run_writer, name='history-writer', daemon=True)
+        self.writer.start()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        # В режиме WAL fsync при каждой фиксации не нужен для целостности базы
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def record(self, sender, destination, message=None, payload=None, codec=JSON_CODEC):
+        """Ставит сообщение в очередь на запись: словарь message или закодированный codec payload."""
+        if payload is not None:
+            # Кадр может ссылаться на буфер приема соединения
+            payload = bytes(payload)
+        with self.lock:
+            record_id = self.next_id
+            self.next_id += 1
+            self.pending.append((record_id, sender, destination, time.time(), codec, message, payload))
+            self.commit_needed.notify()
+        return record_id
+
+    @staticmethod
+    def _row(record):
+        record_id, sender, destination, record_time, codec, message, payload = record
+        if message is not None:
+            # Словарь кодируется в потоке записи, а не в цикле сервера
+            codec, payload = JSON_CODEC, JSON_CODEC.encode(message)
+        return record_id, sender, destination, record_time, codec.name, payload
+
+    def run_writer(self):
+        connection = self._connect()
+        while True:
+            with self.lock:
+                if not self.pending and not self.stopping:
+                    self.commit_needed.wait()
+                stopping = self.stopping
+                delay = self.pending and not stopping and self.commit_interval
+            if delay:
+                # Небольшая задержка собирает в одну транзакцию больше сообщений
+                time.sleep(delay)
+            self.commit(connection)
+            if stopping:
+                connection.close()
+                return
+
+    def commit(self, connection):
+        with self.lock:
+            self.writing, self.pending = self.pending, []
+            batch = self.writing
+        if batch:
+            try:
+                with connection:
+                    connection.execute('BEGIN')
+                    connection.executemany(INSERT, [self._row(record) for record in batch])
+            except sqlite3.Error as err:
+                SERVER_LOGGER.error(f'Ошибка записи истории сообщений: {err}, потеряно записей: {len(batch)}')
+        with self.lock:
+            self.writing = []
+            self.committed.notify_all()
+
+    def sync(self, timeout=None):
+        """Ждет записи всех принятых сообщений; возвращает False по истечении timeout."""
+        with self.lock:
+            self.commit_needed.notify()
+            return self.committed.wait_for(lambda: not self.pending and not self.writing, timeout)
+
+    def query(self, name, peer, limit, before=None):
+        """Страница переписки name с пользователем или комнатой peer, от новых к старым.
+
+        before - курсор (время, номер) из предыдущего ответа. Возвращает список
+        сообщений и курсор следующей страницы или None, если страница последняя.
+        """
+        before_time, before_id = before if before is not None else (float('inf'), 0)
+        if peer.startswith(ROOM_PREFIX):
+            conversations = ((peer,),)
+            statement = ROOM_PAGE
+        else:
+            conversations = ((name, peer), (peer, name))
+            statement = PAGE
+        # Записи в памяти копируются до чтения базы: записанное потоком в промежутке
+        # окажется и там, и там, и отбросится по номеру
+        with self.lock:
+            unwritten = [self._unwritten_row(record) for record in self.writing + self.pending
+                         if (record[2],) in conversations or (record[1], record[2]) in conversations]
+        rows = {row[0]: row for row in unwritten
+                if row[1] < before_time or row[1] == before_time and row[0] < before_id}
+        for conversation in conversations:
+            for row in self.reader.execute(statement, (*conversation, before_time, before_time, before_id, limit)):
+                rows.setdefault(row[0], row)
+        page = sorted(rows.values(), key=lambda row: (row[1], row[0]), reverse=True)[:limit]
+        messages = [get_codec(codec).decode(payload) for _, _, codec, payload in page]
+        cursor = [page[-1][1], page[-1][0]] if len(page) == limit else None
+        return messages, cursor
+
+    def _unwritten_row(self, record):
+        record_id, _, _, record_time, codec, message, payload = record
+        if message is not None:
+            return record_id, record_time, JSON_CODEC.name, JSON_CODEC.encode(message)
+        return record_id, record_time, codec.name, payload
+
+    def close(self):
+        with self.lock:
+            self.stopping = True
+            self.commit_needed.notify()
+        self.writer.join()
+        self.reader.close()
@@ -0,0 +1,203 @@
+import logging
+import os
+import socketserver
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from common.variables import PROFILE_SECONDS
+from server_core.profiling import PROFILE_MODES, PROFILE_SAMPLE
+
+SERVER_LOGGER = logging.getLogger('server')
+
+METRICS_PREFIX = 'messenger_'
+# Границы корзин гистограмм времени: от 1 мкс до ~8 с, каждая следующая вдвое больше
+TIME_BUCKETS = tuple(1e-6 * 2 ** power for power in range(24))
+
+# Пояснения к счетчикам Server.stats; счетчики без пояснения выводятся под своим именем
+COUNTER_HELP = {
+    'connections': 'Принятые подключения',
+    'presences': 'Успешные приветствия',
+    'relayed_messages': 'Сообщения, переданные получателю после разбора',
+    'relayed_frames': 'Кадры, переданные получателю без разбора',
+    'undeliverable_messages': 'Сообщения неизвестным пользователям',
+    'dropped_messages': 'Сообщения, отброшенные при переполнении очереди',
+    'rejected_messages': 'Сообщения, отклоненные при переполнении очереди',
+    'overflow_disconnects': 'Отключения из-за переполнения очереди',
+    'paused_senders': 'Приостановки чтения от отправителей',
+    'bytes_in': 'Принято байт от клиентов',
+    'bytes_out': 'Отправлено байт клиентам',
+    'write_calls': 'Вызовы записи в сокеты клиентов',
+    'history_queries': 'Запросы истории сообщений',
+    'decompressed_frames': 'Сжатые кадры, распакованные для получателя без поддержки сжатия',
+    'throttled_clients': 'Приостановки чтения из-за превышения частоты сообщений',
+    'rate_limited_messages': 'Сообщения, отклоненные из-за превышения частоты',
+    'rate_limit_disconnects': 'Отключения из-за превышения частоты сообщений',
+    'contact_updates': 'Новые версии списка пользователей в сети',
+    'duplicate_messages': 'Повторно отправленные сообщения, отброшенные после переподключения',
+    'acks': 'Подтверждения доставки от получателей',
+}
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами: наблюдение - один bisect и три сложения.
+
+    labels - метки ряда ({'stage': 'read'}); ряды с одним именем и разными
+    метками выводятся под общими HELP и TYPE.
+    """
+
+    def __init__(self, name, description, bounds=TIME_BUCKETS, labels=None):
+        self.name = name
+        self.description = description
+        self.bounds = bounds
+        self.labels = ''.join(f'{key}="{value}",' for key, value in sorted((labels or {}).items()))
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value, count=1):
+        self.counts[bisect_left(self.bounds, value)] += count
+        self.sum += value * count
+        self.count += count
+
+    def render(self, lines, header=True):
+        name = METRICS_PREFIX + self.name
+        if header:
+            lines.append(f'# HELP {name} {self.description}')
+            lines.append(f'# TYPE {name} histogram')
+        labels = self.labels
+        series = f'{{{labels[:-1]}}}' if labels else ''
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}le="{bound:.6g}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels}le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum{series} {self.sum:.9g}')
+        lines.append(f'{name}_count{series} {self.count}')
+
+
+class Metrics:
+    """Метрики сервера в текстовом формате Prometheus.
+
+    Счетчики - это Server.stats: в горячем пути они увеличиваются обычным
+    сложением в Counter. Значения датчиков вычисляются функциями только
+    в момент запроса метрик.
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.gauges = dict()
+        self.histograms = dict()
+
+    def gauge(self, name, description, func):
+        self.gauges[name] = description, func
+
+    def histogram(self, name, description, bounds=TIME_BUCKETS, labels=None):
+        key = name, tuple(sorted((labels or {}).items()))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(name, description, bounds, labels)
+        return histogram
+
+    def render(self):
+        lines = []
+        # Копия словаря делается за один вызов и не мешает циклу событий, меняющему счетчики
+        for key, value in sorted(dict(self.stats).items()):
+            name = f'{METRICS_PREFIX}{key}_total'
+            lines.append(f'# HELP {name} {COUNTER_HELP.get(key, key)}')
+            lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name} {value}')
+        for key, (description, func) in sorted(self.gauges.items()):
+            try:
+                value = func()
+            except Exception as err:
+                SERVER_LOGGER.error(f'Не удалось вычислить метрику {key}: {err}')
+                continue
+            name = METRICS_PREFIX + key
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {value}')
+        rendered = set()
+        for histogram in sorted(list(self.histograms.values()), key=lambda item: item.name):
+            histogram.render(lines, histogram.name not in rendered)
+            rendered.add(histogram.name)
+        lines.append('')
+        return '\n'.join(lines)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """GET / и /metrics - метрики; POST /profile?mode=sample|trace&seconds=N - профиль цикла событий."""
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        profiler = getattr(self.server, 'profiler', None)
+        if url.path != '/profile' or profiler is None:
+            self.send_error(404)
+            return
+        query = parse_qs(url.query)
+        mode = query.get('mode', [PROFILE_SAMPLE])[0]
+        try:
+            seconds = float(query.get('seconds', [PROFILE_SECONDS])[0])
+            if mode not in PROFILE_MODES or not 0 < seconds <= 3600:
+                raise ValueError
+        except ValueError:
+            # Строка статуса HTTP - только латиница, пояснение уходит в тело ответа
+            self.send_error(400, 'Bad Request', 'Ожидается mode=sample|trace и seconds от 0 до 3600')
+            return
+        path = profiler.start(mode, seconds)
+        if path is None:
+            self.send_error(409, 'Conflict', 'Профилирование уже идет')
+            return
+        body = f'{path}\n'.encode('utf-8')
+        self.send_response(202)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # У unix-сокета нет адреса клиента
+        return str(self.client_address or 'unix')
+
+    def log_message(self, format, *args):
+        SERVER_LOGGER.debug('Запрос метрик: %s', format % args)
+
+
+class TCPAdminServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+if hasattr(socketserver, 'UnixStreamServer'):
+    class UnixAdminServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+
+def start_admin_server(metrics, address, profiler=None):
+    """Отдает метрики по HTTP в отдельном потоке.
+
+    address - номер порта на 127.0.0.1 или путь к unix-сокету; profiler
+    (LoopProfiler) включает профилирование по запросу POST /profile.
+    """
+    if isinstance(address, int):
+        admin_server = TCPAdminServer(('127.0.0.1', address), MetricsRequestHandler)
+    else:
+        if os.path.exists(address):
+            os.unlink(address)
+        admin_server = UnixAdminServer(address, MetricsRequestHandler)
+    admin_server.metrics = metrics
+    admin_server.profiler = profiler
+    threading.Thread(target=admin_server.serve_forever, name='metrics', daemon=True).start()
+    SERVER_LOGGER.info(f'Метрики доступны по адресу {address}')
+    return admin_server
@@ -0,0 +1,380 @@
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+from common.variables import OFFLINE_SEGMENT_SIZE, OFFLINE_RETENTION, OFFLINE_COMMIT_INTERVAL, \
+    OFFLINE_COMPACT_RATIO, OFFLINE_MAINTENANCE_INTERVAL, OFFLINE_RETRY_INTERVAL
+from common.message_codecs import JSON_CODEC
+
+SERVER_LOGGER = logging.getLogger('server')
+
+# Заголовок записи: crc32 остальной части записи, длина сообщения, вид записи,
+# номер записи, время записи и длина имени получателя
+RECORD_HEADER = struct.Struct('!IIBQdH')
+RECORD_CRC = struct.Struct('!I')
+RECORD_MESSAGE = 0
+# Отметка о доставке: все сообщения получателя с номером не больше указанного доставлены
+RECORD_DELIVERED = 1
+
+SEGMENT_SUFFIX = '.log'
+
+
+class Segment:
+    """Файл журнала: размер, объем недоставленных сообщений в нем и время последней записи."""
+
+    def __init__(self, number):
+        self.number = number
+        self.size = 0
+        # Сколько байт сегмента уже записано на диск
+        self.durable = 0
+        self.live_bytes = 0
+        self.last_time = 0.0
+        self.fd = None
+
+
+class OfflineStore:
+    """Почтовые ящики пользователей, которые не в сети.
+
+    Сообщения дописываются в конец журнала, разбитого на файлы-сегменты;
+    в памяти для каждого получателя хранится очередь (номер записи, сегмент,
+    смещение, длина). Запись на диск и fsync выполняет фоновый поток пачками,
+    поэтому цикл сервера не ждет диска; неудавшаяся запись повторяется
+    через retry_interval, пока не пройдет. Сегменты старше срока хранения
+    удаляются, а самый старый сегмент с малой долей недоставленных сообщений
+    сжимается: они переносятся в текущий сегмент, файл удаляется.
+    """
+
+    def __init__(self, directory, segment_size=OFFLINE_SEGMENT_SIZE, retention=OFFLINE_RETENTION,
+                 commit_interval=OFFLINE_COMMIT_INTERVAL, compact_ratio=OFFLINE_COMPACT_RATIO,
+                 maintenance_interval=OFFLINE_MAINTENANCE_INTERVAL, retry_interval=OFFLINE_RETRY_INTERVAL):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.retention = retention
+        self.commit_interval = commit_interval
+        self.compact_ratio = compact_ratio
+        self.maintenance_interval = maintenance_interval
+        self.retry_interval = retry_interval
+
+        self.lock = threading.Lock()
+        self.commit_needed = threading.Condition(self.lock)
+        self.committed = threading.Condition(self.lock)
+        # Запись пачек из разных потоков не должна перемешивать порядок данных в файле
+        self.commit_lock = threading.Lock()
+        self.segments = dict()
+        self.mailboxes = dict()
+        self.next_id = 1
+        # Записи, еще не отданные потоку записи, и записи, еще не попавшие на диск
+        self.pending = []
+        self.unwritten = dict()
+        # Число неудавшихся записей на диск, по нему sync узнает об ошибке
+        self.failures = 0
+        self.stopping = False
+
+        os.makedirs(directory, exist_ok=True)
+        self.recover()
+        self.active = max(self.segments, default=0) + 1
+        self.segments[self.active] = Segment(self.active)
+        self.writer = threading.Thread(target=self.run_writer, name='offline-writer', daemon=True)
+        self.writer.start()
+
+    def _path(self, number):
+        return os.path.join(self.directory, f'{number:020d}{SEGMENT_SUFFIX}')
+
+    def _fd(self, segment):
+        if segment.fd is None:
+            segment.fd = os.open(self._path(segment.number), os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o600)
+        return segment.fd
+
+    def recover(self):
+        """Восстанавливает почтовые ящики по файлам журнала после перезапуска."""
+        numbers = sorted(int(file_name[:-len(SEGMENT_SUFFIX)]) for file_name in os.listdir(self.directory)
+                         if file_name.endswith(SEGMENT_SUFFIX) and file_name[:-len(SEGMENT_SUFFIX)].isdigit())
+        seen = set()
+        unordered = set()
+        for number in numbers:
+            segment = self.segments[number] = Segment(number)
+            with open(self._path(number), 'rb') as file:
+                data = file.read()
+            offset = 0
+            while offset < len(data):
+                record = self._parse(data, offset)
+                if record is None:
+                    # Хвост, недописанный при аварийной остановке, отбрасывается
+                    SERVER_LOGGER.warning(f'Поврежденная запись в {self._path(number)} '
+                                          f'на смещении {offset}, журнал усечен.')
+                    os.truncate(self._path(number), offset)
+                    break
+                kind, record_id, record_time, name, length = record
+                self.next_id = max(self.next_id, record_id + 1)
+                if kind == RECORD_MESSAGE and record_id not in seen:
+                    # Повтор номера - копия, оставшаяся от прерванного сжатия
+                    seen.add(record_id)
+                    mailbox = self.mailboxes.setdefault(name, deque())
+                    if mailbox and mailbox[-1][0] > record_id:
+                        unordered.add(name)
+                    mailbox.append((record_id, number, offset, length))
+                    segment.live_bytes += length
+                elif kind == RECORD_DELIVERED:
+                    if name in unordered:
+                        # Сообщения, перенесенные при сжатии, встают на место по номеру
+                        self.mailboxes[name] = deque(sorted(self.mailboxes[name]))
+                        unordered.discard(name)
+                    self._drop_delivered(name, record_id)
+                segment.last_time = record_time
+                offset += length
+            segment.size = segment.durable = offset
+        for name in unordered:
+            self.mailboxes[name] = deque(sorted(self.mailboxes[name]))
+        SERVER_LOGGER.info(f'Восстановлены почтовые ящики: {len(self.mailboxes)}, '
+                           f'сегментов журнала: {len(self.segments)}.')
+
+    @staticmethod
+    def _parse(data, offset):
+        if len(data) - offset < RECORD_HEADER.size:
+            return None
+        crc, payload_length, kind, record_id, record_time, name_length = RECORD_HEADER.unpack_from(data, offset)
+        length = RECORD_HEADER.size + name_length + payload_length
+        if offset + length > len(data) or zlib.crc32(data[offset + RECORD_CRC.size:offset + length]) != crc:
+            return None
+        name_start = offset + RECORD_HEADER.size
+        try:
+            name = data[name_start:name_start + name_length].decode('utf-8')
+        except UnicodeDecodeError:
+            return None
+        return kind, record_id, record_time, name, length
+
+    @staticmethod
+    def _payload(record):
+        return record[RECORD_HEADER.size + RECORD_HEADER.unpack_from(record)[-1]:]
+
+    def _append(self, kind, record_id, record_time, name, payload=b''):
+        encoded_name = name.encode('utf-8')
+        body = RECORD_HEADER.pack(0, len(payload), kind, record_id, record_time,
+                                  len(encoded_name))[RECORD_CRC.size:] + encoded_name + payload
+        record = RECORD_CRC.pack(zlib.crc32(body)) + body
+
+        segment = self.segments[self.active]
+        if segment.size and segment.size + len(record) > self.segment_size:
+            self.active += 1
+            segment = self.segments[self.active] = Segment(self.active)
+        offset = segment.size
+        segment.size += len(record)
+        segment.last_time = record_time
+        if kind == RECORD_MESSAGE:
+            segment.live_bytes += len(record)
+            self.mailboxes.setdefault(name, deque()).append((record_id, segment.number, offset, len(record)))
+        self.pending.append((segment, offset, record))
+        self.unwritten[segment.number, offset] = record
+        self.commit_needed.notify()
+
+    def _drop_delivered(self, name, record_id):
+        mailbox = self.mailboxes.get(name)
+        while mailbox and mailbox[0][0] <= record_id:
+            _, number, _, length = mailbox.popleft()
+            self.segments[number].live_bytes -= length
+        if not mailbox:
+            self.mailboxes.pop(name, None)
+
+    def _read_record(self, number, offset, length):
+        record = self.unwritten.get((number, offset))
+        if record is None:
+            record = os.pread(self._fd(self.segments[number]), length, offset)
+        return record
+
+    def store(self, message, name):
+        """Кладет сообщение в почтовый ящик пользователя name; возвращает номер записи."""
+        with self.lock:
+            record_id = self.next_id
+            self.next_id += 1
+            self._append(RECORD_MESSAGE, record_id, time.time(), name, JSON_CODEC.encode(message))
+        return record_id
+
+    def has_mail(self, name, after=0):
+        """Есть ли в ящике пользователя name сообщения с номером больше after."""
+        mailbox = self.mailboxes.get(name)
+        return bool(mailbox) and mailbox[-1][0] > after
+
+    def read(self, name, max_bytes, after=0):
+        """Сообщения ящика с номером больше after общим объемом около max_bytes: список пар (номер, сообщение).
+
+        after - последний номер, уже отправленный клиенту, но еще не отмеченный доставленным.
+        """
+        result = []
+        total = 0
+        with self.lock:
+            for record_id, number, offset, length in self.mailboxes.get(name, ()):
+                if record_id <= after:
+                    continue
+                if result and total + length > max_bytes:
+                    break
+                record = self._read_record(number, offset, length)
+                result.append((record_id, JSON_CODEC.decode(self._payload(record))))
+                total += length
+        return result
+
+    def delivered(self, name, record_id):
+        """Отмечает доставленными сообщения пользователя name с номером не больше record_id."""
+        with self.lock:
+            self._drop_delivered(name, record_id)
+            self._append(RECORD_DELIVERED, record_id, time.time(), name)
+
+    def run_writer(self):
+        next_maintenance = time.monotonic() + self.maintenance_interval
+        while True:
+            with self.lock:
+                if not self.pending and not self.stopping:
+                    self.commit_needed.wait(max(next_maintenance - time.monotonic(), 0))
+                stopping = self.stopping
+                delay = self.pending and not stopping and self.commit_interval
+            if delay:
+                # Небольшая задержка собирает в одну запись и один fsync больше сообщений
+                time.sleep(delay)
+            if not self.commit() and not stopping:
+                time.sleep(self.retry_interval)
+            if stopping:
+                return
+            if time.monotonic() >= next_maintenance:
+                next_maintenance = time.monotonic() + self.maintenance_interval
+                try:
+                    self.maintain()
+                except OSError as err:
+                    SERVER_LOGGER.error(f'Ошибка обслуживания журнала недоставленных сообщений: {err}')
+
+    def commit(self):
+        """Записывает накопленные записи и выполняет fsync для каждого затронутого сегмента.
+
+        Возвращает False, если записать удалось не все: оставшиеся записи
+        возвращаются в начало pending и записываются при следующем вызове.
+        """
+        with self.commit_lock:
+            with self.lock:
+                batch, self.pending = self.pending, []
+            if not batch:
+                return True
+            chunks = dict()
+            for segment, offset, record in batch:
+                chunks.setdefault(segment, (offset, []))[1].append(record)
+            written = set()
+            try:
+                for segment, (offset, records) in chunks.items():
+                    self._write(segment, offset, b''.join(records))
+                    written.add(segment)
+            except OSError as err:
+                # Записи остаются в памяти и доставляются, пока сервер работает
+                SERVER_LOGGER.error(f'Ошибка записи журнала недоставленных сообщений: {err}')
+            with self.lock:
+                retry = []
+                for entry in batch:
+                    segment, offset, _ = entry
+                    if segment in written:
+                        self.unwritten.pop((segment.number, offset), None)
+                    else:
+                        retry.append(entry)
+                if retry:
+                    self.pending[:0] = retry
+                    self.failures += 1
+                self.committed.notify_all()
+            return not retry
+
+    def _write(self, segment, offset, data):
+        fd = self._fd(segment)
+        if segment.durable != offset:
+            # Прошлая попытка могла оставить в файле часть пачки
+            os.ftruncate(fd, offset)
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+        os.fsync(fd)
+        segment.durable = offset + len(data)
+
+    def sync(self, timeout=None):
+        """Ждет, пока все принятые записи окажутся на диске.
+
+        Возвращает False по истечении timeout или если запись на диск не удалась;
+        записи при этом не теряются и записываются при следующих попытках.
+        """
+        with self.lock:
+            failures = self.failures
+            self.commit_needed.notify()
+            return self.committed.wait_for(lambda: not self.unwritten or self.failures != failures,
+                                           timeout) and not self.unwritten
+
+    def maintain(self, now=None):
+        """Удаляет сегменты старше срока хранения и сжимает самый старый полупустой сегмент."""
+        now = time.time() if now is None else now
+        with self.lock:
+            expired = [segment for number, segment in sorted(self.segments.items())
+                       if number != self.active and segment.last_time < now - self.retention]
+            for segment in expired:
+                if segment.live_bytes:
+                    self._expire(segment.number)
+                self._remove_segment(segment)
+            compacted = self._compact()
+        if compacted and self.commit():
+            # Старый файл удаляется только после того, как перенесенные записи на диске
+            with self.lock:
+                for segment in compacted:
+                    self._remove_segment(segment)
+
+    def _expire(self, number):
+        expired = 0
+        for name in list(self.mailboxes):
+            mailbox = self.mailboxes[name]
+            kept = deque(entry for entry in mailbox if entry[1] != number)
+            expired += len(mailbox) - len(kept)
+            if kept:
+                self.mailboxes[name] = kept
+            else:
+                del self.mailboxes[name]
+        SERVER_LOGGER.warning(f'Истек срок хранения {expired} недоставленных сообщений.')
+
+    def _compact(self):
+        # Сжимаются только самые старые сегменты: их отметки о доставке не могут
+        # относиться к записям более старых сегментов, поэтому их можно не переносить
+        compacted = []
+        for number in sorted(self.segments):
+            segment = self.segments[number]
+            if number == self.active or segment.live_bytes > segment.size * self.compact_ratio:
+                break
+            moved = 0
+            for name in list(self.mailboxes):
+                mailbox = self.mailboxes[name]
+                entries = [entry for entry in mailbox if entry[1] == number]
+                if not entries:
+                    continue
+                kept = deque(entry for entry in mailbox if entry[1] != number)
+                self.mailboxes[name] = kept
+                for record_id, _, offset, length in entries:
+                    record = self._read_record(number, offset, length)
+                    self._append(RECORD_MESSAGE, record_id, RECORD_HEADER.unpack_from(record)[4],
+                                 name, self._payload(record))
+                    moved += 1
+                # Перенесенные сообщения встают на место по номеру записи
+                self.mailboxes[name] = deque(sorted(self.mailboxes[name]))
+            segment.live_bytes = 0
+            compacted.append(segment)
+            SERVER_LOGGER.info(f'Сжат сегмент журнала {number}, перенесено сообщений: {moved}.')
+        return compacted
+
+    def _remove_segment(self, segment):
+        if segment.fd is not None:
+            os.close(segment.fd)
+            segment.fd = None
+        try:
+            os.unlink(self._path(segment.number))
+        except FileNotFoundError:
+            pass
+        self.segments.pop(segment.number, None)
+
+    def close(self):
+        with self.lock:
+            self.stopping = True
+            self.commit_needed.notify()
+        self.writer.join()
+        for segment in self.segments.values():
+            if segment.fd is not None:
+                os.close(segment.fd)
+                segment.fd = None
@@ -0,0 +1,117 @@
+import cProfile
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from common.variables import PROFILE_SAMPLE_INTERVAL
+
+SERVER_LOGGER = logging.getLogger('server')
+
+PROFILE_SAMPLE = 'sample'
+PROFILE_TRACE = 'trace'
+PROFILE_MODES = (PROFILE_SAMPLE, PROFILE_TRACE)
+
+
+def frame_stack(frame):
+    """Стек вызовов кадра в формате collapsed stacks: от внешней функции к внутренней через ';'."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{os.path.basename(code.co_filename)}:{code.co_name}:{code.co_firstlineno}')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class LoopProfiler:
+    """Профилирование цикла событий работающего сервера по запросу.
+
+    Режим sample - выборочный: отдельный поток раз в interval секунд снимает
+    стек потока цикла событий и по окончании пишет файл .collapsed для
+    flamegraph.pl или speedscope. Почти не замедляет сервер. Режим trace -
+    детерминированный cProfile, пишет файл .pstats; включается и выключается
+    в потоке цикла событий (cProfile видит только свой поток), поэтому запрос
+    выполняется при ближайшем вызове tick.
+
+    Запросить профиль можно из любого потока и из обработчика сигнала.
+    """
+
+    def __init__(self, directory, interval=PROFILE_SAMPLE_INTERVAL):
+        self.directory = directory
+        self.interval = interval
+        self.thread_id = None
+        # Запрошенный режим trace (длительность и файл) и время его окончания
+        self.requested = None
+        self.path = None
+        self.profile = None
+        self.deadline = None
+        self.sampling = False
+        self.lock = threading.Lock()
+
+    @property
+    def active(self):
+        return self.sampling or self.profile is not None or self.requested is not None
+
+    def start(self, mode, seconds):
+        """Запускает профилирование на seconds секунд; возвращает путь будущего файла или None, если уже идет."""
+        with self.lock:
+            if self.active:
+                return None
+            path = os.path.join(self.directory, time.strftime(f'profile-%Y%m%d-%H%M%S-{os.getpid()}-{mode}'))
+            if mode == PROFILE_SAMPLE:
+                self.sampling = True
+                threading.Thread(target=self._sample, args=(seconds, path + '.collapsed'),
+                                 name='profiler', daemon=True).start()
+                return path + '.collapsed'
+            self.requested = seconds, path + '.pstats'
+            return path + '.pstats'
+
+    def tick(self):
+        """Вызывается циклом событий; включает и выключает cProfile в его потоке."""
+        # Выборки снимаются с потока, в котором последним работал цикл событий
+        self.thread_id = threading.get_ident()
+        if self.requested is not None:
+            seconds, self.path = self.requested
+            self.profile = cProfile.Profile()
+            self.deadline = time.monotonic() + seconds
+            self.profile.enable()
+            self.requested = None
+            SERVER_LOGGER.warning(f'Включен cProfile на {seconds} с')
+        elif self.profile is not None and time.monotonic() >= self.deadline:
+            self.profile.disable()
+            try:
+                self.profile.dump_stats(self.path)
+                SERVER_LOGGER.warning(f'Профиль записан в {self.path}')
+            except OSError as err:
+                SERVER_LOGGER.error(f'Не удалось записать профиль {self.path}: {err}')
+            self.profile = None
+
+    def _sample(self, seconds, path):
+        stacks = Counter()
+        deadline = time.monotonic() + seconds
+        SERVER_LOGGER.warning(f'Включено выборочное профилирование на {seconds} с')
+        try:
+            while time.monotonic() < deadline:
+                frame = sys._current_frames().get(self.thread_id)
+                if frame is not None:
+                    stacks[frame_stack(frame)] += 1
+                del frame
+                time.sleep(self.interval)
+            with open(path, 'w', encoding='utf-8') as file:
+                for stack, count in stacks.most_common():
+                    file.write(f'{stack} {count}\n')
+            SERVER_LOGGER.warning(f'Профиль записан в {path}, выборок: {sum(stacks.values())}')
+        except OSError as err:
+            SERVER_LOGGER.error(f'Не удалось записать профиль {path}: {err}')
+        finally:
+            self.sampling = False
+
+
+def install_profile_signals(profiler, seconds):
+    """SIGUSR1 - выборочное профилирование, SIGUSR2 - cProfile на seconds секунд."""
+    if not hasattr(signal, 'SIGUSR1'):
+        return
+    signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.start(PROFILE_SAMPLE, seconds))
+    signal.signal(signal.SIGUSR2, lambda signum, frame: profiler.start(PROFILE_TRACE, seconds))
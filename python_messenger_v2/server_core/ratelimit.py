@@ -0,0 +1,77 @@
+class TokenBucket:
+    """Корзина маркеров: пополняется со скоростью rate до burst маркеров."""
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.updated = now
+
+
+class BucketGroup:
+    """Корзины с общими скоростью и емкостью, по одной на ключ (имя пользователя или IP-адрес)."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = dict()
+
+    def refill(self, key, now):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.burst, now)
+        else:
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+            bucket.updated = now
+        return bucket
+
+    def prune(self, now):
+        # Полная корзина ничем не отличается от новой, ее можно забыть
+        full = [key for key, bucket in self.buckets.items()
+                if bucket.tokens + (now - bucket.updated) * self.rate >= self.burst]
+        for key in full:
+            del self.buckets[key]
+
+
+class RateLimiter:
+    """Ограничение частоты сообщений клиентов по алгоритму token bucket.
+
+    Каждое сообщение списывает по маркеру из корзины учетной записи и из
+    корзины IP-адреса клиента, поэтому ни один пользователь, ни один адрес
+    с множеством соединений не превысят заданную скорость дольше, чем
+    позволяет запас burst. Скорость 0 отключает соответствующее ограничение.
+    """
+
+    def __init__(self, account_rate=0, account_burst=None, ip_rate=0, ip_burst=None):
+        self.accounts = BucketGroup(account_rate, account_burst or max(account_rate, 1)) if account_rate else None
+        self.addresses = BucketGroup(ip_rate, ip_burst or max(ip_rate, 1)) if ip_rate else None
+
+    def _buckets(self, client, now):
+        if self.accounts is not None and client.name is not None:
+            yield self.accounts, self.accounts.refill(client.name, now)
+        if self.addresses is not None and isinstance(client.addr, tuple):
+            yield self.addresses, self.addresses.refill(client.addr[0], now)
+
+    def acquire(self, client, now):
+        """Списывает маркер за сообщение клиента и возвращает 0.
+
+        Если маркеров не хватает хотя бы в одной корзине, ничего не списывает
+        и возвращает время в секундах, через которое сообщение можно принять.
+        """
+        buckets = list(self._buckets(client, now))
+        wait = 0
+        for group, bucket in buckets:
+            if bucket.tokens < 1:
+                wait = max(wait, (1 - bucket.tokens) / group.rate)
+        if wait:
+            return wait
+        for _, bucket in buckets:
+            bucket.tokens -= 1
+        return 0
+
+    def prune(self, now):
+        for group in (self.accounts, self.addresses):
+            if group is not None:
+                group.prune(now)
+
+    def __len__(self):
+        return sum(len(group.buckets) for group in (self.accounts, self.addresses) if group is not None)
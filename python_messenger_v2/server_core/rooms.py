@@ -0,0 +1,88 @@
+from common.utils import frame_payload
+
+
+class Room:
+    """Комната: имя и множество соединений участников."""
+
+    def __init__(self, name):
+        self.name = name
+        self.members = set()
+
+
+class RoomRegistry:
+    """Комнаты сервера.
+
+    Участники хранятся во множестве комнаты, а комнаты клиента - во множестве
+    client.rooms, поэтому вход, выход и удаление отключившегося клиента
+    не требуют перебора всех участников.
+    """
+
+    def __init__(self):
+        self.rooms = dict()
+
+    def get(self, name):
+        return self.rooms.get(name)
+
+    def join(self, name, client):
+        room = self.rooms.get(name)
+        if room is None:
+            room = self.rooms[name] = Room(name)
+        room.members.add(client)
+        client.rooms.add(room)
+        return room
+
+    def leave(self, name, client):
+        room = self.rooms.get(name)
+        if room is None or client not in room.members:
+            return False
+        self._discard(room, client)
+        client.rooms.discard(room)
+        return True
+
+    def leave_all(self, client):
+        for room in client.rooms:
+            self._discard(room, client)
+        client.rooms.clear()
+
+    def _discard(self, room, client):
+        room.members.discard(client)
+        # Пустая комната удаляется, ее имя снова свободно
+        if not room.members and self.rooms.get(room.name) is room:
+            del self.rooms[room.name]
+
+
+class FanOut:
+    """Рассылка одного сообщения участникам комнаты, выполняемая частями.
+
+    Кадр кодируется один раз для каждого сочетания версии протокола, кодека
+    и сжатия, и один и тот же объект кадра ставится в очереди всех участников
+    с этим форматом. Кадр, принятый от отправителя, используется как есть для
+    участников с той же версией и кодеком, умеющих распаковать его сжатие.
+    """
+
+    def __init__(self, room, sender, message=None, frame=None):
+        # Снимок участников: вход и выход во время рассылки ее не затрагивают
+        self.members = list(room.members)
+        self.position = 0
+        self.sender = sender
+        # Время приема сообщения от отправителя для гистограммы времени пересылки
+        self.received_at = sender.received_at if sender is not None else None
+        self.message = message
+        self.frames = dict()
+        self.source = frame
+        if frame is not None:
+            self.source_format = sender.protocol_version, sender.codec
+            # Номер алгоритма сжатия в старшем байте заголовка
+            self.source_compression = frame[0]
+
+    def frame_for(self, member):
+        if self.source is not None and (member.protocol_version, member.codec) == self.source_format and \
+                (not self.source_compression or self.source_compression in member.compressions):
+            return self.source
+        key = member.protocol_version, member.codec, member.compression
+        frame = self.frames.get(key)
+        if frame is None:
+            if self.message is None:
+                self.message = self.sender.codec.decode(frame_payload(self.source))
+            frame = self.frames[key] = member.encode(self.message)
+        return frame
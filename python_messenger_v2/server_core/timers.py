@@ -0,0 +1,117 @@
+import math
+
+# Число ячеек на уровне колеса (степень двойки) и число уровней
+WHEEL_BITS = 6
+WHEEL_SLOTS = 1 << WHEEL_BITS
+WHEEL_LEVELS = 4
+
+
+class Timer:
+    """Отложенный вызов callback(*args); отменяется методом TimerWheel.cancel."""
+    __slots__ = ('tick', 'callback', 'args', 'slot')
+
+    def __init__(self, tick, callback, args):
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+        # Ячейка колеса, в которой лежит таймер, или None, если он сработал или отменен
+        self.slot = None
+
+    @property
+    def active(self):
+        return self.slot is not None
+
+
+class TimerWheel:
+    """Иерархическое колесо таймеров.
+
+    Время делится на такты длиной resolution. Уровень 0 хранит таймеры
+    ближайших WHEEL_SLOTS тактов, каждый следующий уровень - в WHEEL_SLOTS
+    раз более крупные интервалы; при переходе нижнего уровня через ноль
+    ячейка верхнего уровня раскладывается по нижним. Добавление и отмена
+    таймера - O(1), продвижение колеса стоит число сработавших и переложенных
+    таймеров плюс число непустых участков колеса, которые пришлось пройти,
+    независимо от общего числа таймеров; пустые участки пропускаются целиком.
+    """
+
+    def __init__(self, resolution, now):
+        self.resolution = resolution
+        self.current = int(now / resolution)
+        self.levels = [[set() for _ in range(WHEEL_SLOTS)] for _ in range(WHEEL_LEVELS)]
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def schedule(self, now, delay, callback, *args):
+        """Вызывает callback(*args) не раньше, чем через delay секунд после now."""
+        tick = max(math.ceil((now + delay) / self.resolution), self.current + 1)
+        timer = Timer(tick, callback, args)
+        self._place(timer)
+        self.count += 1
+        return timer
+
+    def cancel(self, timer):
+        if timer is not None and timer.slot is not None:
+            timer.slot.discard(timer)
+            timer.slot = None
+            self.count -= 1
+
+    def _place(self, timer):
+        distance = timer.tick - self.current
+        for level in range(WHEEL_LEVELS):
+            if distance < 1 << (WHEEL_BITS * (level + 1)) or level == WHEEL_LEVELS - 1:
+                break
+        # Таймеры дальше последнего уровня ждут в его ячейке и перекладываются при каждом обороте
+        index = (min(timer.tick, self.current + (1 << (WHEEL_BITS * WHEEL_LEVELS)) - 1)
+                 >> (WHEEL_BITS * level)) & (WHEEL_SLOTS - 1)
+        slot = self.levels[level][index]
+        slot.add(timer)
+        timer.slot = slot
+
+    def advance(self, now):
+        """Продвигает колесо до момента now и возвращает список сработавших таймеров."""
+        target = int(now / self.resolution)
+        expired = []
+        levels = self.levels
+        while self.current < target:
+            self.current += 1
+            current = self.current
+            # Переход уровней через ноль: таймеры ячеек верхних уровней перекладываются
+            # ниже, начиная с самого верхнего, чтобы попасть в еще не обработанные ячейки
+            top = 0
+            while top + 1 < WHEEL_LEVELS and not current & ((1 << (WHEEL_BITS * (top + 1))) - 1):
+                top += 1
+            for level in range(top, 0, -1):
+                slot = levels[level][(current >> (WHEEL_BITS * level)) & (WHEEL_SLOTS - 1)]
+                if slot:
+                    timers = list(slot)
+                    slot.clear()
+                    for timer in timers:
+                        if timer.tick <= current:
+                            timer.slot = None
+                            expired.append(timer)
+                        else:
+                            self._place(timer)
+            slot = levels[0][current & (WHEEL_SLOTS - 1)]
+            if slot:
+                for timer in slot:
+                    timer.slot = None
+                expired.extend(slot)
+                slot.clear()
+            # Если нижние уровни пусты, до следующей раскладки ничего не сработает
+            span = 1
+            for level in range(WHEEL_LEVELS - 1):
+                size = 1 << (WHEEL_BITS * (level + 1))
+                if current & (size - 1) or any(levels[level]):
+                    break
+                span = size
+            if span > 1:
+                self.current = min(target, current + span - 1)
+        self.count -= len(expired)
+        return expired
+
+    def run(self, now):
+        """Продвигает колесо и вызывает сработавшие таймеры."""
+        for timer in self.advance(now):
+            timer.callback(*timer.args)
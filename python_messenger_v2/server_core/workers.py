@@ -0,0 +1,244 @@
+import base64
+import logging
+import os
+import shutil
+import signal
+import socket
+import tempfile
+from itertools import combinations
+from common.variables import ACTION, ACCOUNT_NAME, MESSAGE, DESTINATION, PEER_JOIN, PEER_LEAVE, \
+    WORKER, PROTOCOL_VERSION, ACK, UNKNOWN_NAMES_LIMIT
+from common.message_codecs import CODECS
+from server_core.connection import ClientConnection
+from logs.configs.queue_logging import stop_queue_logging
+
+SERVER_LOGGER = logging.getLogger('server')
+
+
+class NameRegistry:
+    """Реестр занятых имен, общий для рабочих процессов одной машины.
+
+    Каждое имя - файл в общем каталоге (по возможности в /dev/shm). Файл создается
+    с O_EXCL, поэтому занять имя может только один процесс; внутри хранится номер
+    процесса-владельца.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, name):
+        file_name = base64.urlsafe_b64encode(name.encode('utf-8')).decode('ascii')
+        return os.path.join(self.directory, file_name)
+
+    def claim(self, name, worker_id):
+        try:
+            fd = os.open(self._path(name), os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600)
+        except FileExistsError:
+            return False
+        except OSError as err:
+            SERVER_LOGGER.error(f'Не удалось занять имя {name}: {err}')
+            return False
+        try:
+            os.write(fd, str(worker_id).encode('ascii'))
+        finally:
+            os.close(fd)
+        return True
+
+    def release(self, name):
+        try:
+            os.unlink(self._path(name))
+        except FileNotFoundError:
+            pass
+
+    def owner(self, name):
+        try:
+            with open(self._path(name), 'rb') as file:
+                return int(file.read() or -1)
+        except (OSError, ValueError):
+            return None
+
+    def release_worker(self, worker_id):
+        for file_name in os.listdir(self.directory):
+            path = os.path.join(self.directory, file_name)
+            try:
+                with open(path, 'rb') as file:
+                    owner = file.read()
+                if owner == str(worker_id).encode('ascii'):
+                    os.unlink(path)
+            except OSError:
+                continue
+
+
+class PeerConnection(ClientConnection):
+    """Канал к соседнему рабочему процессу.
+
+    По каналу идут сообщения многих пользователей; кадры, накопленные за
+    итерацию цикла, отправляются пачками, как и клиентам (ClientConnection.flush).
+    """
+    is_peer = True
+
+    def __init__(self, sock, peer_id, addr=None):
+        super().__init__(sock, addr or f'worker-{peer_id}')
+        self.peer_id = peer_id
+        self.protocol_version = PROTOCOL_VERSION
+        # Процессы одного сервера поддерживают одни и те же кодеки
+        self.set_codec(next(iter(CODECS.values())))
+
+
+class WorkerCluster:
+    """Связь рабочего процесса с остальными: общий реестр имен и маршрутизация сообщений."""
+
+    def __init__(self, worker_id, registry, peer_socks):
+        self.worker_id = worker_id
+        self.registry = registry
+        self.peer_socks = peer_socks
+        self.peers = dict()
+        # Имена клиентов соседних процессов и номера этих процессов
+        self.remote_names = dict()
+        # Имена, которых не было в реестре: до их PEER_JOIN реестр повторно не читается
+        self.unknown_names = set()
+        self.server = None
+
+    def attach(self, server):
+        self.server = server
+        for peer_id, sock in self.peer_socks.items():
+            sock.setblocking(False)
+            peer = PeerConnection(sock, peer_id)
+            self.peers[peer_id] = peer
+            server.selector.register(sock, peer.events, peer)
+
+    def claim(self, name):
+        if not self.registry.claim(name, self.worker_id):
+            return False
+        self.broadcast({ACTION: PEER_JOIN, ACCOUNT_NAME: name, WORKER: self.worker_id})
+        return True
+
+    def release(self, name):
+        self.registry.release(name)
+        self.broadcast({ACTION: PEER_LEAVE, ACCOUNT_NAME: name, WORKER: self.worker_id})
+
+    def broadcast(self, message):
+        for peer in self.peers.values():
+            if not peer.closed:
+                self.server.send_to(peer, message)
+
+    def has_user(self, name):
+        return name in self.remote_names
+
+    def forward(self, message, sender=None):
+        """Передает сообщение процессу, к которому подключен получатель."""
+        name = message[DESTINATION]
+        owner = self.remote_names.get(name)
+        if owner is None:
+            if name in self.unknown_names:
+                return False
+            # PEER_JOIN мог еще не дойти: реестр читается один раз, промах запоминается
+            owner = self.registry.owner(name)
+            if owner is None:
+                if len(self.unknown_names) >= UNKNOWN_NAMES_LIMIT:
+                    self.unknown_names.clear()
+                self.unknown_names.add(name)
+                return False
+        peer = self.peers.get(owner)
+        if peer is None or peer.closed:
+            return False
+        return self.server.send_to(peer, message, sender)
+
+    def process_peer_message(self, message, peer):
+        action = message.get(ACTION)
+        if action == MESSAGE:
+            receiver = self.server.names.get(message[DESTINATION])
+            if receiver is None:
+                SERVER_LOGGER.error(f'Пользователь {message[DESTINATION]} уже отключился, '
+                                    f'сообщение от процесса {peer.peer_id} не доставлено.')
+                return
+            self.server.send_to(receiver, message)
+        elif action == ACK:
+            # Подтверждение отключившемуся отправителю не нужно
+            receiver = self.server.names.get(message[DESTINATION])
+            if receiver is not None:
+                self.server.send_to(receiver, message)
+        elif action == PEER_JOIN:
+            self.remote_names[message[ACCOUNT_NAME]] = message[WORKER]
+            self.unknown_names.discard(message[ACCOUNT_NAME])
+            self.server.contacts.touch(message[ACCOUNT_NAME])
+        elif action == PEER_LEAVE:
+            if self.remote_names.get(message[ACCOUNT_NAME]) == message[WORKER]:
+                del self.remote_names[message[ACCOUNT_NAME]]
+                self.server.contacts.touch(message[ACCOUNT_NAME])
+        else:
+            SERVER_LOGGER.error(f'Некорректное сообщение от процесса {peer.peer_id}: {message}')
+
+    def peer_lost(self, peer):
+        SERVER_LOGGER.error(f'Потеряна связь с рабочим процессом {peer.peer_id}.')
+        for name, owner in list(self.remote_names.items()):
+            if owner == peer.peer_id:
+                del self.remote_names[name]
+
+
+def run_workers(count, make_server):
+    """Запускает count рабочих процессов, принимающих подключения на одном порту."""
+    if not hasattr(os, 'fork') or not hasattr(socket, 'SO_REUSEPORT'):
+        raise OSError('Режим нескольких процессов требует fork и SO_REUSEPORT')
+
+    shm = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    registry = NameRegistry(tempfile.mkdtemp(prefix='messenger-names-', dir=shm))
+    links = {pair: socket.socketpair() for pair in combinations(range(count), 2)}
+    workers = dict()
+
+    for worker_id in range(count):
+        pid = os.fork()
+        if pid == 0:
+            peer_socks = dict()
+            for (first, second), (first_sock, second_sock) in links.items():
+                if first == worker_id:
+                    peer_socks[second] = first_sock
+                    second_sock.close()
+                elif second == worker_id:
+                    peer_socks[first] = second_sock
+                    first_sock.close()
+                else:
+                    first_sock.close()
+                    second_sock.close()
+            exit_code = 0
+            try:
+                server = make_server()
+                server.reuse_port = True
+                server.cluster = WorkerCluster(worker_id, registry, peer_socks)
+                server.main_loop()
+            except KeyboardInterrupt:
+                pass
+            except Exception:
+                SERVER_LOGGER.exception(f'Аварийное завершение рабочего процесса {worker_id}.')
+                exit_code = 1
+            finally:
+                stop_queue_logging()
+                os._exit(exit_code)
+        workers[pid] = worker_id
+
+    for first_sock, second_sock in links.values():
+        first_sock.close()
+        second_sock.close()
+
+    def stop_workers(signum, frame):
+        for worker_pid in workers:
+            try:
+                os.kill(worker_pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop_workers)
+    signal.signal(signal.SIGINT, stop_workers)
+    try:
+        while workers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            worker_id = workers.pop(pid, None)
+            if worker_id is not None:
+                SERVER_LOGGER.info(f'Рабочий процесс {worker_id} завершен с кодом '
+                                   f'{os.waitstatus_to_exitcode(status)}.')
+                registry.release_worker(worker_id)
+    finally:
+        shutil.rmtree(registry.directory, ignore_errors=True)
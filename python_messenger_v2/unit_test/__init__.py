@@ -0,0 +1,5 @@
+import os
+
+# Тесты не пишут отладочный журнал в отслеживаемые файлы logs/*_logs; уровень задается
+# до первого импорта модулей сервера и клиента, которые читают MESSENGER_LOG_LEVEL
+os.environ.setdefault('MESSENGER_LOG_LEVEL', 'CRITICAL')
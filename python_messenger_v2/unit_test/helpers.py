@@ -0,0 +1,71 @@
+import asyncio
+import socket
+import threading
+import time
+from common.utils import send_message, get_message
+from common.variables import ACTION, PRESENCE, TIME, USER, ACCOUNT_NAME, VERSION, CODECS, \
+    PROTOCOL_VERSION, LEGACY_PROTOCOL_VERSION, SESSION
+
+
+class ServerThread(threading.Thread):
+    """Сервер на свободном порту, цикл которого крутится в отдельном потоке."""
+
+    def __init__(self, server):
+        super().__init__(daemon=True)
+        self.server = server
+        self.server.init_socket()
+        self.port = self.server.sock.getsockname()[1]
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.server.run_once(0.05)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        for client in list(self.server.clients):
+            self.server.remove_client(client)
+        self.server.selector.close()
+        self.server.sock.close()
+
+
+def connect_client(port, name, version=PROTOCOL_VERSION, codecs=None, session=None):
+    sock = socket.create_connection(('127.0.0.1', port), timeout=5)
+    presence = {ACTION: PRESENCE, TIME: time.time(), USER: {ACCOUNT_NAME: name}}
+    if version != LEGACY_PROTOCOL_VERSION:
+        presence[VERSION] = version
+    if codecs is not None:
+        presence[CODECS] = codecs
+    if session is not None:
+        presence[SESSION] = session
+    send_message(sock, presence, LEGACY_PROTOCOL_VERSION)
+    return sock, get_message(sock)
+
+
+class AsyncServerThread(threading.Thread):
+    """Сервер на asyncio, запущенный в собственном цикле событий в отдельном потоке."""
+
+    def __init__(self, server):
+        super().__init__(daemon=True)
+        self.server = server
+        self.loop = asyncio.new_event_loop()
+        self.loop.run_until_complete(self.server.start())
+        self.port = self.server.sock.getsockname()[1]
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.join()
+        self.loop.close()
+
+    async def shutdown(self):
+        self.server.close()
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
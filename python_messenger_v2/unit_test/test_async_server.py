@@ -0,0 +1,90 @@
+import threading
+import time
+import unittest
+from unittest import mock
+from common.utils import send_message, get_message, encode_message, MessageDecoder
+from common.variables import ACTION, MESSAGE, TIME, SENDER, DESTINATION, MESSAGE_TEXT, \
+    STATUS_CODE, VERSION, PROTOCOL_VERSION, LEGACY_PROTOCOL_VERSION, EXIT, ACCOUNT_NAME, OVERFLOW_DROP_OLDEST, \
+    OVERFLOW_REJECT
+from server import AsyncServer
+from unit_test.helpers import AsyncServerThread, connect_client
+
+
+class TestAsyncServer(unittest.TestCase):
+
+    def setUp(self):
+        self.server_thread = AsyncServerThread(AsyncServer('127.0.0.1', 0))
+        self.server_thread.start()
+        self.socks = []
+
+    def tearDown(self):
+        for sock in self.socks:
+            sock.close()
+        self.server_thread.stop()
+
+    def connect(self, name, version=PROTOCOL_VERSION):
+        sock, response = connect_client(self.server_thread.port, name, version)
+        self.socks.append(sock)
+        return sock, response
+
+    def test_presence_and_duplicate_name(self):
+        _, response = self.connect('test1')
+        self.assertEqual(response[STATUS_CODE], 200)
+        self.assertEqual(response[VERSION], PROTOCOL_VERSION)
+        sock, response = self.connect('test1')
+        self.assertEqual(response[STATUS_CODE], 400)
+        self.assertEqual(sock.recv(1), b'')
+
+    def test_relay_between_protocol_versions(self):
+        sender, _ = self.connect('test1')
+        receiver, _ = self.connect('test2', LEGACY_PROTOCOL_VERSION)
+        for i in range(10):
+            send_message(sender, {ACTION: MESSAGE, TIME: 1.1, SENDER: 'test1',
+                                  DESTINATION: 'test2', MESSAGE_TEXT: str(i) * 3000})
+        for i in range(10):
+            self.assertEqual(get_message(receiver)[MESSAGE_TEXT], str(i) * 3000)
+
+    def test_exit_releases_name(self):
+        sock, _ = self.connect('test1')
+        send_message(sock, {ACTION: EXIT, TIME: 1.1, ACCOUNT_NAME: 'test1'})
+        self.assertEqual(sock.recv(1), b'')
+        _, response = self.connect('test1')
+        self.assertEqual(response[STATUS_CODE], 200)
+
+    def test_sender_paused_until_receiver_drains(self):
+        server = self.server_thread.server
+        count = 8000
+        with mock.patch.object(server, 'pause_sender', wraps=server.pause_sender) as pause_sender:
+            sender, _ = self.connect('test1')
+            receiver, _ = self.connect('test2')
+            data = b''.join(encode_message({ACTION: MESSAGE, TIME: 1.1, SENDER: 'test1', DESTINATION: 'test2',
+                                            MESSAGE_TEXT: f'{number:04}' + 'x' * 1000})
+                            for number in range(count))
+            # Получатель не читает: без приостановки отправителя очередь переполнилась бы и сообщения отклонялись
+            flood = threading.Thread(target=sender.sendall, args=(data,), daemon=True)
+            flood.start()
+            deadline = time.monotonic() + 5
+            while not pause_sender.called:
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.01)
+            decoder = MessageDecoder()
+            received = []
+            while len(received) < count:
+                data = receiver.recv(65536)
+                self.assertTrue(data)
+                received.extend(message[MESSAGE_TEXT][:4] for message in decoder.feed(data))
+            flood.join(5)
+        self.assertEqual(received, [f'{number:04}' for number in range(count)])
+        self.assertEqual(server.stats['rejected_messages'], 0)
+        send_message(sender, {ACTION: MESSAGE, TIME: 1.1, SENDER: 'test1', DESTINATION: 'test2',
+                              MESSAGE_TEXT: 'После разгрузки'})
+        self.assertEqual(get_message(receiver)[MESSAGE_TEXT], 'После разгрузки')
+
+    def test_drop_oldest_is_not_supported(self):
+        self.assertEqual(self.server_thread.server.overflow_policy, OVERFLOW_REJECT)
+        with self.assertRaises(ValueError):
+            AsyncServer('127.0.0.1', 0, overflow_policy=OVERFLOW_DROP_OLDEST)
+
+
+if __name__ == '__main__':
+    unittest.main()
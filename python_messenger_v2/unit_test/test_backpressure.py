@@ -0,0 +1,143 @@
+import socket
+import unittest
+from collections import Counter
+from common.variables import STATUS_CODE, OVERFLOW_DROP_OLDEST, OVERFLOW_REJECT, OVERFLOW_DISCONNECT
+from common.utils import MessageDecoder
+from server import Server
+from server_core.connection import ClientConnection
+
+
+class TestBackpressure(unittest.TestCase):
+
+    def make_server(self, policy, queue_limit=100):
+        self.server = Server('127.0.0.1', 0, queue_limit=queue_limit, high_watermark=60,
+                             low_watermark=20, overflow_policy=policy)
+        self.peers = []
+
+    def add_client(self, name):
+        sock, peer = socket.socketpair()
+        sock.setblocking(False)
+        self.peers.append(peer)
+        client = ClientConnection(sock, name)
+        client.name = name
+        self.server.clients.add(client)
+        self.server.names[name] = client
+        self.server.selector.register(sock, client.events, client)
+        return client
+
+    def tearDown(self):
+        for client in list(self.server.clients):
+            self.server.remove_client(client)
+        for peer in self.peers:
+            peer.close()
+
+    def test_drop_oldest(self):
+        self.make_server(OVERFLOW_DROP_OLDEST)
+        client = self.add_client('test1')
+        for i in range(5):
+            self.assertTrue(self.server.deliver(client, bytes([i]) * 40))
+        self.assertEqual(list(client.out_queue), [bytes([3]) * 40, bytes([4]) * 40])
+        self.assertEqual(client.out_bytes, 80)
+        self.assertEqual(self.server.stats['dropped_messages'], 3)
+
+    def test_drop_oldest_keeps_partially_sent_frame(self):
+        self.make_server(OVERFLOW_DROP_OLDEST)
+        client = self.add_client('test1')
+        self.server.deliver(client, b'a' * 40)
+        self.server.deliver(client, b'b' * 40)
+        client.out_offset = 10
+        client.out_bytes -= 10
+        self.server.deliver(client, b'c' * 40)
+        self.assertEqual(list(client.out_queue), [b'a' * 40, b'c' * 40])
+
+    def test_reject_replies_to_sender(self):
+        self.make_server(OVERFLOW_REJECT, queue_limit=1000)
+        sender = self.add_client('test1')
+        receiver = self.add_client('test2')
+        self.server.deliver(receiver, b'a' * 990)
+        self.assertFalse(self.server.deliver(receiver, b'b' * 20, sender))
+        self.assertEqual(self.server.stats['rejected_messages'], 1)
+        reply, = MessageDecoder().feed(b''.join(sender.out_queue))
+        self.assertEqual(reply[STATUS_CODE], 503)
+
+    def test_disconnect_slow_receiver(self):
+        self.make_server(OVERFLOW_DISCONNECT)
+        receiver = self.add_client('test2')
+        self.server.deliver(receiver, b'a' * 90)
+        self.assertFalse(self.server.deliver(receiver, b'b' * 20))
+        self.assertTrue(receiver.closed)
+        self.assertNotIn('test2', self.server.names)
+        self.assertEqual(self.server.stats['overflow_disconnects'], 1)
+
+    def test_high_watermark_pauses_sender_until_drained(self):
+        self.make_server(OVERFLOW_DROP_OLDEST)
+        sender = self.add_client('test1')
+        receiver = self.add_client('test2')
+        self.server.deliver(receiver, b'a' * 50, sender)
+        self.assertFalse(sender.paused)
+        self.server.deliver(receiver, b'b' * 30, sender)
+        self.assertTrue(sender.paused)
+        self.assertEqual(sender.events, 0)
+        self.server.flush_clients()
+        self.assertEqual(receiver.out_bytes, 0)
+        self.assertFalse(sender.paused)
+        self.assertNotEqual(sender.events, 0)
+
+
+class TestBatchedWrites(unittest.TestCase):
+
+    def setUp(self):
+        self.sock, self.peer = socket.socketpair()
+        self.sock.setblocking(False)
+        self.stats = Counter()
+
+    def tearDown(self):
+        self.sock.close()
+        self.peer.close()
+
+    def make_client(self, frames, write_batch_frames=512):
+        client = ClientConnection(self.sock, 'test', self.stats, write_batch_frames)
+        for frame in frames:
+            client.queue_frame(frame)
+        return client
+
+    def receive(self, size):
+        data = b''
+        while len(data) < size:
+            data += self.peer.recv(size - len(data))
+        return data
+
+    def test_small_frames_share_one_call(self):
+        frames = [bytes([i]) * 10 for i in range(100)]
+        client = self.make_client(frames)
+        self.assertTrue(client.flush())
+        self.assertEqual(self.stats['write_calls'], 1)
+        self.assertEqual(self.receive(1000), b''.join(frames))
+        self.assertEqual((client.out_bytes, client.out_offset), (0, 0))
+
+    def test_batch_is_limited_by_frames(self):
+        client = self.make_client([b'a' * 10] * 10, write_batch_frames=1)
+        self.assertTrue(client.flush())
+        self.assertEqual(self.stats['write_calls'], 10)
+        client = self.make_client([b'a' * 10] * 10, write_batch_frames=4)
+        self.assertTrue(client.flush())
+        self.assertEqual(self.stats['write_calls'], 13)
+        self.receive(200)
+
+    def test_partial_write_resumes_mid_frame(self):
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        frames = [bytes([i % 256]) * 1000 for i in range(3000)]
+        client = self.make_client(frames)
+        self.assertFalse(client.flush())
+        self.assertLess(len(client.out_queue), len(frames))
+        self.assertEqual(client.out_bytes, sum(map(len, client.out_queue)) - client.out_offset)
+        data = b''
+        while not client.flush():
+            data += self.peer.recv(65536)
+        data += self.receive(len(frames) * 1000 - len(data))
+        self.assertEqual(data, b''.join(frames))
+        self.assertEqual(self.stats['bytes_out'], len(data))
+
+
+if __name__ == '__main__':
+    unittest.main()
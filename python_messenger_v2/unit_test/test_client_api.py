@@ -0,0 +1,201 @@
+import asyncio
+import socket
+import time
+import unittest
+from common.variables import SENDER, DESTINATION, MESSAGE_TEXT, STATUS_CODE, ROOM
+from client_api import AsyncClient, SyncClient
+from server import Server, AsyncServer
+from unit_test.helpers import ServerThread, AsyncServerThread
+
+
+class TestAsyncClient(unittest.TestCase):
+    server_class = Server
+    thread_class = ServerThread
+
+    def setUp(self):
+        self.server_thread = self.thread_class(self.server_class('127.0.0.1', 0))
+        self.server_thread.start()
+        self.port = self.server_thread.port
+
+    def tearDown(self):
+        self.server_thread.stop()
+
+    def drop_client(self, name):
+        # Цикл сервера сам заметит закрытое соединение и удалит клиента
+        self.server_thread.server.names[name].sock.shutdown(socket.SHUT_RDWR)
+
+    def run_async(self, coro):
+        return asyncio.run(asyncio.wait_for(coro, 10))
+
+    def test_pipelined_send(self):
+        async def scenario():
+            async with AsyncClient('bot', port=self.port) as bot, AsyncClient('test1', port=self.port) as user:
+                for number in range(2000):
+                    bot.send('test1', str(number))
+                await bot.flush()
+                received = []
+                async for message in user:
+                    received.append(message[MESSAGE_TEXT])
+                    if len(received) == 2000:
+                        break
+                self.assertEqual(received, [str(number) for number in range(2000)])
+                self.assertEqual(message[SENDER], 'bot')
+                self.assertEqual(message[DESTINATION], 'test1')
+                # Сообщения, поставленные в очередь за один проход цикла, уходят одной записью
+                self.assertLess(bot.writes, 10)
+
+        self.run_async(scenario())
+
+    def test_rooms(self):
+        async def scenario():
+            async with AsyncClient('bot', port=self.port) as bot, AsyncClient('test1', port=self.port) as user:
+                self.assertEqual((await user.join('#news'))[STATUS_CODE], 200)
+                self.assertEqual((await bot.join('#news'))[STATUS_CODE], 200)
+                bot.send('#news', 'Новости')
+                message = await user.receive()
+                self.assertEqual(message[MESSAGE_TEXT], 'Новости')
+                self.assertEqual((await user.leave('#news'))[STATUS_CODE], 200)
+
+        self.run_async(scenario())
+
+    def test_reconnect(self):
+        async def scenario():
+            async with AsyncClient('bot', port=self.port, reconnect_delay=0.05) as bot, \
+                    AsyncClient('test1', port=self.port) as user:
+                await user.join('#news')
+                self.drop_client('test1')
+                while not user.reconnects:
+                    await asyncio.sleep(0.01)
+                await user.connected.wait()
+                bot.send('test1', 'После переподключения')
+                self.assertEqual((await user.receive())[MESSAGE_TEXT], 'После переподключения')
+                # Комнаты восстанавливаются после переподключения
+                await bot.join('#news')
+                bot.send('#news', 'Новости')
+                self.assertEqual((await user.receive())[MESSAGE_TEXT], 'Новости')
+
+        self.run_async(scenario())
+
+    def test_contacts(self):
+        async def wait_until(condition):
+            while not condition():
+                await asyncio.sleep(0.01)
+
+        async def scenario():
+            async with AsyncClient('watcher', port=self.port, reconnect_delay=0.05) as watcher:
+                self.assertEqual((await watcher.contacts())[STATUS_CODE], 200)
+                async with AsyncClient('test1', port=self.port):
+                    await wait_until(lambda: 'test1' in watcher.online)
+                await wait_until(lambda: 'test1' not in watcher.online)
+                # После переподключения клиент сам запрашивает снимок и снова подписывается
+                self.drop_client('watcher')
+                await wait_until(lambda: watcher.reconnects)
+                await wait_until(lambda: watcher.contacts_revision is not None)
+                async with AsyncClient('test2', port=self.port):
+                    await wait_until(lambda: 'test2' in watcher.online)
+                self.assertFalse(watcher.requests)
+
+        self.run_async(scenario())
+
+    def test_responses_match_requests(self):
+        async def scenario():
+            async with AsyncClient('test1', port=self.port, reconnect_delay=0.05) as user:
+                await user.join('#r')
+                self.drop_client('test1')
+                while not user.reconnects:
+                    await asyncio.sleep(0.01)
+                # Ответ на повторный вход в #r и ошибка на сообщение в чужую комнату не относятся к запросам
+                user.send('#closed', 'Не участник')
+                response = await user.leave('#other')
+                self.assertEqual((response[STATUS_CODE], response.get(ROOM)), (404, None))
+                response = await user.join('#next')
+                self.assertEqual((response[STATUS_CODE], response[ROOM]), (200, '#next'))
+                self.assertFalse(user.requests)
+
+        self.run_async(scenario())
+
+    def test_acks_are_batched(self):
+        async def scenario():
+            async with AsyncClient('bot', port=self.port) as bot, AsyncClient('test1', port=self.port) as user:
+                for number in range(1000):
+                    last = bot.send('test1', str(number))
+                for _ in range(1000):
+                    await user.receive()
+                while not bot.delivered('test1', last):
+                    await asyncio.sleep(0.01)
+                self.assertFalse(bot.unacked)
+                # Одно подтверждение на ack_batch сообщений, а не на каждое
+                self.assertLessEqual(self.server_thread.server.stats['acks'], 1000 // user.ack_batch + 2)
+
+        self.run_async(scenario())
+
+    def test_resent_message_is_not_duplicated(self):
+        async def scenario():
+            async with AsyncClient('bot', port=self.port, reconnect_delay=0.05) as bot, \
+                    AsyncClient('test1', port=self.port, ack_interval=60) as user:
+                first = bot.send('test1', 'Первое')
+                self.assertEqual((await user.receive())[MESSAGE_TEXT], 'Первое')
+                # Подтверждение еще не отправлено: после обрыва сообщение уйдет повторно
+                self.drop_client('bot')
+                while not bot.reconnects:
+                    await asyncio.sleep(0.01)
+                await bot.connected.wait()
+                second = bot.send('test1', 'Второе')
+                self.assertEqual((await user.receive())[MESSAGE_TEXT], 'Второе')
+                self.assertEqual(self.server_thread.server.stats['duplicate_messages'], 1)
+                self.assertFalse(bot.delivered('test1', first))
+                await user.close()
+                while not bot.delivered('test1', second):
+                    await asyncio.sleep(0.01)
+
+        self.run_async(scenario())
+
+    def test_sync_client(self):
+        with SyncClient('bot', port=self.port) as bot, SyncClient('test1', port=self.port) as user:
+            for number in range(500):
+                bot.send('test1', str(number))
+            bot.flush(5)
+            received = []
+            for message in user:
+                received.append(message[MESSAGE_TEXT])
+                if len(received) == 500:
+                    break
+            self.assertEqual(received, [str(number) for number in range(500)])
+        self.assertTrue(user.client.closed)
+
+    def test_sync_client_keeps_unsent_messages(self):
+        with SyncClient('test1', port=self.port) as user:
+            bot = SyncClient('bot', port=self.port, max_pending=10)
+            try:
+                # Пока клиент не подключен, очередь отправки не разгружается
+                for number in range(25):
+                    bot.send('test1', str(number))
+                with self.assertRaises(BufferError):
+                    bot.flush(5)
+                self.assertEqual(len(bot.outbox), 15)
+                bot.connect(5)
+                deadline = time.monotonic() + 5
+                while True:
+                    try:
+                        bot.flush(5)
+                        break
+                    except BufferError:
+                        self.assertLess(time.monotonic(), deadline)
+                        time.sleep(0.01)
+                received = [user.receive(5)[MESSAGE_TEXT] for _ in range(25)]
+                self.assertEqual(received, [str(number) for number in range(25)])
+            finally:
+                bot.close(5)
+
+
+class TestAsyncClientAsyncServer(TestAsyncClient):
+    server_class = AsyncServer
+    thread_class = AsyncServerThread
+
+    def drop_client(self, name):
+        server = self.server_thread.server
+        self.server_thread.loop.call_soon_threadsafe(server.remove_client, server.names[name])
+
+
+if __name__ == '__main__':
+    unittest.main()
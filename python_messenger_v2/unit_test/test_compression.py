@@ -0,0 +1,124 @@
+import random
+import socket
+import unittest
+import zlib
+from common.utils import MessageDecoder, encode_message, send_message, get_message, FRAME_HEADER, MAX_FRAME_LENGTH
+from common.variables import ACTION, MESSAGE, TIME, SENDER, DESTINATION, MESSAGE_TEXT, STATUS_CODE, CODEC, \
+    COMPRESSION, COMPRESSIONS, PRESENCE, USER, ACCOUNT_NAME, VERSION, CODECS, PROTOCOL_VERSION, \
+    LEGACY_PROTOCOL_VERSION, JOIN, ROOM, COMPRESSION_THRESHOLD
+from common.message_codecs import get_codec
+from common.compression import ZlibCompression, compress_payload, get_compression, compression_by_id
+from server import Server
+from unit_test.helpers import ServerThread
+
+
+def message(sender, destination, text):
+    return {ACTION: MESSAGE, TIME: 1.1, SENDER: sender, DESTINATION: destination, MESSAGE_TEXT: text}
+
+
+class TestCompression(unittest.TestCase):
+
+    def test_threshold_and_incompressible_data(self):
+        zlib_compression = get_compression('zlib')
+        self.assertEqual(compress_payload(b'a' * (COMPRESSION_THRESHOLD - 1), zlib_compression)[0], 0)
+        self.assertEqual(compress_payload(b'a' * COMPRESSION_THRESHOLD, zlib_compression)[0], ZlibCompression.id)
+        self.assertEqual(compress_payload(random.Random(1).randbytes(1024), zlib_compression)[0], 0)
+        self.assertEqual(compress_payload(b'a' * 4096, None), (0, b'a' * 4096))
+
+    def test_compressed_frame_round_trip(self):
+        big = message('test1', 'test2', 'Длинный текст ' * 200)
+        frame = encode_message(big, compression=get_compression('zlib'))
+        self.assertEqual(frame[0], ZlibCompression.id)
+        self.assertLess(len(frame), len(encode_message(big)))
+        small = encode_message(message('test1', 'test2', 'Привет'), compression=get_compression('zlib'))
+        self.assertEqual(small[0], 0)
+        legacy = encode_message(message('test2', 'test1', 'Старый клиент'), LEGACY_PROTOCOL_VERSION)
+        decoder = MessageDecoder()
+        received = list(decoder.feed(frame + small + legacy))
+        self.assertEqual([item[MESSAGE_TEXT] for item in received],
+                         [big[MESSAGE_TEXT], 'Привет', 'Старый клиент'])
+
+    def test_decompressed_length_is_limited(self):
+        bomb = zlib.compress(b'{' + b' ' * 100000 + b'}')
+        frame = FRAME_HEADER.pack(ZlibCompression.id << 24 | len(bomb)) + bomb
+        with self.assertRaises(ValueError):
+            list(MessageDecoder(max_length=1000).feed(frame))
+        self.assertEqual(list(MessageDecoder().feed(frame)), [{}])
+        self.assertLessEqual(len(bomb), MAX_FRAME_LENGTH)
+
+    def test_unavailable_algorithm(self):
+        for compression_id in (2, 3):
+            try:
+                compression_by_id(compression_id)
+            except ValueError:
+                frame = FRAME_HEADER.pack(compression_id << 24 | 3) + b'abc'
+                with self.assertRaises(ValueError):
+                    list(MessageDecoder().feed(frame))
+
+
+class TestCompressedRelay(unittest.TestCase):
+
+    def setUp(self):
+        self.server_thread = ServerThread(Server('127.0.0.1', 0))
+        self.server_thread.start()
+        self.socks = []
+
+    def tearDown(self):
+        for sock in self.socks:
+            sock.close()
+        self.server_thread.stop()
+
+    def connect(self, name, compressions):
+        sock = socket.create_connection(('127.0.0.1', self.server_thread.port), timeout=5)
+        self.socks.append(sock)
+        send_message(sock, {ACTION: PRESENCE, TIME: 1.1, USER: {ACCOUNT_NAME: name}, VERSION: PROTOCOL_VERSION,
+                            CODECS: ['struct'], COMPRESSIONS: compressions}, LEGACY_PROTOCOL_VERSION)
+        response = get_message(sock)
+        self.assertEqual(response[STATUS_CODE], 200)
+        return sock, get_codec(response[CODEC]), get_compression(response[COMPRESSION])
+
+    @staticmethod
+    def next_frame(sock):
+        decoder = MessageDecoder()
+        while (frame := decoder.next_frame()) is None:
+            decoder.append(sock.recv(65536))
+        return bytes(frame)
+
+    def test_compressed_frame_passes_through(self):
+        sender, codec, compression = self.connect('test1', ['zlib'])
+        self.assertEqual(compression.name, 'zlib')
+        receiver, _, _ = self.connect('test2', ['zlib'])
+        plain, _, no_compression = self.connect('test3', [])
+        self.assertIsNone(no_compression)
+
+        frame = encode_message(message('test1', 'test2', 'Сжатый текст ' * 100), codec=codec,
+                               compression=compression)
+        self.assertEqual(frame[0], ZlibCompression.id)
+        sender.sendall(frame)
+        self.assertEqual(self.next_frame(receiver), frame)
+
+        sender.sendall(encode_message(message('test1', 'test3', 'Сжатый текст ' * 100), codec=codec,
+                                      compression=compression))
+        received = self.next_frame(plain)
+        self.assertEqual(received[0], 0)
+        self.assertEqual(codec.decode(received[FRAME_HEADER.size:])[MESSAGE_TEXT], 'Сжатый текст ' * 100)
+        stats = self.server_thread.server.stats
+        self.assertEqual(stats['relayed_frames'], 2)
+        self.assertEqual(stats['decompressed_frames'], 1)
+
+    def test_room_fanout_keeps_compressed_frame(self):
+        clients = [self.connect('test1', ['zlib']), self.connect('test2', ['zlib']), self.connect('test3', [])]
+        for sock, codec, _ in clients:
+            send_message(sock, {ACTION: JOIN, TIME: 1.1, ROOM: '#room'}, codec=codec)
+            self.assertEqual(get_message(sock, codec)[STATUS_CODE], 200)
+        sender, codec, compression = clients[0]
+        frame = encode_message(message('test1', '#room', 'Новости ' * 200), codec=codec, compression=compression)
+        sender.sendall(frame)
+        self.assertEqual(self.next_frame(clients[1][0]), frame)
+        received = self.next_frame(clients[2][0])
+        self.assertEqual(received[0], 0)
+        self.assertEqual(codec.decode(received[FRAME_HEADER.size:])[MESSAGE_TEXT], 'Новости ' * 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import socket
+import time
+import unittest
+from common.utils import send_message, get_message
+from common.variables import ACTION, TIME, CONTACTS, SUBSCRIBE, REVISION, USERS, JOINED, LEFT, STATUS_CODE, \
+    LEGACY_PROTOCOL_VERSION
+from server import Server
+from unit_test.helpers import ServerThread, connect_client
+
+
+class FakeClient:
+    def __init__(self, name):
+        self.name = name
+        self.closed = False
+
+
+class TestContactDirectory(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Server('127.0.0.1', 0)
+        self.contacts = self.server.contacts
+
+    def online(self, *names):
+        for name in names:
+            self.server.names[name] = FakeClient(name)
+            self.contacts.touch(name)
+
+    def offline(self, *names):
+        for name in names:
+            del self.server.names[name]
+            self.contacts.touch(name)
+
+    def test_changes_are_coalesced(self):
+        subscriber = FakeClient('watcher')
+        self.contacts.subscribe(subscriber)
+        names = [f'user{number}' for number in range(10000)]
+        self.online(*names)
+        self.offline(*names[:100])
+        self.online('ghost')
+        self.offline('ghost')
+        self.assertEqual(self.contacts.revision, 0)
+        self.contacts.flush()
+        self.assertEqual(self.contacts.revision, 1)
+        self.assertEqual(len(self.server.fanouts), 1)
+        update = self.server.fanouts[0].message
+        self.assertEqual(update[ACTION], CONTACTS)
+        self.assertEqual(update[REVISION], 1)
+        self.assertEqual(update[JOINED], sorted(names[100:]))
+        self.assertEqual(update[LEFT], [])
+        self.assertEqual(self.server.fanouts[0].members, [subscriber])
+
+    def test_flush_is_scheduled_once(self):
+        self.online('test1', 'test2')
+        self.assertEqual(self.server.timers.count, 1)
+        # Без подписчиков версия растет, но рассылки нет
+        self.server.timers.run(self.server.now + self.contacts.interval + 1)
+        self.assertEqual(self.contacts.published, {'test1', 'test2'})
+        self.assertEqual(self.contacts.revision, 1)
+        self.assertFalse(self.server.fanouts)
+        self.offline('test1')
+        self.contacts.flush()
+        self.assertEqual(self.contacts.published, {'test2'})
+        self.assertEqual(self.contacts.revision, 2)
+
+
+class TestContactsAction(unittest.TestCase):
+
+    def setUp(self):
+        self.server_thread = ServerThread(Server('127.0.0.1', 0))
+        self.server_thread.start()
+        self.socks = []
+
+    def tearDown(self):
+        for sock in self.socks:
+            sock.close()
+        self.server_thread.stop()
+
+    def connect(self, name):
+        sock, response = connect_client(self.server_thread.port, name)
+        self.assertEqual(response[STATUS_CODE], 200)
+        self.socks.append(sock)
+        return sock
+
+    def test_snapshot_and_updates(self):
+        watcher = self.connect('watcher')
+        contacts = self.server_thread.server.contacts
+        deadline = time.monotonic() + 5
+        while 'watcher' not in contacts.published and time.monotonic() < deadline:
+            time.sleep(0.01)
+        send_message(watcher, {ACTION: CONTACTS, TIME: 1.1})
+        snapshot = get_message(watcher)
+        self.assertEqual((snapshot[STATUS_CODE], snapshot[REVISION], snapshot[USERS]), (200, 1, ['watcher']))
+
+        other = self.connect('test1')
+        update = get_message(watcher)
+        self.assertEqual((update[ACTION], update[REVISION], update[JOINED], update[LEFT]),
+                         (CONTACTS, 2, ['test1'], []))
+        other.close()
+        update = get_message(watcher)
+        self.assertEqual((update[REVISION], update[JOINED], update[LEFT]), (3, [], ['test1']))
+
+        send_message(watcher, {ACTION: CONTACTS, TIME: 1.1, SUBSCRIBE: False})
+        self.assertEqual(get_message(watcher)[USERS], ['watcher'])
+        self.assertFalse(contacts.subscribers.members)
+
+    def test_request_before_presence_is_rejected(self):
+        sock = socket.create_connection(('127.0.0.1', self.server_thread.port), timeout=5)
+        self.socks.append(sock)
+        send_message(sock, {ACTION: CONTACTS, TIME: 1.1}, LEGACY_PROTOCOL_VERSION)
+        self.assertEqual(get_message(sock)[STATUS_CODE], 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import logging
+import unittest
+import decors
+
+
+def add(first, second):
+    return first + second
+
+
+def caller_function():
+    return decors.log(add)(1, 2)
+
+
+class RecordingHandler(logging.Handler):
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class TestLog(unittest.TestCase):
+
+    def setUp(self):
+        self.level = decors.LOGGER.level
+
+    def tearDown(self):
+        decors.LOGGER.setLevel(self.level)
+        decors.LOG_CALLS = True
+
+    def test_wraps_function(self):
+        wrapped = decors.log(add)
+        self.assertEqual(wrapped(1, 2), 3)
+        self.assertEqual(wrapped.__name__, 'add')
+
+    def test_logs_caller_when_debug_enabled(self):
+        decors.LOGGER.setLevel(logging.DEBUG)
+        with self.assertLogs(decors.LOGGER, logging.DEBUG) as logs:
+            self.assertEqual(caller_function(), 3)
+        self.assertIn('add', logs.output[0])
+        self.assertIn('caller_function', logs.output[0])
+        self.assertEqual(logs.records[0].funcName, 'caller_function')
+
+    def test_silent_when_debug_disabled(self):
+        decors.LOGGER.setLevel(logging.INFO)
+        handler = RecordingHandler()
+        decors.LOGGER.addHandler(handler)
+        try:
+            caller_function()
+        finally:
+            decors.LOGGER.removeHandler(handler)
+        self.assertEqual(handler.records, [])
+
+    def test_disabled_at_import_returns_function(self):
+        decors.LOG_CALLS = False
+        self.assertIs(decors.log(add), add)
+
+
+if __name__ == '__main__':
+    unittest.main()
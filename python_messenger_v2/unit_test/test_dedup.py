@@ -0,0 +1,96 @@
+import time
+import unittest
+from common.utils import send_message, get_message
+from common.variables import ACTION, MESSAGE, TIME, SENDER, DESTINATION, MESSAGE_TEXT, MESSAGE_ID, ACK, \
+    STATUS_CODE
+from server import Server
+from server_core.dedup import SenderWindows
+from unit_test.helpers import ServerThread, connect_client
+
+
+class TestSenderWindows(unittest.TestCase):
+
+    def test_restore_same_session(self):
+        windows = SenderWindows()
+        windows.save('test1', 'a', 10)
+        self.assertEqual(windows.restore('test1', 'a'), 10)
+        # Восстановленный номер снова у соединения
+        self.assertEqual(windows.restore('test1', 'a'), 0)
+
+    def test_new_session_starts_over(self):
+        windows = SenderWindows()
+        windows.save('test1', 'a', 10)
+        self.assertEqual(windows.restore('test1', 'b'), 0)
+        windows.save('test2', None, 10)
+        self.assertEqual(windows.restore('test2', None), 0)
+
+    def test_oldest_sender_is_evicted(self):
+        windows = SenderWindows(limit=2)
+        for number, name in enumerate(('test1', 'test2', 'test3'), 1):
+            windows.save(name, 'a', number)
+        self.assertEqual(windows.restore('test1', 'a'), 0)
+        self.assertEqual(windows.restore('test3', 'a'), 3)
+
+
+class TestDeduplication(unittest.TestCase):
+
+    def setUp(self):
+        self.server_thread = ServerThread(Server('127.0.0.1', 0))
+        self.server_thread.start()
+        self.socks = []
+
+    def tearDown(self):
+        for sock in self.socks:
+            sock.close()
+        self.server_thread.stop()
+
+    def connect(self, name, **options):
+        sock, response = connect_client(self.server_thread.port, name, **options)
+        self.assertEqual(response[STATUS_CODE], 200)
+        self.socks.append(sock)
+        return sock
+
+    def reconnect(self, sock, name, session):
+        sock.close()
+        deadline = time.monotonic() + 5
+        while name in self.server_thread.server.names and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return self.connect(name, session=session)
+
+    @staticmethod
+    def message(number):
+        return {ACTION: MESSAGE, TIME: 1.1, SENDER: 'test1', DESTINATION: 'test2', MESSAGE_TEXT: str(number),
+                MESSAGE_ID: number}
+
+    def test_resent_messages_are_dropped(self):
+        receiver = self.connect('test2')
+        sender = self.connect('test1', session='s1')
+        for number in (1, 2, 3):
+            send_message(sender, self.message(number))
+            self.assertEqual(get_message(receiver)[MESSAGE_ID], number)
+        sender = self.reconnect(sender, 'test1', 's1')
+        for number in (2, 3, 4):
+            send_message(sender, self.message(number))
+        self.assertEqual(get_message(receiver)[MESSAGE_TEXT], '4')
+        self.assertEqual(self.server_thread.server.stats['duplicate_messages'], 2)
+
+    def test_new_session_is_not_deduplicated(self):
+        receiver = self.connect('test2')
+        sender = self.connect('test1', session='s1')
+        send_message(sender, self.message(5))
+        get_message(receiver)
+        sender = self.reconnect(sender, 'test1', 's2')
+        send_message(sender, self.message(1))
+        self.assertEqual(get_message(receiver)[MESSAGE_ID], 1)
+
+    def test_ack_reaches_sender(self):
+        receiver = self.connect('test2')
+        sender = self.connect('test1')
+        send_message(receiver, {ACTION: ACK, SENDER: 'someone', DESTINATION: 'test1', MESSAGE_ID: 7})
+        self.assertEqual(get_message(sender), {ACTION: ACK, SENDER: 'test2', DESTINATION: 'test1', MESSAGE_ID: 7})
+        send_message(receiver, {ACTION: ACK, DESTINATION: 'test1', MESSAGE_ID: '7'})
+        self.assertEqual(get_message(receiver)[STATUS_CODE], 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
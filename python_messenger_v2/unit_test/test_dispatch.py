@@ -0,0 +1,119 @@
+import socket
+import unittest
+from types import SimpleNamespace
+from common.utils import send_message, get_message, encode_message
+from common.variables import ACTION, MESSAGE, TIME, SENDER, DESTINATION, MESSAGE_TEXT, STATUS_CODE, STATUS, \
+    ERROR, USER, JOIN, ROOM, PROTOCOL_VERSION, LEGACY_PROTOCOL_VERSION
+from common.message_codecs import JSON_CODEC, get_codec
+from server import Server, AsyncServer
+from server_core.dispatch import ActionRegistry, CannedResponse, compile_schema
+from unit_test.helpers import ServerThread, AsyncServerThread, connect_client
+
+
+class TestActionRegistry(unittest.TestCase):
+
+    def test_compiled_schema(self):
+        validate = compile_schema({TIME: None, USER: dict, DESTINATION: (str, type(None))})
+        anonymous = SimpleNamespace(name=None)
+        self.assertTrue(validate({TIME: 1, USER: {}, DESTINATION: 'test2'}, anonymous))
+        self.assertTrue(validate({TIME: 1, USER: {}, DESTINATION: None}, anonymous))
+        self.assertFalse(validate({TIME: 1, USER: {}}, anonymous))
+        self.assertFalse(validate({TIME: 1, USER: 'test1', DESTINATION: 'test2'}, anonymous))
+        self.assertFalse(validate({USER: {}, DESTINATION: 'test2'}, anonymous))
+        named = compile_schema({}, named=True)
+        self.assertFalse(named({}, anonymous))
+        self.assertTrue(named({}, SimpleNamespace(name='test1')))
+
+    def test_subclass_extends_copy(self):
+        class Base:
+            actions = ActionRegistry()
+
+            @actions.action('first')
+            def first(self, message, client):
+                return 'base'
+
+        class Child(Base):
+            actions = Base.actions.copy()
+
+            def first(self, message, client):
+                return 'child'
+
+            @actions.action('second', {TIME: None})
+            def second(self, message, client):
+                return 'second'
+
+        self.assertEqual(set(Base.actions.bind(Base())), {'first'})
+        handlers = Child.actions.bind(Child())
+        self.assertEqual(handlers['first'][1](None, None), 'child')
+        self.assertTrue(handlers['second'][0]({TIME: 1}, None))
+
+    def test_canned_response_per_format(self):
+        canned = CannedResponse({STATUS_CODE: 400, STATUS: 'Bad Request', ERROR: 'Ошибка'})
+        legacy = SimpleNamespace(protocol_version=LEGACY_PROTOCOL_VERSION, codec=JSON_CODEC)
+        current = SimpleNamespace(protocol_version=PROTOCOL_VERSION, codec=get_codec('struct'))
+        frame = canned.frame_for(current)
+        self.assertIs(canned.frame_for(SimpleNamespace(protocol_version=PROTOCOL_VERSION,
+                                                       codec=get_codec('struct'))), frame)
+        self.assertEqual(frame, encode_message(canned.message, PROTOCOL_VERSION, get_codec('struct')))
+        self.assertEqual(canned.frame_for(legacy), encode_message(canned.message, LEGACY_PROTOCOL_VERSION))
+        self.assertEqual(len(canned.frames), 2)
+
+
+class EchoServer(Server):
+    """Сервер с дополнительным действием, добавленным без правки разбора сообщений."""
+    actions = Server.actions.copy()
+
+    @actions.action('echo', {MESSAGE_TEXT: str}, named=True)
+    def handle_echo(self, message, client):
+        self.send_to(client, {STATUS_CODE: 200, STATUS: 'OK', MESSAGE_TEXT: message[MESSAGE_TEXT]})
+
+
+class TestDispatch(unittest.TestCase):
+    server_class = EchoServer
+    thread_class = ServerThread
+
+    def setUp(self):
+        self.server_thread = self.thread_class(self.server_class('127.0.0.1', 0))
+        self.server_thread.start()
+        self.sock, response = connect_client(self.server_thread.port, 'test1')
+        self.assertEqual(response[STATUS_CODE], 200)
+
+    def tearDown(self):
+        self.sock.close()
+        self.server_thread.stop()
+
+    def request(self, message):
+        send_message(self.sock, message)
+        return get_message(self.sock)
+
+    def test_bad_requests_keep_connection(self):
+        for message in ({ACTION: 'unknown', TIME: 1.1},
+                        {ACTION: ['list'], TIME: 1.1},
+                        {TIME: 1.1},
+                        {ACTION: MESSAGE, TIME: 1.1, SENDER: 'test1', DESTINATION: 5, MESSAGE_TEXT: 'Привет'},
+                        {ACTION: JOIN, TIME: 1.1, ROOM: 'room'}):
+            response = self.request(message)
+            self.assertEqual((response[STATUS_CODE], response[STATUS]), (400, 'Bad Request'))
+        self.assertEqual(self.request({ACTION: JOIN, TIME: 1.1, ROOM: '#room'})[STATUS_CODE], 200)
+
+    def test_named_action_requires_presence(self):
+        anonymous = socket.create_connection(('127.0.0.1', self.server_thread.port), timeout=5)
+        send_message(anonymous, {ACTION: 'echo', TIME: 1.1, MESSAGE_TEXT: 'Эхо'}, LEGACY_PROTOCOL_VERSION)
+        self.assertEqual(get_message(anonymous)[STATUS_CODE], 400)
+        anonymous.close()
+        self.assertEqual(self.request({ACTION: 'echo', TIME: 1.1, MESSAGE_TEXT: 'Эхо'})[MESSAGE_TEXT], 'Эхо')
+        self.assertEqual(self.request({ACTION: 'echo', TIME: 1.1, MESSAGE_TEXT: 1})[STATUS_CODE], 400)
+
+    def test_plain_server_has_no_extra_action(self):
+        server = Server('127.0.0.1', 0)
+        self.assertNotIn('echo', server.handlers)
+        self.assertIn('echo', self.server_thread.server.handlers)
+
+
+class TestAsyncDispatch(TestDispatch):
+    server_class = type('AsyncEchoServer', (AsyncServer, EchoServer), {})
+    thread_class = AsyncServerThread
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+import select
+import socket
+import time
+import unittest
+from unittest import mock
+from common.utils import send_message, get_message, encode_message
+from common.variables import ACTION, MESSAGE, TIME, SENDER, DESTINATION, MESSAGE_TEXT, STATUS_CODE
+from server import Server
+from server_core.federation import FederationCluster
+from unit_test.helpers import ServerThread, connect_client
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def message(sender, destination, text):
+    return {ACTION: MESSAGE, TIME: 1.1, SENDER: sender, DESTINATION: destination, MESSAGE_TEXT: text}
+
+
+class TestFederation(unittest.TestCase):
+    nodes = 3
+
+    def setUp(self):
+        addresses = {node_id: ('127.0.0.1', free_port()) for node_id in range(self.nodes)}
+        self.threads = []
+        for node_id, address in addresses.items():
+            server = Server('127.0.0.1', 0)
+            server.cluster = FederationCluster(node_id, address, {peer_id: peer_address for peer_id, peer_address
+                                                                  in addresses.items() if peer_id != node_id})
+            thread = ServerThread(server)
+            thread.start()
+            self.threads.append(thread)
+        self.wait(lambda: all(len(thread.server.cluster.links) == self.nodes - 1 for thread in self.threads))
+        self.socks = []
+
+    def tearDown(self):
+        for sock in self.socks:
+            sock.close()
+        for thread in self.threads:
+            thread.stopped.set()
+            thread.join()
+            thread.server.cluster.close()
+            thread.stop()
+
+    @staticmethod
+    def wait(condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                raise AssertionError('Условие не выполнилось за отведенное время')
+            time.sleep(0.01)
+
+    def connect(self, node_id, name):
+        sock, response = connect_client(self.threads[node_id].port, name)
+        self.socks.append(sock)
+        return sock, response[STATUS_CODE]
+
+    def test_name_is_unique_across_nodes(self):
+        self.assertEqual(self.connect(1, 'test1')[1], 200)
+        self.assertEqual(self.connect(2, 'test1')[1], 400)
+        self.assertEqual(self.connect(0, 'test1')[1], 400)
+        self.assertEqual(self.connect(0, 'test2')[1], 200)
+        self.assertEqual(self.connect(2, 'test2')[1], 400)
+        self.assertEqual(self.threads[0].server.cluster.directory, {'test1': 1, 'test2': 0})
+
+    def test_messages_between_nodes(self):
+        first, _ = self.connect(1, 'test1')
+        second, _ = self.connect(2, 'test2')
+        third, _ = self.connect(0, 'test3')
+        self.wait(lambda: len(self.threads[1].server.cluster.locations) == 2)
+        send_message(first, message('test1', 'test2', 'Привет'))
+        self.assertEqual(get_message(second)[MESSAGE_TEXT], 'Привет')
+        send_message(second, message('test2', 'test3', 'Каталогу'))
+        self.assertEqual(get_message(third)[MESSAGE_TEXT], 'Каталогу')
+        send_message(third, message('test3', 'test1', 'Ответ'))
+        self.assertEqual(get_message(first)[MESSAGE_TEXT], 'Ответ')
+
+    def test_burst_is_forwarded_in_order(self):
+        first, _ = self.connect(1, 'test1')
+        second, _ = self.connect(2, 'test2')
+        self.wait(lambda: 'test2' in self.threads[1].server.cluster.locations)
+        first.sendall(b''.join(encode_message(message('test1', 'test2', str(i))) for i in range(500)))
+        for i in range(500):
+            self.assertEqual(get_message(second)[MESSAGE_TEXT], str(i))
+
+    def test_name_released_after_disconnect(self):
+        sock, _ = self.connect(1, 'test1')
+        sock.close()
+        self.wait(lambda: 'test1' not in self.threads[0].server.cluster.directory)
+        self.assertEqual(self.connect(2, 'test1')[1], 200)
+        self.wait(lambda: self.threads[1].server.cluster.locations.get('test1') == 2)
+
+    def test_contacts_include_other_nodes(self):
+        sock, _ = self.connect(1, 'test1')
+        self.connect(2, 'test2')
+        for thread in self.threads:
+            self.wait(lambda: thread.server.contacts.published == {'test1', 'test2'})
+        sock.close()
+        for thread in self.threads:
+            self.wait(lambda: thread.server.contacts.published == {'test2'})
+
+    def test_users_registered_again_after_directory_link_loss(self):
+        first, _ = self.connect(1, 'test1')
+        second, _ = self.connect(2, 'test2')
+        cluster = self.threads[1].server.cluster
+        link = cluster.links[0]
+        link.sock.shutdown(socket.SHUT_RDWR)
+        self.wait(lambda: cluster.links.get(0) not in (None, link))
+        self.wait(lambda: self.threads[0].server.cluster.directory.get('test1') == 1 and
+                  self.threads[2].server.cluster.locations.get('test1') == 1)
+        self.assertEqual(self.connect(2, 'test1')[1], 400)
+        send_message(second, message('test2', 'test1', 'Снова на связи'))
+        self.assertEqual(get_message(first)[MESSAGE_TEXT], 'Снова на связи')
+
+    def test_link_replaced_without_losing_users(self):
+        first, _ = self.connect(1, 'test1')
+        second, _ = self.connect(2, 'test2')
+        self.wait(lambda: self.threads[2].server.cluster.locations.get('test1') == 1)
+        # Цикл узла 1 продолжает тест в своем потоке, чтобы открыть вторую связь при живой первой
+        thread = self.threads[1]
+        thread.stopped.set()
+        thread.join()
+        cluster = thread.server.cluster
+        link = cluster.links[0]
+        directory = self.threads[0].server.cluster
+        with mock.patch.object(directory, 'leave', wraps=directory.leave) as leave:
+            cluster.connect(0)
+
+            def replaced():
+                thread.server.run_once(0.01)
+                return cluster.links.get(0) not in (None, link)
+
+            self.wait(replaced)
+            for _ in range(20):
+                thread.server.run_once(0.01)
+        # Каталог не снимал пользователей узла 1 при замене связи
+        leave.assert_not_called()
+        self.assertEqual(self.threads[0].server.cluster.directory, {'test1': 1, 'test2': 2})
+        self.assertEqual(self.threads[2].server.cluster.locations.get('test1'), 1)
+        self.assertEqual(cluster.locations.get('test2'), 2)
+        send_message(second, message('test2', 'test1', 'Через новую связь'))
+
+        def delivered():
+            thread.server.run_once(0.01)
+            return bool(select.select([first], [], [], 0)[0])
+
+        self.wait(delivered)
+        self.assertEqual(get_message(first)[MESSAGE_TEXT], 'Через новую связь')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import os
+import shutil
+import tempfile
+import unittest
+from common.utils import send_message, get_message
+from common.variables import ACTION, MESSAGE, TIME, SENDER, DESTINATION, MESSAGE_TEXT, STATUS_CODE, \
+    HISTORY, LIMIT, BEFORE, MESSAGES, JOIN, ROOM, CODEC
+from common.message_codecs import get_codec
+from server import Server
+from server_core.history import MessageHistory, PAGE, ROOM_PAGE
+from unit_test.helpers import ServerThread, connect_client
+
+
+def message(sender, destination, text):
+    return {ACTION: MESSAGE, TIME: 1.1, SENDER: sender, DESTINATION: destination, MESSAGE_TEXT: text}
+
+
+class TestMessageHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='messenger-history-')
+        self.path = os.path.join(self.directory, 'history.db')
+        self.history = MessageHistory(self.path)
+
+    def tearDown(self):
+        self.history.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def pages(self, name, peer, limit):
+        texts = []
+        before = None
+        while True:
+            messages, before = self.history.query(name, peer, limit, before)
+            texts.extend(item[MESSAGE_TEXT] for item in messages)
+            if before is None:
+                return texts
+
+    def test_pagination_over_both_directions(self):
+        for i in range(10):
+            sender, destination = ('test1', 'test2') if i % 2 else ('test2', 'test1')
+            self.history.record(sender, destination, message(sender, destination, str(i)))
+            # Посторонняя переписка не попадает в историю
+            self.history.record('test1', 'test3', message('test1', 'test3', 'чужое'))
+            if i == 4:
+                self.assertTrue(self.history.sync(5))
+        expected = [str(i) for i in reversed(range(10))]
+        # Часть записей еще может быть в памяти, часть уже в базе
+        self.assertEqual(self.pages('test1', 'test2', 3), expected)
+        self.assertTrue(self.history.sync(5))
+        self.assertEqual(self.pages('test2', 'test1', 4), expected)
+        self.assertEqual(self.pages('test1', 'test2', 10), expected)
+
+    def test_frames_are_stored_in_their_codec(self):
+        codec = get_codec('struct')
+        self.history.record('test1', '#room', payload=memoryview(codec.encode(message('test1', '#room', 'кадр'))),
+                            codec=codec)
+        self.history.record('test2', '#room', message('test2', '#room', 'словарь'))
+        self.history.close()
+        self.history = MessageHistory(self.path)
+        messages, before = self.history.query('test3', '#room', 10)
+        self.assertEqual([item[MESSAGE_TEXT] for item in messages], ['словарь', 'кадр'])
+        self.assertIsNone(before)
+        self.assertEqual(self.history.record('test1', 'test2', message('test1', 'test2', 'новое')), 3)
+
+    def test_pages_are_read_through_indexes(self):
+        for statement, params, index in ((PAGE, ('a', 'b', 1.0, 1.0, 5, 10), 'messages_conversation'),
+                                         (ROOM_PAGE, ('#a', 1.0, 1.0, 5, 10), 'messages_room')):
+            plan = ' '.join(row[-1] for row in self.history.reader.execute('EXPLAIN QUERY PLAN ' + statement, params))
+            self.assertIn(index, plan)
+            self.assertNotIn('TEMP B-TREE', plan)
+
+
+class TestHistoryRequests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='messenger-history-')
+        self.history = MessageHistory(os.path.join(self.directory, 'history.db'))
+        self.server_thread = ServerThread(Server('127.0.0.1', 0, history=self.history))
+        self.server_thread.start()
+        self.socks = []
+
+    def tearDown(self):
+        for sock in self.socks:
+            sock.close()
+        self.server_thread.stop()
+        self.history.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def connect(self, name):
+        sock, response = connect_client(self.server_thread.port, name, codecs=['struct'])
+        self.socks.append(sock)
+        self.assertEqual(response[STATUS_CODE], 200)
+        return sock, get_codec(response[CODEC])
+
+    def test_history_request(self):
+        sender, codec = self.connect('test1')
+        receiver, _ = self.connect('test2')
+        for i in range(5):
+            send_message(sender, message('test1', 'test2', str(i)), codec=codec)
+            get_message(receiver, codec)
+        self.assertEqual(self.server_thread.server.stats['relayed_frames'], 5)
+
+        send_message(receiver, {ACTION: HISTORY, TIME: 1.1, DESTINATION: 'test1', LIMIT: 3}, codec=codec)
+        response = get_message(receiver, codec)
+        self.assertEqual(response[STATUS_CODE], 200)
+        self.assertEqual([item[MESSAGE_TEXT] for item in response[MESSAGES]], ['4', '3', '2'])
+        send_message(receiver, {ACTION: HISTORY, TIME: 1.1, DESTINATION: 'test1', LIMIT: 3,
+                                BEFORE: response[BEFORE]}, codec=codec)
+        response = get_message(receiver, codec)
+        self.assertEqual([item[MESSAGE_TEXT] for item in response[MESSAGES]], ['1', '0'])
+        self.assertIsNone(response[BEFORE])
+
+    def test_room_history_requires_membership(self):
+        sender, codec = self.connect('test1')
+        send_message(sender, {ACTION: HISTORY, TIME: 1.1, DESTINATION: '#news'}, codec=codec)
+        self.assertEqual(get_message(sender, codec)[STATUS_CODE], 403)
+        send_message(sender, {ACTION: JOIN, TIME: 1.1, ROOM: '#news'}, codec=codec)
+        get_message(sender, codec)
+        send_message(sender, message('test1', '#news', 'новость'), codec=codec)
+        send_message(sender, {ACTION: HISTORY, TIME: 1.1, DESTINATION: '#news'}, codec=codec)
+        response = get_message(sender, codec)
+        self.assertEqual([item[MESSAGE_TEXT] for item in response[MESSAGES]], ['новость'])
+        send_message(sender, {ACTION: HISTORY, TIME: 1.1, DESTINATION: '#news', LIMIT: 0}, codec=codec)
+        self.assertEqual(get_message(sender, codec)[STATUS_CODE], 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import unittest
+from common.variables import ACTION, MESSAGE, TIME, SENDER, DESTINATION, MESSAGE_TEXT, PRESENCE, USER, \
+    ACCOUNT_NAME, MESSAGE_ID
+from common.message_codecs import CODECS, StructCodec, JSON_CODEC, negotiate_codec, get_codec
+
+
+class TestMessageCodecs(unittest.TestCase):
+    message = {ACTION: MESSAGE, TIME: 1.5, SENDER: 'Гость', DESTINATION: 'test2', MESSAGE_TEXT: 'Привет' * 10}
+    presence = {ACTION: PRESENCE, TIME: '1.1', USER: {ACCOUNT_NAME: 'Guest'}}
+    numbered = dict(message, **{MESSAGE_ID: 2 ** 40})
+
+    def test_round_trip(self):
+        for codec in CODECS.values():
+            for message in (self.message, self.presence, self.numbered):
+                self.assertEqual(codec.decode(memoryview(codec.encode(message))), message, codec.name)
+
+    def test_struct_codec_packs_messages(self):
+        codec = StructCodec()
+        payload = codec.encode(self.message)
+        self.assertEqual(payload[0], StructCodec.KIND_MESSAGE)
+        self.assertLess(len(payload), len(JSON_CODEC.encode(self.message)))
+        self.assertEqual(codec.encode(self.presence)[0], StructCodec.KIND_JSON)
+        self.assertEqual(codec.encode(self.numbered)[0], StructCodec.KIND_MESSAGE_ID)
+        self.assertEqual(codec.encode(dict(self.message, **{MESSAGE_ID: -1}))[0], StructCodec.KIND_JSON)
+
+    def test_struct_codec_rejects_broken_payload(self):
+        codec = StructCodec()
+        payload = codec.encode(self.message)
+        with self.assertRaises(ValueError):
+            codec.decode(payload[:-1])
+        with self.assertRaises(ValueError):
+            codec.decode(payload[:5])
+
+    def test_peek_route(self):
+        for codec in CODECS.values():
+            route = codec.peek_route(memoryview(codec.encode(self.message)))
+            if codec is not JSON_CODEC:
+                self.assertEqual(route, ('Гость', 'test2', None), codec.name)
+                route = codec.peek_route(memoryview(codec.encode(self.numbered)))
+                self.assertEqual(route, ('Гость', 'test2', 2 ** 40), codec.name)
+            self.assertIsNone(codec.peek_route(codec.encode(self.presence)), codec.name)
+        self.assertIsNone(StructCodec().peek_route(StructCodec().encode(self.message)[:-1]))
+
+    def test_negotiate_codec(self):
+        self.assertIs(negotiate_codec(['json', 'struct']), CODECS['struct'])
+        self.assertIs(negotiate_codec(['unknown']), JSON_CODEC)
+        self.assertIs(negotiate_codec(None), JSON_CODEC)
+        self.assertIs(get_codec(None), JSON_CODEC)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+import os
+import socket
+import tempfile
+import unittest
+import urllib.request
+from collections import Counter
+from common.utils import send_message, get_message
+from common.variables import ACTION, MESSAGE, TIME, SENDER, DESTINATION, MESSAGE_TEXT
+from server import Server, AsyncServer
+from server_core.metrics import Histogram, Metrics, start_admin_server
+from logs.configs.queue_logging import dropped_records
+from unit_test.helpers import ServerThread, AsyncServerThread, connect_client
+
+
+def parse_metrics(text):
+    values = dict()
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            values[name] = float(value)
+    return values
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_histogram_buckets(self):
+        histogram = Histogram('test_seconds', 'Тест', bounds=(0.001, 0.01, 0.1))
+        histogram.observe(0.0005)
+        histogram.observe(0.05, 3)
+        histogram.observe(5)
+        self.assertEqual(histogram.counts, [1, 0, 3, 1])
+        lines = []
+        histogram.render(lines)
+        values = parse_metrics('\n'.join(lines))
+        self.assertEqual(values['messenger_test_seconds_bucket{le="0.01"}'], 1)
+        self.assertEqual(values['messenger_test_seconds_bucket{le="0.1"}'], 4)
+        self.assertEqual(values['messenger_test_seconds_bucket{le="+Inf"}'], 5)
+        self.assertEqual(values['messenger_test_seconds_count'], 5)
+
+    def test_render_counters_and_gauges(self):
+        stats = Counter(connections=3)
+        metrics = Metrics(stats)
+        metrics.histogram('stage_seconds', 'Этапы', bounds=(0.1,), labels={'stage': 'read'}).observe(0.05)
+        metrics.histogram('stage_seconds', 'Этапы', bounds=(0.1,), labels={'stage': 'send'}).observe(1)
+        metrics.gauge('clients', 'Клиенты', lambda: 2)
+        metrics.gauge('broken', 'Ошибка', lambda: 1 / 0)
+        text = metrics.render()
+        self.assertIn('# TYPE messenger_connections_total counter', text)
+        values = parse_metrics(text)
+        self.assertEqual(values['messenger_connections_total'], 3)
+        self.assertEqual(values['messenger_clients'], 2)
+        self.assertNotIn('messenger_broken', values)
+        self.assertEqual(text.count('# TYPE messenger_stage_seconds histogram'), 1)
+        self.assertEqual(values['messenger_stage_seconds_bucket{stage="read",le="0.1"}'], 1)
+        self.assertEqual(values['messenger_stage_seconds_bucket{stage="send",le="+Inf"}'], 1)
+        self.assertEqual(values['messenger_stage_seconds_count{stage="send"}'], 1)
+
+    @unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'нужны unix-сокеты')
+    def test_unix_socket_endpoint(self):
+        path = os.path.join(tempfile.mkdtemp(prefix='messenger-admin-'), 'metrics.sock')
+        admin_server = start_admin_server(Metrics(Counter(presences=1)), path)
+        try:
+            with socket.socket(socket.AF_UNIX) as sock:
+                sock.connect(path)
+                sock.sendall(b'GET /metrics HTTP/1.0\r\n\r\n')
+                response = b''
+                while chunk := sock.recv(65536):
+                    response += chunk
+            self.assertIn(b'200', response.split(b'\r\n', 1)[0])
+            self.assertIn(b'messenger_presences_total 1', response)
+        finally:
+            admin_server.shutdown()
+            admin_server.server_close()
+            os.unlink(path)
+
+
+class TestServerMetrics(unittest.TestCase):
+    server_class = Server
+    thread_class = ServerThread
+
+    def setUp(self):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            self.admin_port = sock.getsockname()[1]
+        self.server_thread = self.thread_class(self.server_class('127.0.0.1', 0, admin_address=self.admin_port))
+        self.server_thread.start()
+        self.socks = []
+
+    def tearDown(self):
+        for sock in self.socks:
+            sock.close()
+        self.server_thread.stop()
+        self.server_thread.server.stop_admin()
+
+    def scrape(self):
+        with urllib.request.urlopen(f'http://127.0.0.1:{self.admin_port}/metrics', timeout=5) as response:
+            self.assertTrue(response.headers['Content-Type'].startswith('text/plain'))
+            return parse_metrics(response.read().decode('utf-8'))
+
+    def test_relay_is_counted(self):
+        for name in ('test1', 'test2'):
+            sock, _ = connect_client(self.server_thread.port, name)
+            self.socks.append(sock)
+        message = {ACTION: MESSAGE, TIME: 1.1, SENDER: 'test1', DESTINATION: 'test2', MESSAGE_TEXT: 'Привет'}
+        for _ in range(3):
+            send_message(self.socks[0], message)
+            get_message(self.socks[1])
+        values = self.scrape()
+        self.assertEqual(values['messenger_connections_total'], 2)
+        self.assertEqual(values['messenger_presences_total'], 2)
+        self.assertEqual(values['messenger_relayed_messages_total'], 3)
+        self.assertEqual(values['messenger_clients'], 2)
+        self.assertEqual(values['messenger_relay_seconds_count'], 3)
+        self.assertGreater(values['messenger_bytes_in_total'], 0)
+        self.assertGreater(values['messenger_bytes_out_total'], 0)
+        self.assertEqual(values['messenger_log_records_dropped'], dropped_records())
+
+
+class TestAsyncServerMetrics(TestServerMetrics):
+    server_class = AsyncServer
+    thread_class = AsyncServerThread
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,198 @@
+import os
+import shutil
+import socket
+import tempfile
+import time
+import unittest
+from unittest import mock
+from common.utils import send_message, get_message, MessageDecoder
+from common.variables import ACTION, MESSAGE, TIME, SENDER, DESTINATION, MESSAGE_TEXT, STATUS_CODE
+from server import Server
+from server_core.connection import ClientConnection
+from server_core.offline import OfflineStore
+from unit_test.helpers import ServerThread, connect_client
+
+
+def message(sender, destination, text):
+    return {ACTION: MESSAGE, TIME: 1.1, SENDER: sender, DESTINATION: destination, MESSAGE_TEXT: text}
+
+
+class TestOfflineStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='messenger-offline-')
+        self.stores = []
+
+    def tearDown(self):
+        for store in self.stores:
+            store.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def open_store(self, **options):
+        store = OfflineStore(self.directory, **options)
+        self.stores.append(store)
+        return store
+
+    def reopen(self, store, **options):
+        store.close()
+        self.stores.remove(store)
+        return self.open_store(**options)
+
+    def texts(self, store, name, max_bytes=1 << 20):
+        return [item[MESSAGE_TEXT] for _, item in store.read(name, max_bytes)]
+
+    def test_store_and_recover(self):
+        store = self.open_store()
+        for i in range(5):
+            store.store(message('test1', 'test2', str(i)), 'test2')
+        store.store(message('test2', 'test1', 'ответ'), 'test1')
+        batch = store.read('test2', 1)
+        self.assertEqual(len(batch), 1)
+        store.delivered('test2', batch[0][0])
+        self.assertEqual(self.texts(store, 'test2'), ['1', '2', '3', '4'])
+
+        store = self.reopen(store)
+        self.assertEqual(self.texts(store, 'test2'), ['1', '2', '3', '4'])
+        self.assertEqual(self.texts(store, 'test1'), ['ответ'])
+        record_id = store.store(message('test1', 'test2', '5'), 'test2')
+        store.delivered('test2', record_id)
+        self.assertFalse(store.has_mail('test2'))
+
+    def test_torn_tail_is_truncated(self):
+        store = self.open_store()
+        store.store(message('test1', 'test2', 'целое'), 'test2')
+        store.sync()
+        path = store._path(store.active)
+        store = self.reopen(store)
+        with open(path, 'ab') as file:
+            file.write(b'\x00\x01\x02')
+        store = self.reopen(store)
+        self.assertEqual(self.texts(store, 'test2'), ['целое'])
+        self.assertEqual(os.path.getsize(path), store.segments[int(os.path.basename(path)[:-4])].size)
+
+    def test_compaction_keeps_undelivered_in_order(self):
+        store = self.open_store(segment_size=512)
+        ids = [store.store(message('test1', 'test2' if i % 4 else 'test3', str(i)), 'test2' if i % 4 else 'test3')
+               for i in range(40)]
+        store.delivered('test2', ids[30])
+        store.sync()
+        segments_before = len(store.segments)
+        store.maintain()
+        self.assertLess(len(store.segments), segments_before)
+        expected_test2 = [str(i) for i in range(31, 40) if i % 4]
+        expected_test3 = [str(i) for i in range(40) if not i % 4]
+        self.assertEqual(self.texts(store, 'test2'), expected_test2)
+        self.assertEqual(self.texts(store, 'test3'), expected_test3)
+
+        store = self.reopen(store, segment_size=512)
+        self.assertEqual(self.texts(store, 'test2'), expected_test2)
+        self.assertEqual(self.texts(store, 'test3'), expected_test3)
+
+    def test_retention_expires_old_segments(self):
+        store = self.open_store(segment_size=256, retention=60)
+        for i in range(10):
+            store.store(message('test1', 'test2', str(i)), 'test2')
+        store.sync()
+        store.maintain(now=time.time() + 120)
+        self.assertEqual(list(store.segments), [store.active])
+        self.assertLess(len(self.texts(store, 'test2')), 10)
+
+    def test_failed_commit_is_retried(self):
+        store = self.open_store(retry_interval=0.01)
+        store.store(message('test1', 'test2', 'первое'), 'test2')
+        self.assertTrue(store.sync(5))
+        with mock.patch('server_core.offline.os.fsync', side_effect=OSError('нет места')):
+            store.store(message('test1', 'test2', 'второе'), 'test2')
+            self.assertFalse(store.sync(5))
+        self.assertTrue(store.sync(5))
+        store = self.reopen(store)
+        self.assertEqual(self.texts(store, 'test2'), ['первое', 'второе'])
+
+    def test_read_after_cursor(self):
+        store = self.open_store()
+        ids = [store.store(message('test1', 'test2', str(i)), 'test2') for i in range(3)]
+        self.assertEqual([item[MESSAGE_TEXT] for _, item in store.read('test2', 1 << 20, ids[0])], ['1', '2'])
+        self.assertTrue(store.has_mail('test2', ids[1]))
+        self.assertFalse(store.has_mail('test2', ids[2]))
+
+
+class TestOfflineDelivery(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='messenger-offline-')
+        self.store = OfflineStore(self.directory)
+        self.server_thread = ServerThread(Server('127.0.0.1', 0, offline=self.store, high_watermark=2048,
+                                                 low_watermark=512))
+        self.server_thread.start()
+        self.socks = []
+
+    def tearDown(self):
+        for sock in self.socks:
+            sock.close()
+        self.server_thread.stop()
+        self.store.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def connect(self, name):
+        sock, response = connect_client(self.server_thread.port, name)
+        self.socks.append(sock)
+        self.assertEqual(response[STATUS_CODE], 200)
+        return sock
+
+    def test_messages_delivered_after_presence(self):
+        sender = self.connect('test1')
+        for i in range(50):
+            send_message(sender, message('test1', 'test2', str(i) * 100))
+        deadline = time.monotonic() + 5
+        while self.server_thread.server.stats['offline_stored'] < 50 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        receiver = self.connect('test2')
+        send_message(sender, message('test1', 'test2', 'после входа'))
+        for i in range(50):
+            self.assertEqual(get_message(receiver)[MESSAGE_TEXT], str(i) * 100)
+        self.assertEqual(get_message(receiver)[MESSAGE_TEXT], 'после входа')
+        self.assertFalse(self.store.has_mail('test2'))
+
+
+class TestOfflineConfirmation(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='messenger-offline-')
+        self.store = OfflineStore(self.directory)
+        self.server = Server('127.0.0.1', 0, offline=self.store)
+        self.sock, self.peer = socket.socketpair()
+        self.sock.setblocking(False)
+        self.client = ClientConnection(self.sock, 'test2')
+        self.client.name = 'test2'
+        self.server.clients.add(self.client)
+        self.server.names['test2'] = self.client
+        self.server.selector.register(self.sock, self.client.events, self.client)
+        for i in range(3):
+            self.store.store(message('test1', 'test2', str(i)), 'test2')
+
+    def tearDown(self):
+        if not self.client.closed:
+            self.server.remove_client(self.client)
+        self.peer.close()
+        self.server.selector.close()
+        self.store.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_delivered_after_flush(self):
+        self.server.deliver_offline(self.client)
+        self.assertFalse(self.client.mailbox)
+        # Кадры еще в очереди соединения: после сбоя сообщения будут доставлены снова
+        self.assertTrue(self.store.has_mail('test2'))
+        self.server.flush_clients()
+        self.assertFalse(self.store.has_mail('test2'))
+        texts = [item[MESSAGE_TEXT] for item in MessageDecoder().feed(self.peer.recv(65536))]
+        self.assertEqual(texts, ['0', '1', '2'])
+
+    def test_unflushed_messages_stay_in_mailbox(self):
+        self.server.deliver_offline(self.client)
+        self.server.remove_client(self.client)
+        self.assertEqual(len(self.store.read('test2', 1 << 20)), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
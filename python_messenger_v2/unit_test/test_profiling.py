@@ -0,0 +1,152 @@
+import pstats
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+import urllib.error
+import urllib.request
+from collections import Counter
+from common.utils import send_message, get_message
+from common.variables import ACTION, MESSAGE, TIME, SENDER, DESTINATION, MESSAGE_TEXT
+from server import Server
+from server_core.metrics import Metrics, start_admin_server
+from server_core.profiling import LoopProfiler, PROFILE_SAMPLE, PROFILE_TRACE
+from unit_test.helpers import ServerThread, connect_client
+
+
+def busy_loop_marker(profiler, stopped):
+    while not stopped.is_set():
+        profiler.tick()
+        sum(range(1000))
+
+
+class TestLoopProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='messenger-profile-')
+        self.profiler = LoopProfiler(self.directory, interval=0.001)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=busy_loop_marker, args=(self.profiler, self.stopped))
+        self.thread.start()
+
+    def tearDown(self):
+        self.stopped.set()
+        self.thread.join()
+        shutil.rmtree(self.directory)
+
+    def wait_done(self, timeout=5):
+        deadline = time.monotonic() + timeout
+        while self.profiler.active:
+            if time.monotonic() > deadline:
+                raise AssertionError('Профилирование не завершилось')
+            time.sleep(0.01)
+
+    def test_sample_writes_collapsed_stacks(self):
+        path = self.profiler.start(PROFILE_SAMPLE, 0.2)
+        self.assertIsNone(self.profiler.start(PROFILE_TRACE, 0.2))
+        self.wait_done()
+        with open(path, encoding='utf-8') as file:
+            lines = file.read().splitlines()
+        self.assertTrue(lines)
+        stack, count = lines[0].rsplit(' ', 1)
+        self.assertGreater(int(count), 0)
+        self.assertIn('busy_loop_marker', stack)
+        self.assertTrue(path.endswith('.collapsed'))
+
+    def test_trace_writes_pstats(self):
+        path = self.profiler.start(PROFILE_TRACE, 0.1)
+        self.wait_done()
+        functions = {name for _, _, name in pstats.Stats(path).stats}
+        self.assertIn('tick', functions)
+        self.assertIn("<built-in method builtins.sum>", functions)
+
+
+class TestProfileEndpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='messenger-profile-')
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            self.port = sock.getsockname()[1]
+        self.profiler = LoopProfiler(self.directory)
+        self.admin_server = start_admin_server(Metrics(Counter()), self.port, self.profiler)
+
+    def tearDown(self):
+        self.admin_server.shutdown()
+        self.admin_server.server_close()
+        shutil.rmtree(self.directory)
+
+    def post(self, query):
+        request = urllib.request.Request(f'http://127.0.0.1:{self.port}/profile?{query}', method='POST')
+        try:
+            with urllib.request.urlopen(request, timeout=5) as response:
+                return response.status, response.read().decode('utf-8')
+        except urllib.error.HTTPError as err:
+            return err.code, ''
+
+    def test_trace_is_requested(self):
+        status, body = self.post('mode=trace&seconds=5')
+        self.assertEqual(status, 202)
+        self.assertTrue(body.strip().endswith('.pstats'))
+        self.assertEqual(self.profiler.requested, (5, body.strip()))
+        self.assertEqual(self.post('mode=sample&seconds=1')[0], 409)
+
+    def test_bad_request(self):
+        self.assertEqual(self.post('mode=perf')[0], 400)
+        self.assertEqual(self.post('seconds=-1')[0], 400)
+        self.assertFalse(self.profiler.active)
+
+
+class TestIdleServerProfile(unittest.TestCase):
+
+    def test_trace_finishes_without_events(self):
+        directory = tempfile.mkdtemp(prefix='messenger-profile-')
+        server = Server('127.0.0.1', 0, profile_dir=directory)
+        server.init_socket()
+        path = server.profiler.start(PROFILE_TRACE, 0.1)
+
+        def idle_loop():
+            # Клиентов и таймеров нет: без ограничения select ждал бы события бесконечно
+            while server.profiler.active:
+                server.run_once()
+
+        thread = threading.Thread(target=idle_loop, daemon=True)
+        thread.start()
+        try:
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+            self.assertIn('run_once', {name for _, _, name in pstats.Stats(path).stats})
+        finally:
+            server.selector.close()
+            server.sock.close()
+            shutil.rmtree(directory)
+
+
+class TestStageTimers(unittest.TestCase):
+
+    def test_stages_are_observed(self):
+        thread = ServerThread(Server('127.0.0.1', 0))
+        thread.start()
+        socks = []
+        try:
+            for name in ('test1', 'test2'):
+                sock, _ = connect_client(thread.port, name)
+                socks.append(sock)
+            message = {ACTION: MESSAGE, TIME: 1.1, SENDER: 'test1', DESTINATION: 'test2', MESSAGE_TEXT: 'Привет'}
+            send_message(socks[0], message)
+            get_message(socks[1])
+        finally:
+            for sock in socks:
+                sock.close()
+            thread.stop()
+        server = thread.server
+        self.assertEqual(server.accept_time.count, 2)
+        for histogram in (server.read_time, server.decode_time, server.dispatch_time, server.route_time,
+                          server.send_time):
+            self.assertGreater(histogram.count, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import json
+import logging
+import queue
+import sys
+import unittest
+from logs.configs.queue_logging import BoundedQueueHandler, JsonLinesFormatter, setup_queue_logging, \
+    dropped_records, DROP_NEWEST, DROP_OLDEST
+
+
+def make_record(msg, *args, exc_info=None):
+    return logging.LogRecord('server', logging.INFO, __file__, 1, msg, args, exc_info)
+
+
+class RecordingHandler(logging.Handler):
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class TestQueueLogging(unittest.TestCase):
+
+    def test_drop_newest(self):
+        handler = BoundedQueueHandler(queue.Queue(2), DROP_NEWEST)
+        for i in range(4):
+            handler.handle(make_record('запись %s', i))
+        self.assertEqual(handler.dropped, 2)
+        self.assertEqual([handler.queue.get_nowait().msg for _ in range(2)], ['запись 0', 'запись 1'])
+
+    def test_drop_oldest(self):
+        handler = BoundedQueueHandler(queue.Queue(2), DROP_OLDEST)
+        for i in range(4):
+            handler.handle(make_record('запись %s', i))
+        self.assertEqual(handler.dropped, 2)
+        self.assertEqual([handler.queue.get_nowait().msg for _ in range(2)], ['запись 2', 'запись 3'])
+
+    def test_message_formatted_on_enqueue(self):
+        handler = BoundedQueueHandler(queue.Queue(2))
+        members = ['test1']
+        record = make_record('участники %s', members)
+        handler.handle(record)
+        members.append('test2')
+        queued = handler.queue.get_nowait()
+        self.assertEqual((queued.msg, queued.args), ("участники ['test1']", None))
+        self.assertEqual(record.msg, 'участники %s')
+
+    def test_exception_text_kept(self):
+        handler = BoundedQueueHandler(queue.Queue(2))
+        try:
+            raise ValueError('сбой')
+        except ValueError:
+            handler.handle(make_record('ошибка', exc_info=sys.exc_info()))
+        queued = handler.queue.get_nowait()
+        self.assertIsNone(queued.exc_info)
+        self.assertIn('ValueError: сбой', queued.exc_text)
+        self.assertIn('ValueError: сбой', logging.Formatter().format(queued))
+        self.assertIn('ValueError: сбой', json.loads(JsonLinesFormatter().format(queued))['exc'])
+
+    def test_json_lines_formatter(self):
+        line = JsonLinesFormatter().format(make_record('Привет, %s', 'мир'))
+        entry = json.loads(line)
+        self.assertEqual(entry['message'], 'Привет, мир')
+        self.assertEqual(entry['level'], 'INFO')
+        self.assertNotIn('\n', line)
+
+    def test_listener_delivers_records(self):
+        logger = logging.getLogger('test_queue_logging')
+        logger.propagate = False
+        recording = RecordingHandler()
+        queue_handler = setup_queue_logging(logger, (recording,), maxsize=10)
+        try:
+            logger.warning('запись %s', 1)
+            queue_handler.stop_listener()
+        finally:
+            logger.removeHandler(queue_handler)
+        self.assertEqual([record.getMessage() for record in recording.records], ['запись 1'])
+
+    def test_dropped_records_are_summed(self):
+        logger = logging.getLogger('test_queue_logging_dropped')
+        logger.propagate = False
+        queue_handler = setup_queue_logging(logger, (RecordingHandler(),), maxsize=10)
+        before = dropped_records()
+        try:
+            # Без потока записи очередь заполняется, и лишние записи теряются
+            queue_handler.stop_listener()
+            for number in range(15):
+                logger.warning('запись %s', number)
+        finally:
+            logger.removeHandler(queue_handler)
+        self.assertEqual(dropped_records() - before, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
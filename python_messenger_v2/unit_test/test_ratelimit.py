@@ -0,0 +1,148 @@
+import time
+import unittest
+from collections import namedtuple
+from common.utils import send_message, get_message, encode_message
+from common.variables import ACTION, MESSAGE, TIME, SENDER, DESTINATION, MESSAGE_TEXT, STATUS_CODE, \
+    RATE_LIMIT_REJECT, RATE_LIMIT_DISCONNECT
+from server import Server, AsyncServer
+from server_core.ratelimit import RateLimiter
+from unit_test.helpers import ServerThread, AsyncServerThread, connect_client
+
+FakeClient = namedtuple('FakeClient', 'name addr')
+
+
+def message(sender, destination, text):
+    return {ACTION: MESSAGE, TIME: 1.1, SENDER: sender, DESTINATION: destination, MESSAGE_TEXT: text}
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_account_bucket(self):
+        limiter = RateLimiter(account_rate=4, account_burst=3)
+        client = FakeClient('test1', ('127.0.0.1', 1))
+        self.assertEqual([limiter.acquire(client, 100) for _ in range(3)], [0, 0, 0])
+        self.assertEqual(limiter.acquire(client, 100), 0.25)
+        self.assertEqual(limiter.acquire(client, 100.125), 0.125)
+        self.assertEqual(limiter.acquire(client, 100.25), 0)
+        # Клиент до приветствия ограничивается только по адресу
+        self.assertEqual(limiter.acquire(FakeClient(None, ('127.0.0.1', 2)), 100.25), 0)
+
+    def test_address_bucket_is_shared(self):
+        limiter = RateLimiter(account_rate=100, ip_rate=1, ip_burst=2)
+        first = FakeClient('test1', ('10.0.0.1', 1))
+        second = FakeClient('test2', ('10.0.0.1', 2))
+        self.assertEqual(limiter.acquire(first, 0), 0)
+        self.assertEqual(limiter.acquire(second, 0), 0)
+        self.assertEqual(limiter.acquire(second, 0), 1)
+        # Отказ по адресу не списывает маркер из корзины учетной записи
+        self.assertEqual(limiter.accounts.buckets['test2'].tokens, 99)
+        self.assertEqual(limiter.acquire(FakeClient('test3', ('10.0.0.2', 1)), 0), 0)
+
+    def test_prune_full_buckets(self):
+        limiter = RateLimiter(account_rate=1, account_burst=5, ip_rate=1)
+        limiter.acquire(FakeClient('test1', ('10.0.0.1', 1)), 0)
+        self.assertEqual(len(limiter), 2)
+        limiter.prune(0.5)
+        self.assertEqual(len(limiter), 2)
+        limiter.prune(1)
+        self.assertEqual(len(limiter), 0)
+
+
+class OrderedServer(Server):
+    """Сервер, запоминающий порядок доставки кадров получателям."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.deliveries = []
+
+    def deliver(self, client, frame, sender=None):
+        self.deliveries.append(client.name)
+        return super().deliver(client, frame, sender)
+
+
+class TestFairScheduling(unittest.TestCase):
+
+    def setUp(self):
+        self.server_thread = ServerThread(OrderedServer('127.0.0.1', 0, fair_quantum=4))
+        self.server_thread.start()
+        self.socks = dict()
+        for name in ('test1', 'test2', 'test3', 'test4'):
+            self.socks[name], response = connect_client(self.server_thread.port, name)
+            self.assertEqual(response[STATUS_CODE], 200)
+
+    def tearDown(self):
+        for sock in self.socks.values():
+            sock.close()
+        self.server_thread.stop()
+
+    def test_flood_does_not_starve_others(self):
+        count = 2000
+        flood = b''.join(encode_message(message('test1', 'test2', str(i))) for i in range(count))
+        self.socks['test1'].sendall(flood)
+        send_message(self.socks['test3'], message('test3', 'test4', 'Не ждет'))
+        self.assertEqual(get_message(self.socks['test4'])[MESSAGE_TEXT], 'Не ждет')
+        for i in range(count):
+            self.assertEqual(get_message(self.socks['test2'])[MESSAGE_TEXT], str(i))
+        deliveries = self.server_thread.server.deliveries
+        self.assertLess(deliveries.index('test4'), len(deliveries) - 1)
+        self.assertFalse(self.server_thread.server.backlog)
+
+
+class TestRateLimits(unittest.TestCase):
+    server_class = Server
+    thread_class = ServerThread
+
+    def start(self, **options):
+        self.server_thread = self.thread_class(self.server_class('127.0.0.1', 0, **options))
+        self.server_thread.start()
+        self.socks = []
+
+    def tearDown(self):
+        for sock in self.socks:
+            sock.close()
+        self.server_thread.stop()
+
+    def connect(self, name):
+        sock, response = connect_client(self.server_thread.port, name)
+        self.socks.append(sock)
+        self.assertEqual(response[STATUS_CODE], 200)
+        return sock
+
+    def test_delay_policy_slows_sender(self):
+        self.start(rate_limiter=RateLimiter(account_rate=20, account_burst=5))
+        sender = self.connect('test1')
+        receiver = self.connect('test2')
+        started = time.monotonic()
+        sender.sendall(b''.join(encode_message(message('test1', 'test2', str(i))) for i in range(15)))
+        for i in range(15):
+            self.assertEqual(get_message(receiver)[MESSAGE_TEXT], str(i))
+        self.assertGreaterEqual(time.monotonic() - started, 0.4)
+        self.assertGreater(self.server_thread.server.stats['throttled_clients'], 0)
+
+    def test_reject_policy(self):
+        self.start(rate_limiter=RateLimiter(account_rate=0.5, account_burst=3), rate_limit_policy=RATE_LIMIT_REJECT)
+        sender = self.connect('test1')
+        receiver = self.connect('test2')
+        sender.sendall(b''.join(encode_message(message('test1', 'test2', str(i))) for i in range(5)))
+        self.assertEqual([get_message(sender)[STATUS_CODE] for _ in range(2)], [429, 429])
+        self.assertEqual([get_message(receiver)[MESSAGE_TEXT] for _ in range(3)], ['0', '1', '2'])
+        self.assertEqual(self.server_thread.server.stats['rate_limited_messages'], 2)
+
+    def test_disconnect_policy(self):
+        self.start(rate_limiter=RateLimiter(ip_rate=0.5, ip_burst=4), rate_limit_policy=RATE_LIMIT_DISCONNECT)
+        sender = self.connect('test1')
+        self.connect('test2')
+        sender.sendall(b''.join(encode_message(message('test1', 'test2', str(i))) for i in range(5)))
+        with self.assertRaises(ConnectionError):
+            while True:
+                get_message(sender)
+        self.assertEqual(self.server_thread.server.stats['rate_limit_disconnects'], 1)
+
+
+class TestAsyncRateLimits(TestRateLimits):
+    server_class = AsyncServer
+    thread_class = AsyncServerThread
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+import time
+import unittest
+from common.utils import send_message, get_message
+from common.variables import ACTION, MESSAGE, TIME, SENDER, DESTINATION, MESSAGE_TEXT, STATUS_CODE, \
+    JOIN, LEAVE, ROOM, LEGACY_PROTOCOL_VERSION, PROTOCOL_VERSION
+from common.message_codecs import CODECS
+from server import Server, AsyncServer
+from server_core.connection import ClientConnection
+from unit_test.helpers import ServerThread, AsyncServerThread, connect_client
+
+
+def room_message(sender, room, text):
+    return {ACTION: MESSAGE, TIME: 1.1, SENDER: sender, DESTINATION: room, MESSAGE_TEXT: text}
+
+
+class TestFanOut(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Server('127.0.0.1', 0)
+        self.members = []
+        for i in range(10):
+            member = ClientConnection(None, ('test', i))
+            member.name = f'test{i}'
+            member.protocol_version = PROTOCOL_VERSION
+            self.members.append(member)
+            self.server.rooms.join('#room', member)
+
+    def test_frame_encoded_once_and_shared(self):
+        self.members[5].set_codec(CODECS['struct'])
+        sender = self.members[0]
+        self.server.publish(self.server.rooms.get('#room'), sender, room_message('test0', '#room', 'Привет'))
+        self.server.run_fanouts()
+        self.assertEqual(len(sender.out_queue), 0)
+        json_frames = {id(member.out_queue[0]) for member in self.members[1:] if member is not self.members[5]}
+        self.assertEqual(len(json_frames), 1)
+        self.assertEqual(len(self.members[5].out_queue), 1)
+        self.assertEqual(self.server.stats['fanout_frames'], 2)
+
+    def test_fanout_runs_in_chunks(self):
+        self.server.fanout_chunk = 4
+        self.server.publish(self.server.rooms.get('#room'), self.members[0], room_message('test0', '#room', '1'))
+        self.server.publish(self.server.rooms.get('#room'), self.members[1], room_message('test1', '#room', '2'))
+        rounds = 0
+        while self.server.fanouts:
+            self.server.run_fanouts()
+            rounds += 1
+        self.assertEqual(rounds, 5)
+        for member in self.members[2:]:
+            self.assertEqual(len(member.out_queue), 2)
+
+    def test_relay_time_counts_from_receive(self):
+        self.server.fanout_chunk = 4
+        sender = self.members[0]
+        sender.received_at = time.perf_counter() - 1
+        self.server.publish(self.server.rooms.get('#room'), sender, room_message('test0', '#room', '1'))
+        while self.server.fanouts:
+            self.server.run_fanouts()
+        # Одно наблюдение на рассылку, когда кадр поставлен в очередь последнего участника
+        self.assertEqual(self.server.relay_time.count, 1)
+        self.assertGreaterEqual(self.server.relay_time.sum, 1)
+
+    def test_leave_all_removes_empty_rooms(self):
+        self.server.rooms.join('#other', self.members[0])
+        self.server.rooms.leave_all(self.members[0])
+        self.assertIsNone(self.server.rooms.get('#other'))
+        self.assertNotIn(self.members[0], self.server.rooms.get('#room').members)
+        self.assertFalse(self.server.rooms.leave('#room', self.members[0]))
+
+
+class TestRooms(unittest.TestCase):
+    server_class = Server
+    thread_class = ServerThread
+
+    def setUp(self):
+        self.server_thread = self.thread_class(self.server_class('127.0.0.1', 0))
+        self.server_thread.start()
+        self.socks = []
+
+    def tearDown(self):
+        for sock in self.socks:
+            sock.close()
+        self.server_thread.stop()
+
+    def connect(self, name, version=PROTOCOL_VERSION, codecs=None):
+        sock, response = connect_client(self.server_thread.port, name, version, codecs)
+        self.socks.append(sock)
+        return sock
+
+    @staticmethod
+    def request(sock, action, room, codec=None):
+        send_message(sock, {ACTION: action, TIME: 1.1, ROOM: room}, codec=codec or CODECS['json'])
+        return get_message(sock, codec or CODECS['json'])
+
+    def test_room_fanout_between_formats(self):
+        struct_codec = CODECS['struct']
+        first = self.connect('test1', codecs=['struct'])
+        second = self.connect('test2', codecs=['struct'])
+        third = self.connect('test3')
+        legacy = self.connect('test4', LEGACY_PROTOCOL_VERSION)
+        self.assertEqual(self.request(first, JOIN, '#room', struct_codec)[STATUS_CODE], 200)
+        self.assertEqual(self.request(second, JOIN, '#room', struct_codec)[STATUS_CODE], 200)
+        self.assertEqual(self.request(third, JOIN, '#room')[STATUS_CODE], 200)
+        send_message(legacy, {ACTION: JOIN, TIME: 1.1, ROOM: '#room'}, LEGACY_PROTOCOL_VERSION)
+        self.assertEqual(get_message(legacy)[STATUS_CODE], 200)
+
+        message = room_message('test1', '#room', 'Всем привет')
+        send_message(first, message, codec=struct_codec)
+        self.assertEqual(get_message(second, struct_codec), message)
+        self.assertEqual(get_message(third), message)
+        self.assertEqual(get_message(legacy), message)
+
+        self.assertEqual(self.request(third, LEAVE, '#room')[STATUS_CODE], 200)
+        send_message(second, room_message('test2', '#room', 'Второе'), codec=struct_codec)
+        self.assertEqual(get_message(first, struct_codec)[MESSAGE_TEXT], 'Второе')
+        self.assertEqual(get_message(legacy)[MESSAGE_TEXT], 'Второе')
+        send_message(third, room_message('test3', '#room', 'Не участник'))
+        self.assertEqual(get_message(third)[STATUS_CODE], 403)
+
+    def test_bad_room_name(self):
+        sock = self.connect('test1')
+        self.assertEqual(self.request(sock, JOIN, 'room')[STATUS_CODE], 400)
+        self.assertEqual(self.request(sock, LEAVE, '#room')[STATUS_CODE], 404)
+
+
+class TestAsyncRooms(TestRooms):
+    server_class = AsyncServer
+    thread_class = AsyncServerThread
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+import unittest
+from common.utils import send_message, get_message
+from common.variables import ACTION, MESSAGE, TIME, SENDER, DESTINATION, MESSAGE_TEXT, \
+    STATUS_CODE, VERSION, PROTOCOL_VERSION, LEGACY_PROTOCOL_VERSION, EXIT, ACCOUNT_NAME, CODEC, PRESENCE, USER
+from common.message_codecs import CODECS as CODECS_BY_NAME
+from server import Server
+from unit_test.helpers import ServerThread, connect_client
+
+
+class TestServerLoop(unittest.TestCase):
+
+    def setUp(self):
+        self.server_thread = ServerThread(Server('127.0.0.1', 0))
+        self.server_thread.start()
+        self.port = self.server_thread.port
+        self.socks = []
+
+    def tearDown(self):
+        for sock in self.socks:
+            sock.close()
+        self.server_thread.stop()
+
+    def connect(self, name, version=PROTOCOL_VERSION, codecs=None):
+        sock, response = connect_client(self.port, name, version, codecs)
+        self.socks.append(sock)
+        return sock, response
+
+    @staticmethod
+    def message(sender, destination, text):
+        return {ACTION: MESSAGE, TIME: 1.1, SENDER: sender, DESTINATION: destination, MESSAGE_TEXT: text}
+
+    def test_presence_negotiates_version(self):
+        _, response = self.connect('new')
+        self.assertEqual(response[STATUS_CODE], 200)
+        self.assertEqual(response[VERSION], PROTOCOL_VERSION)
+        _, response = self.connect('old', LEGACY_PROTOCOL_VERSION)
+        self.assertEqual(response[VERSION], LEGACY_PROTOCOL_VERSION)
+
+    def test_duplicate_name_rejected(self):
+        self.connect('test1')
+        sock, response = self.connect('test1')
+        self.assertEqual(response[STATUS_CODE], 400)
+        self.assertEqual(sock.recv(1), b'')
+
+    def test_relay_burst_of_large_messages(self):
+        sender, _ = self.connect('test1')
+        receiver, _ = self.connect('test2', LEGACY_PROTOCOL_VERSION)
+        for i in range(20):
+            send_message(sender, self.message('test1', 'test2', str(i) * 5000))
+        for i in range(20):
+            self.assertEqual(get_message(receiver)[MESSAGE_TEXT], str(i) * 5000)
+
+    def test_relay_between_codecs(self):
+        sender, response = self.connect('test1', codecs=['struct'])
+        self.assertEqual(response[CODEC], 'struct')
+        receiver, response = self.connect('test2', codecs=['json'])
+        self.assertEqual(response[CODEC], 'json')
+        message = self.message('test1', 'test2', 'Привет')
+        send_message(sender, message, codec=CODECS_BY_NAME['struct'])
+        self.assertEqual(get_message(receiver), message)
+        send_message(receiver, self.message('test2', 'test1', 'Ответ'))
+        self.assertEqual(get_message(sender, CODECS_BY_NAME['struct'])[MESSAGE_TEXT], 'Ответ')
+
+    def test_relay_fast_path(self):
+        struct_codec = CODECS_BY_NAME['struct']
+        sender, _ = self.connect('test1', codecs=['struct'])
+        receiver, _ = self.connect('test2', codecs=['struct'])
+        for i in range(10):
+            send_message(sender, self.message('test1', 'test2', str(i)), codec=struct_codec)
+        for i in range(10):
+            self.assertEqual(get_message(receiver, struct_codec), self.message('test1', 'test2', str(i)))
+        self.assertEqual(self.server_thread.server.stats['relayed_frames'], 10)
+
+    def test_relay_fast_path_checks_sender(self):
+        struct_codec = CODECS_BY_NAME['struct']
+        sender, _ = self.connect('test1', codecs=['struct'])
+        receiver, _ = self.connect('test2', codecs=['struct'])
+        send_message(sender, self.message('test3', 'test2', 'Чужое имя'), codec=struct_codec)
+        self.assertEqual(get_message(sender, struct_codec)[STATUS_CODE], 403)
+        send_message(sender, self.message('test1', 'test2', 'Привет'), codec=struct_codec)
+        self.assertEqual(get_message(receiver, struct_codec)[MESSAGE_TEXT], 'Привет')
+        self.assertEqual(self.server_thread.server.stats['relayed_frames'], 1)
+        self.assertEqual(self.server_thread.server.stats['relayed_messages'], 0)
+
+    def test_forged_sender_is_rejected(self):
+        sender, _ = self.connect('test1')
+        self.connect('test2')
+        send_message(sender, self.message('test2', 'test2', 'Чужое имя'))
+        self.assertEqual(get_message(sender)[STATUS_CODE], 403)
+        self.assertEqual(self.server_thread.server.stats['relayed_messages'], 0)
+
+    def test_exit_releases_name(self):
+        sock, _ = self.connect('test1')
+        send_message(sock, {ACTION: EXIT, TIME: 1.1, ACCOUNT_NAME: 'test1'})
+        self.assertEqual(sock.recv(1), b'')
+        _, response = self.connect('test1')
+        self.assertEqual(response[STATUS_CODE], 200)
+
+    def test_exit_only_for_own_name(self):
+        sock, _ = self.connect('test1')
+        other, _ = self.connect('test2')
+        send_message(sock, {ACTION: EXIT, TIME: 1.1, ACCOUNT_NAME: 'test2'})
+        self.assertEqual(get_message(sock)[STATUS_CODE], 400)
+        send_message(sock, {ACTION: EXIT, TIME: 1.1, ACCOUNT_NAME: 'test3'})
+        self.assertEqual(get_message(sock)[STATUS_CODE], 400)
+        send_message(sock, self.message('test1', 'test2', 'Привет'))
+        self.assertEqual(get_message(other)[MESSAGE_TEXT], 'Привет')
+
+    def test_second_presence_rejected(self):
+        sock, _ = self.connect('test1')
+        send_message(sock, {ACTION: PRESENCE, TIME: 1.1, USER: {ACCOUNT_NAME: 'test2'}})
+        self.assertEqual(get_message(sock)[STATUS_CODE], 400)
+        self.assertEqual(self.server_thread.server.names['test1'].name, 'test1')
+        self.assertNotIn('test2', self.server_thread.server.names)
+        send_message(sock, {ACTION: EXIT, TIME: 1.1, ACCOUNT_NAME: 'test1'})
+        self.assertEqual(sock.recv(1), b'')
+        _, response = self.connect('test1')
+        self.assertEqual(response[STATUS_CODE], 200)
+
+    def test_malformed_presence_rejected(self):
+        for name in (None, '', ['test1']):
+            _, response = self.connect(name)
+            self.assertEqual(response[STATUS_CODE], 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
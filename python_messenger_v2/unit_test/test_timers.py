@@ -0,0 +1,122 @@
+import socket
+import time
+import unittest
+from common.utils import send_message, get_message
+from common.variables import ACTION, TIME, PING, PONG, STATUS_CODE, LEGACY_PROTOCOL_VERSION
+from server import Server, AsyncServer
+from server_core.timers import TimerWheel
+from unit_test.helpers import ServerThread, AsyncServerThread, connect_client
+
+
+class TestTimerWheel(unittest.TestCase):
+
+    def test_timers_fire_on_their_tick(self):
+        wheel = TimerWheel(1, 0)
+        fired = []
+        delays = [1, 5, 63, 64, 65, 4095, 4096, 4097, 300000, 20000000]
+        for delay in delays:
+            wheel.schedule(0, delay, fired.append, delay)
+        self.assertEqual(len(wheel), len(delays))
+        for now in (0, 1, 64, 4096, 4097, 299999):
+            wheel.run(now)
+            self.assertEqual(fired, [delay for delay in delays if delay <= now])
+        wheel.run(20000000)
+        self.assertEqual(fired, delays)
+        self.assertEqual(len(wheel), 0)
+
+    def test_cancel(self):
+        wheel = TimerWheel(0.5, 100)
+        fired = []
+        first = wheel.schedule(100, 1, fired.append, 'first')
+        wheel.schedule(100, 1, fired.append, 'second')
+        far = wheel.schedule(100, 1000, fired.append, 'far')
+        wheel.cancel(first)
+        wheel.cancel(far)
+        wheel.cancel(first)
+        self.assertEqual(len(wheel), 1)
+        wheel.run(2000)
+        self.assertEqual(fired, ['second'])
+
+    def test_schedule_in_the_past_fires_on_next_tick(self):
+        wheel = TimerWheel(1, 10)
+        fired = []
+        wheel.schedule(10, -5, fired.append, 'late')
+        wheel.run(10)
+        self.assertEqual(fired, [])
+        wheel.run(11)
+        self.assertEqual(fired, ['late'])
+
+
+class TestHeartbeats(unittest.TestCase):
+    server_class = Server
+    thread_class = ServerThread
+
+    def setUp(self):
+        self.server_thread = self.thread_class(self.server_class(
+            '127.0.0.1', 0, ping_interval=0.3, idle_timeout=0.8, handshake_timeout=0.3))
+        self.server_thread.start()
+        self.socks = []
+
+    def tearDown(self):
+        for sock in self.socks:
+            sock.close()
+        self.server_thread.stop()
+
+    def connect(self, name, version=None):
+        if version is None:
+            sock, response = connect_client(self.server_thread.port, name)
+        else:
+            sock, response = connect_client(self.server_thread.port, name, version)
+        self.socks.append(sock)
+        self.assertEqual(response[STATUS_CODE], 200)
+        return sock
+
+    def test_handshake_timeout(self):
+        sock = socket.create_connection(('127.0.0.1', self.server_thread.port), timeout=5)
+        self.socks.append(sock)
+        self.assertEqual(sock.recv(1), b'')
+        self.assertEqual(self.server_thread.server.stats['handshake_timeouts'], 1)
+
+    def test_answered_pings_keep_connection(self):
+        sock = self.connect('test1')
+        deadline = time.monotonic() + 1.5
+        pings = 0
+        while time.monotonic() < deadline:
+            message = get_message(sock)
+            self.assertEqual(message[ACTION], PING)
+            send_message(sock, {ACTION: PONG, TIME: message[TIME]})
+            pings += 1
+        self.assertGreaterEqual(pings, 3)
+        send_message(sock, {ACTION: PING, TIME: 1.5})
+        while (message := get_message(sock))[ACTION] != PONG:
+            pass
+        self.assertEqual(message[TIME], 1.5)
+        self.assertIn('test1', self.server_thread.server.names)
+
+    def test_silent_client_is_reaped(self):
+        sock = self.connect('test1')
+        self.assertEqual(get_message(sock)[ACTION], PING)
+        while True:
+            try:
+                get_message(sock)
+            except ConnectionError:
+                break
+        self.assertNotIn('test1', self.server_thread.server.names)
+        self.assertEqual(self.server_thread.server.stats['idle_disconnects'], 1)
+        self.connect('test1')
+
+    def test_legacy_client_is_not_pinged(self):
+        sock = self.connect('test1', LEGACY_PROTOCOL_VERSION)
+        sock.settimeout(1)
+        with self.assertRaises(socket.timeout):
+            sock.recv(1)
+        self.assertIn('test1', self.server_thread.server.names)
+
+
+class TestAsyncHeartbeats(TestHeartbeats):
+    server_class = AsyncServer
+    thread_class = AsyncServerThread
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,9 @@
 import unittest
 import json
-from common.variables import ENCODING, ACTION, PRESENCE, TIME, USER, ACCOUNT_NAME, STATUS, STATUS_CODE
-from common.utils import get_message, send_message
+from common.variables import ENCODING, ACTION, PRESENCE, TIME, USER, ACCOUNT_NAME, STATUS, STATUS_CODE, \
+    LEGACY_PROTOCOL_VERSION, MESSAGE, SENDER, DESTINATION, MESSAGE_TEXT, RECV_BUFFER_SIZE, RECV_BUFFER_MIN
+from common.message_codecs import CODECS
+from common.utils import get_message, send_message, encode_message, MessageDecoder, FRAME_HEADER
 
 
 class TestSocket:
@@ -11,9 +13,9 @@ class TestSocket:
         self.encoded_message = None
         self.receved_message = None
 
-    def send(self, message_to_send):
-        json_test_message = json.dumps(self.test_dict)
-        self.encoded_message = json_test_message.encode(ENCODING)
+    def sendall(self, message_to_send):
+        json_test_message = json.dumps(self.test_dict).encode(ENCODING)
+        self.encoded_message = FRAME_HEADER.pack(len(json_test_message)) + json_test_message
         self.receved_message = message_to_send
 
     def recv(self, max_len):
@@ -21,6 +23,23 @@ class TestSocket:
         return json_test_message.encode(ENCODING)
 
 
+class ChunkedSocket:
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def recv(self, max_len):
+        return self.chunks.pop(0)
+
+    def recv_into(self, buffer):
+        chunk = self.chunks.pop(0)
+        if len(chunk) > len(buffer):
+            self.chunks.insert(0, chunk[len(buffer):])
+            chunk = chunk[:len(buffer)]
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+
 class TestUtils(unittest.TestCase):
     test_dict_send = {
         ACTION: PRESENCE,
@@ -55,6 +74,113 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(get_message(test_sock_ok), self.test_dict_recv_ok)
         self.assertEqual(get_message(test_sock_err), self.test_dict_recv_err)
 
+    def test_get_message_split_frame(self):
+        frame = encode_message(self.test_dict_send)
+        test_sock = ChunkedSocket([frame[:2], frame[2:7], frame[7:]])
+        self.assertEqual(get_message(test_sock), self.test_dict_send)
+
+    def test_get_message_coalesced_frames(self):
+        data = encode_message(self.test_dict_recv_ok) + encode_message(self.test_dict_recv_err)
+        test_sock = ChunkedSocket([data])
+        self.assertEqual(get_message(test_sock), self.test_dict_recv_ok)
+        self.assertEqual(get_message(test_sock), self.test_dict_recv_err)
+
+    def test_get_message_closed(self):
+        with self.assertRaises(ConnectionError):
+            get_message(ChunkedSocket([b'']))
+
+    def test_decoder_legacy_messages(self):
+        decoder = MessageDecoder()
+        data = encode_message(self.test_dict_send, LEGACY_PROTOCOL_VERSION) + \
+            encode_message({STATUS: 'Привет'}, LEGACY_PROTOCOL_VERSION)
+        self.assertEqual(list(decoder.feed(data[:-5])), [self.test_dict_send])
+        self.assertEqual(list(decoder.feed(data[-5:])), [{STATUS: 'Привет'}])
+        self.assertEqual(decoder.buffer, bytearray())
+
+    def test_decoder_mixed_formats(self):
+        decoder = MessageDecoder()
+        data = encode_message(self.test_dict_send, LEGACY_PROTOCOL_VERSION) + encode_message(self.test_dict_recv_ok)
+        self.assertEqual(list(decoder.feed(data)), [self.test_dict_send, self.test_dict_recv_ok])
+
+    def test_decoder_codec_switch_between_frames(self):
+        struct_codec = CODECS['struct']
+        message = {ACTION: MESSAGE, TIME: 1.5, SENDER: 'test1', DESTINATION: 'test2', MESSAGE_TEXT: 'Привет'}
+        test_sock = ChunkedSocket([encode_message(self.test_dict_recv_ok) + encode_message(message, codec=struct_codec)])
+        self.assertEqual(get_message(test_sock), self.test_dict_recv_ok)
+        self.assertEqual(get_message(test_sock, struct_codec), message)
+
+    def test_decoder_frames_without_copy(self):
+        decoder = MessageDecoder()
+        first = encode_message(self.test_dict_send)
+        second = encode_message(self.test_dict_recv_ok)
+        decoder.append(first + second[:3])
+        frames = list(decoder.frames())
+        self.assertEqual(len(frames), 1)
+        self.assertIsInstance(frames[0][0], memoryview)
+        self.assertEqual(decoder.decode_frame(frames[0][0]), self.test_dict_send)
+        decoder.append(second[3:])
+        frame, message = next(decoder.frames())
+        self.assertIsNone(message)
+        self.assertEqual(bytes(frame), second)
+        self.assertEqual(decoder.buffer, bytearray())
+
+    def test_decoder_rejects_long_frame(self):
+        decoder = MessageDecoder(max_length=16)
+        with self.assertRaises(ValueError):
+            list(decoder.feed(encode_message({STATUS: 'x' * 32})))
+
+    def test_decoder_rejects_garbage(self):
+        with self.assertRaises(ValueError):
+            list(MessageDecoder().feed(b'{"a": }'))
+        with self.assertRaises(ValueError):
+            list(MessageDecoder().feed(encode_message([1, 2])))
+
+    def test_decoder_recv_into(self):
+        first = encode_message(self.test_dict_send)
+        second = encode_message(self.test_dict_recv_ok)
+        legacy = encode_message({STATUS: 'Привет'}, LEGACY_PROTOCOL_VERSION)
+        sock = ChunkedSocket([first + second[:3], second[3:] + legacy[:7], legacy[7:]])
+        decoder = MessageDecoder()
+        received = []
+        while sock.chunks:
+            decoder.recv_into(sock)
+            received.extend(decoder.messages())
+        self.assertEqual(received, [self.test_dict_send, self.test_dict_recv_ok, {STATUS: 'Привет'}])
+        self.assertEqual(decoder.buffer, bytearray())
+
+    def test_decoder_buffer_grows_for_long_frame(self):
+        long_frame = encode_message({STATUS: 'x' * 200000})
+        short_frame = encode_message(self.test_dict_recv_ok)
+        sock = ChunkedSocket([long_frame + short_frame])
+        decoder = MessageDecoder()
+        messages = []
+        while not messages:
+            decoder.recv_into(sock)
+            messages.extend(decoder.messages())
+        self.assertEqual(messages, [{STATUS: 'x' * 200000}])
+        # Остаток кадра читается одним вызовом в буфер под его длину
+        self.assertLess(len(decoder._buffer), 2 * len(long_frame))
+        decoder.recv_into(sock)
+        self.assertEqual(list(decoder.messages()), [self.test_dict_recv_ok])
+        self.assertLessEqual(len(decoder._buffer), RECV_BUFFER_SIZE)
+
+    def test_decoder_shrink(self):
+        frame = encode_message(self.test_dict_recv_ok)
+        sock = ChunkedSocket([frame * 1000, frame[:3]])
+        decoder = MessageDecoder()
+        count = 0
+        while count < 1000:
+            decoder.recv_into(sock)
+            count += len(list(decoder.messages()))
+        self.assertGreater(len(decoder._buffer), RECV_BUFFER_MIN)
+        decoder.recv_into(sock)
+        self.assertEqual(list(decoder.messages()), [])
+        decoder.shrink()
+        self.assertEqual(len(decoder._buffer), 3)
+        self.assertEqual(list(decoder.feed(frame[3:])), [self.test_dict_recv_ok])
+        decoder.shrink()
+        self.assertEqual(len(decoder._buffer), 0)
+
 
 if __name__ == '__main__':
     unittest.main()
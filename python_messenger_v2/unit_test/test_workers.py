@@ -0,0 +1,121 @@
+import socket
+import tempfile
+import time
+import unittest
+from unittest import mock
+from common.utils import send_message, get_message
+from common.variables import ACTION, MESSAGE, TIME, SENDER, DESTINATION, MESSAGE_TEXT, STATUS_CODE, \
+    JOIN, ROOM
+from server import Server
+from server_core.workers import NameRegistry, WorkerCluster
+from unit_test.helpers import ServerThread, connect_client
+
+
+class TestNameRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.registry = NameRegistry(self.directory.name)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_claim_is_exclusive(self):
+        self.assertTrue(self.registry.claim('Гость/1', 0))
+        self.assertFalse(self.registry.claim('Гость/1', 1))
+        self.assertEqual(self.registry.owner('Гость/1'), 0)
+        self.registry.release('Гость/1')
+        self.assertIsNone(self.registry.owner('Гость/1'))
+        self.assertTrue(self.registry.claim('Гость/1', 1))
+
+    def test_release_worker(self):
+        self.registry.claim('test1', 0)
+        self.registry.claim('test2', 1)
+        self.registry.release_worker(0)
+        self.assertIsNone(self.registry.owner('test1'))
+        self.assertEqual(self.registry.owner('test2'), 1)
+
+
+class TestWorkerRouting(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        registry = NameRegistry(self.directory.name)
+        first_sock, second_sock = socket.socketpair()
+        self.threads = []
+        for worker_id, peer_id, sock in ((0, 1, first_sock), (1, 0, second_sock)):
+            server = Server('127.0.0.1', 0)
+            server.cluster = WorkerCluster(worker_id, registry, {peer_id: sock})
+            thread = ServerThread(server)
+            thread.start()
+            self.threads.append(thread)
+        self.socks = []
+
+    def tearDown(self):
+        for sock in self.socks:
+            sock.close()
+        for thread in self.threads:
+            thread.stop()
+        self.directory.cleanup()
+
+    def connect(self, worker_id, name):
+        sock, response = connect_client(self.threads[worker_id].port, name)
+        self.socks.append(sock)
+        return sock, response
+
+    def test_duplicate_name_across_workers(self):
+        _, response = self.connect(0, 'test1')
+        self.assertEqual(response[STATUS_CODE], 200)
+        _, response = self.connect(1, 'test1')
+        self.assertEqual(response[STATUS_CODE], 400)
+
+    def test_message_between_workers(self):
+        first, _ = self.connect(0, 'test1')
+        second, _ = self.connect(1, 'test2')
+        send_message(first, {ACTION: MESSAGE, TIME: 1.1, SENDER: 'test1',
+                             DESTINATION: 'test2', MESSAGE_TEXT: 'Привет'})
+        self.assertEqual(get_message(second)[MESSAGE_TEXT], 'Привет')
+        send_message(second, {ACTION: MESSAGE, TIME: 1.1, SENDER: 'test2',
+                              DESTINATION: 'test1', MESSAGE_TEXT: 'Ответ'})
+        self.assertEqual(get_message(first)[MESSAGE_TEXT], 'Ответ')
+
+    def test_rooms_rejected(self):
+        for worker_id, name in ((0, 'test1'), (1, 'test2')):
+            sock, _ = self.connect(worker_id, name)
+            send_message(sock, {ACTION: JOIN, TIME: 1.1, ROOM: '#room'})
+            self.assertEqual(get_message(sock)[STATUS_CODE], 501)
+            self.assertIsNone(self.threads[worker_id].server.rooms.get('#room'))
+
+    def test_unknown_name_read_from_registry_once(self):
+        first, _ = self.connect(0, 'test1')
+        cluster = self.threads[0].server.cluster
+        with mock.patch.object(cluster.registry, 'owner', wraps=cluster.registry.owner) as owner:
+            for number in range(10):
+                send_message(first, {ACTION: MESSAGE, TIME: 1.1, SENDER: 'test1',
+                                     DESTINATION: 'test2', MESSAGE_TEXT: str(number)})
+            deadline = time.monotonic() + 5
+            while self.threads[0].server.stats['undeliverable_messages'] < 10:
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.01)
+            self.assertEqual(owner.call_count, 1)
+        second, _ = self.connect(1, 'test2')
+        while 'test2' in cluster.unknown_names:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+        send_message(first, {ACTION: MESSAGE, TIME: 1.1, SENDER: 'test1',
+                             DESTINATION: 'test2', MESSAGE_TEXT: 'Привет'})
+        self.assertEqual(get_message(second)[MESSAGE_TEXT], 'Привет')
+
+    def test_name_released_after_disconnect(self):
+        first, _ = self.connect(0, 'test1')
+        first.close()
+        for _ in range(50):
+            sock, response = connect_client(self.threads[1].port, 'test1')
+            self.socks.append(sock)
+            if response[STATUS_CODE] == 200:
+                break
+        self.assertEqual(response[STATUS_CODE], 200)
+
+
+if __name__ == '__main__':
+    unittest.main()